@@ -1,48 +1,576 @@
-import pprint
-import ansible_runner
+import asyncio
+import json
 import logging
-from ansible_runner import Runner
+import os
+import shlex
+import signal
+import sys
+import tempfile
 import threading
+import time
+from typing import TYPE_CHECKING, Callable, Dict, List, Tuple
+from .metrics import PHASE_PROCESS_SPAWN, PHASE_RUNNER_STARTUP, PHASE_PLAYBOOK_EXECUTION, PHASE_FACT_GATHERING
+from .trace import span
+
+if TYPE_CHECKING:
+    # ansible_runner is only imported where playbooks are executed, see "PlaybookRunner.preload"
+    from ansible_runner import Runner
 
 _LOGGER = logging.getLogger(__name__)
 
-runner_status = None
+BACKEND_FORK = "fork"
+BACKEND_SUBPROCESS = "subprocess"
+BACKEND_POOL = "pool"
+BACKENDS = [BACKEND_FORK, BACKEND_SUBPROCESS, BACKEND_POOL]
 
+STATS_KEYS = ["changed", "dark", "failures", "ignored", "ok", "processed", "rescued", "skipped"]
 
-def finished_callback(runner: Runner):
-    _LOGGER.debug(threading.current_thread().name + " - " + runner.status)
-    global runner_status
-    runner_status = runner.status
+# Job events carry the task output, they can get way bigger than the default 64 KiB line limit.
+SUBPROCESS_LINE_LIMIT = 16 * 1024 * 1024
 
+# Messages from a worker to the parent process are (kind, payload) tuples
+MESSAGE_PROGRESS = "progress"
+MESSAGE_RESULT = "result"
 
-async def async_execute_playbook(private_data_dir: str, playbook: str, vault_password_file: str | None) -> Runner:
-    return execute_playbook(
-        private_data_dir=private_data_dir,
-        playbook=playbook,
-        vault_password_file=vault_password_file
-    )
+# How often progress snapshots are sent at most, everything in between is coalesced into the next snapshot.
+PROGRESS_INTERVAL = 1.0
 
+HOST_DONE_EVENTS = {"runner_on_ok", "runner_on_failed", "runner_on_skipped", "runner_on_unreachable"}
+# The events ending the current task
+TASK_END_EVENTS = {"playbook_on_task_start", "playbook_on_play_start", "playbook_on_stats"}
+GATHER_FACTS_ACTIONS = {"gather_facts", "ansible.builtin.gather_facts", "setup", "ansible.builtin.setup"}
 
-def execute_playbook(private_data_dir: str, playbook: str, vault_password_file: str | None) -> Runner:
-    global runner_status
-    runner_status = None
+# Key of the wall clock time a worker sent its result at, in the timings it sends along
+TIMINGS_SENT_AT = "sent_at"
 
-    _LOGGER.debug(threading.current_thread().name + " - Starting ansible_runner.run_async")
-    (thread, runner) = ansible_runner.run_async(
-        private_data_dir=private_data_dir,
-        playbook=playbook,
-        finished_callback=finished_callback,
-        cmdline='--vault-password-file ' + vault_password_file if vault_password_file is not None else None,
-        quiet=True,
-    )
+# A playbook group runs a play of this name (followed by the index of the member) before every member playbook
+GROUP_MEMBER_PLAY = "ansible_playbook group member"
+# Facts gathered by a member are reused by the following members instead of being gathered again (also
+# without the fact cache of AnsibleRuntimeDirectories), unless the ansible.cfg of the project sets "gathering"
+GROUP_ENVVARS = {"ANSIBLE_GATHERING": "smart"}
+GROUP_ENVVARS_SETTINGS = (("defaults", "gathering"),)
+
+# Longer limits are passed to ansible in a file ("--limit @file"): a single argument may not exceed 128 KiB on
+# Linux, which a shard of a large inventory easily does
+MAX_LIMIT_ARGUMENT_LENGTH = 32 * 1024
+
+# The status of a run which was stopped, by the stop service or by its timeout (ansible-runner's own terms)
+STATUS_CANCELED = "canceled"
+STATUS_TIMEOUT = "timeout"
+# How long the processes of a stopped run get to wind down after SIGTERM, before they are killed
+STOP_GRACE_PERIOD = 10.0
+# The prompt of "ansible-playbook --ask-vault-pass", answered by ansible-runner (its "passwords" are regexes)
+VAULT_PASSWORD_PROMPT = r"^Vault password:\s*?$"
+
+
+class RunTimer:
+    """
+    Measures the phases of a run in the process executing it: process spawn (where started there), the
+    startup of ansible-runner until its first job event, and the playbook execution after that. Within the
+    playbook execution, the time spent in fact gathering tasks is summed up.
+    """
+    def __init__(self):
+        self._phase_started = time.monotonic()
+        self._first_event: float | None = None
+        self._gathering_started: float | None = None
+        self.timings: Dict[str, float] = {}
+
+    def spawned(self) -> None:
+        now = time.monotonic()
+        self.timings[PHASE_PROCESS_SPAWN] = now - self._phase_started
+        self._phase_started = now
+
+    def handle_event(self, event: dict) -> None:
+        if self._first_event is None:
+            self._first_event = time.monotonic()
+            self.timings[PHASE_RUNNER_STARTUP] = self._first_event - self._phase_started
+        event_type = event.get("event")
+        if event_type in TASK_END_EVENTS:
+            self._end_gathering()
+            if event_type == "playbook_on_task_start" and (event.get("event_data") or {}).get("task_action") in GATHER_FACTS_ACTIONS:
+                self._gathering_started = time.monotonic()
+
+    def finished(self) -> Dict[str, float]:
+        self._end_gathering()
+        started = self._first_event if self._first_event is not None else self._phase_started
+        self.timings[PHASE_PLAYBOOK_EXECUTION] = time.monotonic() - started
+        return self.timings
+
+    def _end_gathering(self) -> None:
+        if self._gathering_started is not None:
+            gathering = time.monotonic() - self._gathering_started
+            self.timings[PHASE_FACT_GATHERING] = self.timings.get(PHASE_FACT_GATHERING, 0.0) + gathering
+            self._gathering_started = None
+
+
+class PlaybookProgress:
+    """
+    Folds ansible-runner job events into the progress of the current task.
+
+    Hosts are counted per play: a host is known once it started a task of the play, and done once it
+    finished the current task.
+    """
+    def __init__(self):
+        self._current_task: str | None = None
+        self._hosts: set = set()
+        self._hosts_done: set = set()
+        self._tasks_started = 0
+
+    def update(self, event: dict) -> bool:
+        """Returns whether the event changed the progress."""
+        event_type = event.get("event")
+        event_data = event.get("event_data") or {}
+        if event_type == "playbook_on_play_start":
+            self._hosts = set()
+            self._hosts_done = set()
+        elif event_type == "playbook_on_task_start":
+            self._current_task = event_data.get("task")
+            self._hosts_done = set()
+            self._tasks_started += 1
+        elif event_type == "runner_on_start":
+            self._hosts.add(event_data.get("host"))
+        elif event_type in HOST_DONE_EVENTS:
+            self._hosts.add(event_data.get("host"))
+            self._hosts_done.add(event_data.get("host"))
+        else:
+            return False
+        return True
+
+    def snapshot(self) -> dict:
+        hosts_total = len(self._hosts)
+        hosts_done = len(self._hosts_done)
+        return {
+            "current_task": self._current_task,
+            "tasks_started": self._tasks_started,
+            "hosts_done": hosts_done,
+            "hosts_total": hosts_total,
+            "percent": round(100 * hosts_done / hosts_total) if hosts_total > 0 else 0,
+        }
+
+
+class PlaybookGroupStats:
+    """
+    Splits the stats of a playbook group run by member id, using the job events.
+
+    Events belong to the member announced by the latest member play. The counters follow ansible's own
+    accounting, except that a failure which is rescued later stays a failure of the member.
+    """
+    def __init__(self, members: List[str]):
+        self._members = members
+        self._current: str | None = None
+        # member -> (stats in the layout of "Runner.stats", started at, finished at)
+        self._stats: Dict[str, Tuple[dict, float, float | None]] = {}
+
+    def update(self, event: dict) -> None:
+        event_type = event.get("event")
+        event_data = event.get("event_data") or {}
+        if event_type == "playbook_on_play_start":
+            name = event_data.get("play") or event_data.get("name") or ""
+            if name.startswith(GROUP_MEMBER_PLAY):
+                self._start_member(int(name[len(GROUP_MEMBER_PLAY):]))
+            return
+        if self._current is None or event_type not in HOST_DONE_EVENTS:
+            return
+        host = event_data.get("host")
+        stats = self._stats[self._current][0]
+        changed = bool((event_data.get("res") or {}).get("changed"))
+        if event_type == "runner_on_ok":
+            self._increment(stats, "ok", host)
+            if changed:
+                self._increment(stats, "changed", host)
+        elif event_type == "runner_on_failed":
+            if event_data.get("ignore_errors"):
+                self._increment(stats, "ok", host)
+                self._increment(stats, "ignored", host)
+                if changed:
+                    self._increment(stats, "changed", host)
+            else:
+                self._increment(stats, "failures", host)
+        elif event_type == "runner_on_skipped":
+            self._increment(stats, "skipped", host)
+        elif event_type == "runner_on_unreachable":
+            self._increment(stats, "dark", host)
+        stats["processed"][host] = 1
+
+    def member_stats(self) -> Dict[str, Tuple[dict, float, float | None]]:
+        """member -> (stats, started at, finished at) of the members which started, call it when the run is over."""
+        self._finish_member()
+        return self._stats
+
+    def _start_member(self, index: int) -> None:
+        self._finish_member()
+        self._current = self._members[index]
+        self._stats[self._current] = ({key: {} for key in STATS_KEYS}, time.time(), None)
+
+    def _finish_member(self) -> None:
+        if self._current is not None and self._stats[self._current][2] is None:
+            stats, started_at, _ = self._stats[self._current]
+            self._stats[self._current] = (stats, started_at, time.time())
+
+    @staticmethod
+    def _increment(stats: dict, key: str, host: str) -> None:
+        stats[key][host] = stats[key].get(host, 0) + 1
+
+
+class ProgressReporter:
+    """
+    An ansible-runner event handler which streams progress snapshots through "send".
+
+    Events only update a single pending snapshot; a sender thread sends it at most every "interval" seconds.
+    So a chatty playbook is coalesced instead of queued, and a slow reader blocks the sender thread only,
+    not the playbook.
+    """
+    def __init__(self, send: Callable[[dict], None], interval: float = PROGRESS_INTERVAL, timer: RunTimer = None, group_stats: PlaybookGroupStats = None):
+        self._send = send
+        self._timer = timer
+        self._group_stats = group_stats
+        self._interval = interval
+        self._progress = PlaybookProgress()
+        self._lock = threading.Lock()
+        self._pending = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sender, name="ansible-progress", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Sends the last pending snapshot and stops the sender thread."""
+        self._stopped.set()
+        self._pending.set()
+        self._thread.join()
 
-    thread.join()
-    # print(threading.current_thread().name + " - Finished ansible_runner.run_async - Status was: " + runner_status)
-    # print()
-    # pprint.pprint(runner.stats)
+    def __call__(self, event: dict) -> bool:
+        if self._timer is not None:
+            self._timer.handle_event(event)
+        if self._group_stats is not None:
+            self._group_stats.update(event)
+        with self._lock:
+            changed = self._progress.update(event)
+        if changed:
+            self._pending.set()
+        # Keep the event for ansible-runner's own processing
+        return True
+
+    def _sender(self) -> None:
+        try:
+            while not self._stopped.is_set():
+                self._pending.wait()
+                self._pending.clear()
+                self._send_snapshot()
+                self._stopped.wait(self._interval)
+            if self._pending.is_set():
+                self._send_snapshot()
+        except (BrokenPipeError, OSError):
+            pass
+
+    def _send_snapshot(self) -> None:
+        with self._lock:
+            snapshot = self._progress.snapshot()
+        self._send(snapshot)
+
+
+def cancel_on_sigterm() -> threading.Event:
+    """
+    Makes SIGTERM cancel the playbook run of a worker process instead of killing the worker: pass "is_set" of the
+    returned event as "cancel_callback" to "execute_playbook". ansible-runner then kills ansible and reports the
+    status "canceled". Must be called in the main thread of the worker.
+    """
+    canceled = threading.Event()
+    # A forked worker inherits the wakeup fd of the Home Assistant event loop, its signals must not end up there.
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGTERM, lambda signum, frame: canceled.set())
+    return canceled
+
+
+def needs_limit_file(limit: List[str] | None) -> bool:
+    return limit is not None and len(",".join(limit)) > MAX_LIMIT_ARGUMENT_LENGTH
+
+
+def write_limit_file(private_data_dir: str, limit: List[str] | None, artifact_dir: str | None = None) -> str | None:
+    """
+    Writes a limit too long for the command line to a file in the artifact dir (the "artifacts" directory of the
+    private data dir by default), one host (or pattern) per line, and returns its path; None if the limit fits on the
+    command line. The caller removes the file after the run. Blocks on file I/O.
+    """
+    if not needs_limit_file(limit):
+        return None
+    directory = artifact_dir if artifact_dir is not None else os.path.join(private_data_dir, "artifacts")
+    os.makedirs(directory, exist_ok=True)
+    descriptor, path = tempfile.mkstemp(prefix="limit-", suffix=".txt", dir=directory)
+    with os.fdopen(descriptor, "w") as limit_file:
+        limit_file.write("\n".join(limit) + "\n")
+    return path
+
+
+def _remove_limit_file(path: str | None) -> None:
+    if path is not None:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def build_runner_command(
+    private_data_dir: str,
+    playbook: str,
+    vault_password_file: str | None,
+    limit: List[str] | None = None,
+    tags: List[str] | None = None,
+    extra_vars: dict | None = None,
+    artifact_dir: str | None = None,
+    limit_file: str | None = None,
+) -> List[str]:
+    """
+    The ansible-runner command line equivalent to "execute_playbook", printing job events as JSON lines. The limit
+    is read from "limit_file" (see "write_limit_file") instead, if given.
+    """
+    command = [sys.executable, "-m", "ansible_runner", "run", private_data_dir, "--playbook", playbook, "--json"]
+    if artifact_dir is not None:
+        command += ["--artifact-dir", artifact_dir]
+    # ansible-runner splits the cmdline like a shell would
+    cmdline = []
+    if vault_password_file is not None:
+        cmdline.append("--vault-password-file " + shlex.quote(vault_password_file))
+    if tags is not None:
+        cmdline.append("--tags " + shlex.quote(",".join(tags)))
+    if extra_vars:
+        cmdline.append("--extra-vars " + shlex.quote(json.dumps(extra_vars)))
+    if cmdline:
+        command += ["--cmdline", " ".join(cmdline)]
+    if limit_file is not None:
+        command += ["--limit", "@" + limit_file]
+    elif limit is not None:
+        command += ["--limit", ",".join(limit)]
+    return command
+
+
+async def async_execute_playbook(
+    private_data_dir: str,
+    playbook: str,
+    vault_password_file: str | None,
+    event_handler: Callable[[dict], None] = None,
+    timer: RunTimer = None,
+    limit: List[str] | None = None,
+    envvars: Dict[str, str] | None = None,
+    tags: List[str] | None = None,
+    extra_vars: dict | None = None,
+    artifact_dir: str | None = None,
+) -> Tuple[str, dict | None]:
+    """
+    Runs the playbook as a subprocess of the event loop, without forking the calling process.
+
+    Returns the final runner status and the stats of the playbook (same layout as "Runner.stats"), which are taken
+    from the "playbook_on_stats" job event. The stats are None if the playbook didn't get that far.
+    Every job event is passed to "event_handler" (and "timer") as it arrives. "limit" restricts the run to
+    these hosts (or patterns), like "--limit", "tags" to the tasks with these tags. "extra_vars" are passed
+    like "--extra-vars", "envvars" are added to the environment of ansible. The artifacts go to "artifact_dir"
+    (the "artifacts" directory of the private data dir by default).
+
+    Cancelling the coroutine stops ansible-runner: it gets SIGTERM, which makes it cancel ansible, and its
+    process group is killed if it is still around after STOP_GRACE_PERIOD.
+    """
+    with span("ansible_playbook_runner.async_execute_playbook"):
+        timer = timer if timer is not None else RunTimer()
+        loop = asyncio.get_running_loop()
+        limit_file = await loop.run_in_executor(None, write_limit_file, private_data_dir, limit, artifact_dir) if needs_limit_file(limit) else None
+        try:
+            return await _async_run_runner_command(
+                build_runner_command(private_data_dir, playbook, vault_password_file, limit, tags, extra_vars, artifact_dir, limit_file),
+                event_handler,
+                timer,
+                envvars,
+            )
+        finally:
+            if limit_file is not None:
+                await loop.run_in_executor(None, _remove_limit_file, limit_file)
+
+
+async def _async_run_runner_command(
+    command: List[str], event_handler: Callable[[dict], None] | None, timer: RunTimer, envvars: Dict[str, str] | None
+) -> Tuple[str, dict | None]:
+    with span("ansible_playbook_runner._async_run_runner_command"):
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            limit=SUBPROCESS_LINE_LIMIT,
+            env={**os.environ, **envvars} if envvars else None,
+            start_new_session=True,
+        )
+        timer.spawned()
+        stats = None
+        try:
+            async for line in process.stdout:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                if not isinstance(event, dict):
+                    continue
+                timer.handle_event(event)
+                if event_handler is not None:
+                    event_handler(event)
+                if event.get("event") == "playbook_on_stats":
+                    event_data = event.get("event_data", {})
+                    stats = {key: event_data.get(key) or {} for key in STATS_KEYS}
+            return_code = await process.wait()
+        except asyncio.CancelledError:
+            await _terminate_process_group(process)
+            raise
+        timer.finished()
+        status = "successful" if return_code == 0 else "failed"
+        return status, stats
+
+
+async def _terminate_process_group(process: asyncio.subprocess.Process) -> None:
+    """SIGTERM to the process, SIGKILL to its process group if it doesn't exit within STOP_GRACE_PERIOD."""
+    with span("ansible_playbook_runner._terminate_process_group", pid=process.pid) as trace:
+        try:
+            process.terminate()
+            try:
+                await asyncio.wait_for(process.wait(), STOP_GRACE_PERIOD)
+                return
+            except asyncio.TimeoutError:
+                trace.event("still running after %s seconds, killing it", STOP_GRACE_PERIOD)
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
+
+def execute_playbook(
+    private_data_dir: str,
+    playbook: str,
+    vault_password_file: str | None,
+    event_handler: Callable[[dict], bool] = None,
+    limit: List[str] | None = None,
+    envvars: Dict[str, str] | None = None,
+    cancel_callback: Callable[[], bool] = None,
+    tags: List[str] | None = None,
+    extra_vars: dict | None = None,
+    vault_password: str | None = None,
+    artifact_dir: str | None = None,
+) -> "Runner":
+    """
+    Runs the playbook with ansible-runner and blocks until it is over. The final status and the stats are those
+    of the returned runner ("Runner.status", "Runner.stats"); nothing is kept in module state, so concurrent runs
+    in the same process don't see each other's status.
+
+    With "vault_password", ansible asks for the vault password and ansible-runner answers with it, instead of ansible
+    reading "vault_password_file"; the password is neither on the command line nor in a file. The artifacts of
+    the run go to "artifact_dir" (the "artifacts" directory of the private data dir by default).
+    """
+    import ansible_runner
+
+    if vault_password is not None:
+        cmdline = "--ask-vault-pass"
+        passwords = {VAULT_PASSWORD_PROMPT: vault_password}
+    else:
+        # ansible-runner splits the cmdline like a shell would
+        cmdline = "--vault-password-file " + shlex.quote(vault_password_file) if vault_password_file is not None else None
+        passwords = None
+    limit_file = write_limit_file(private_data_dir, limit, artifact_dir)
+    if limit_file is not None:
+        limit_argument = "@" + limit_file
+    else:
+        limit_argument = ",".join(limit) if limit is not None else None
+    _LOGGER.debug("%s - Starting ansible_runner.run_async", threading.current_thread().name)
+    try:
+        (thread, runner) = ansible_runner.run_async(
+            private_data_dir=private_data_dir,
+            playbook=playbook,
+            event_handler=event_handler,
+            cmdline=cmdline,
+            passwords=passwords,
+            limit=limit_argument,
+            tags=",".join(tags) if tags is not None else None,
+            extravars=extra_vars,
+            envvars=envvars,
+            artifact_dir=artifact_dir,
+            cancel_callback=cancel_callback,
+            quiet=True,
+        )
+        thread.join()
+    finally:
+        _remove_limit_file(limit_file)
+    _LOGGER.debug("%s - Finished ansible_runner.run_async, status %s", threading.current_thread().name, runner.status)
     return runner
 
 
+class PlaybookRunner:
+    """
+    Executes playbooks for the execution backends, with ansible-runner: "execute" in the worker process of the fork
+    and pool backends, "async_execute" on the event loop for the subprocess backend. Other runners, like the fake
+    runner of the tests (see tests/fake_runner.py), override both. The pool backend pickles the runner to its workers.
+    """
+    def preload(self) -> None:
+        """
+        Imports ansible_runner, which takes a while. Workers call it before their first run, the fork backend before
+        forking, so the forked processes inherit it. Importing the component doesn't import ansible_runner.
+        Blocks, don't call it on the event loop.
+        """
+        with span("PlaybookRunner.preload"):
+            import ansible_runner  # noqa: F401
+
+    def execute(
+        self,
+        private_data_dir: str,
+        playbook: str,
+        vault_password_file: str | None,
+        event_handler: Callable[[dict], bool] = None,
+        limit: List[str] | None = None,
+        envvars: Dict[str, str] | None = None,
+        cancel_callback: Callable[[], bool] = None,
+        tags: List[str] | None = None,
+        extra_vars: dict | None = None,
+        vault_password: str | None = None,
+        artifact_dir: str | None = None,
+    ) -> "Runner":
+        """Like "execute_playbook": blocks until the run is over, the result has the final "status" and the "stats"."""
+        return execute_playbook(
+            private_data_dir=private_data_dir,
+            playbook=playbook,
+            vault_password_file=vault_password_file,
+            event_handler=event_handler,
+            limit=limit,
+            envvars=envvars,
+            cancel_callback=cancel_callback,
+            tags=tags,
+            extra_vars=extra_vars,
+            vault_password=vault_password,
+            artifact_dir=artifact_dir,
+        )
+
+    async def async_execute(
+        self,
+        private_data_dir: str,
+        playbook: str,
+        vault_password_file: str | None,
+        event_handler: Callable[[dict], None] = None,
+        timer: RunTimer = None,
+        limit: List[str] | None = None,
+        envvars: Dict[str, str] | None = None,
+        tags: List[str] | None = None,
+        extra_vars: dict | None = None,
+        artifact_dir: str | None = None,
+    ) -> Tuple[str, dict | None]:
+        """Like "async_execute_playbook": returns the final status and the stats, cancelling it stops the run."""
+        return await async_execute_playbook(
+            private_data_dir=private_data_dir,
+            playbook=playbook,
+            vault_password_file=vault_password_file,
+            event_handler=event_handler,
+            timer=timer,
+            limit=limit,
+            envvars=envvars,
+            tags=tags,
+            extra_vars=extra_vars,
+            artifact_dir=artifact_dir,
+        )
+
+
 if __name__ == "__main__":
     execute_playbook(
         "./custom_components/ansible_playbook/test",
@@ -0,0 +1,97 @@
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from .trace import span
+
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_ARTIFACT_RETENTION = 10
+# ansible-runner writes this file of a run when the run is over, the artifacts of runs without it are in use
+ARTIFACT_STATUS_FILE = "status"
+# The artifacts of a run which never finished (Home Assistant was killed) are removed after this many seconds
+STALE_ARTIFACT_AGE = 24 * 3600
+
+
+class AnsibleArtifacts:
+    """
+    The artifacts ansible-runner writes for every run (job events, stdout, status), in a directory per playbook: in
+    "artifacts/<playbook id>" of the private data dir, or in "<root>/<playbook id>" if there is a root, e.g. on a tmpfs.
+
+    Only the artifacts of the latest "retention" finished runs of a playbook are kept, "prune" removes the others and
+    measures the disk usage of the artifacts of the playbook.
+    """
+    def __init__(self, root: str | None = None, retention: int = DEFAULT_ARTIFACT_RETENTION):
+        self._root = root
+        self._retention = retention
+        self._lock = threading.Lock()
+        # playbook id -> bytes used by its artifacts, as of the last prune
+        self._usage: Dict[str, int] = {}
+
+    def directory(self, private_data_dir: str, playbook_id: str) -> str:
+        """The artifact dir of the runs of the playbook, ansible-runner adds a directory per run."""
+        root = self._root if self._root is not None else os.path.join(private_data_dir, "artifacts")
+        return os.path.join(root, playbook_id)
+
+    def usage(self, playbook_id: str) -> int | None:
+        """The bytes used by the artifacts of the playbook after the last prune, None before the first one."""
+        with self._lock:
+            return self._usage.get(playbook_id)
+
+    def prune(self, private_data_dir: str, playbook_id: str) -> int:
+        """
+        Removes the artifacts of all but the latest "retention" finished runs of the playbook, and those of runs which
+        never finished, and returns the bytes used by the remaining ones. Blocks on file I/O, must not be called on
+        the event loop.
+        """
+        with span("AnsibleArtifacts.prune", playbook_id=playbook_id) as trace:
+            directory = self.directory(private_data_dir, playbook_id)
+            finished, stale = _list_runs(directory)
+            # Latest first
+            finished.sort(reverse=True)
+            for _, path in finished[self._retention:] + stale:
+                shutil.rmtree(path, ignore_errors=True)
+            removed = len(finished[self._retention:]) + len(stale)
+            usage = _disk_usage(directory)
+            trace.event("removed %s runs, %s bytes left", removed, usage)
+            with self._lock:
+                self._usage[playbook_id] = usage
+            return usage
+
+
+def _list_runs(directory: str) -> Tuple[List[Tuple[float, str]], List[Tuple[float, str]]]:
+    """The finished runs (mtime of their status file, path) and the stale unfinished runs in the artifact dir."""
+    finished = []
+    stale = []
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return finished, stale
+    stale_before = time.time() - STALE_ARTIFACT_AGE
+    for entry in entries:
+        if not entry.is_dir(follow_symlinks=False):
+            continue
+        try:
+            finished.append((os.stat(os.path.join(entry.path, ARTIFACT_STATUS_FILE)).st_mtime, entry.path))
+        except FileNotFoundError:
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime < stale_before:
+                    stale.append((0.0, entry.path))
+            except FileNotFoundError:
+                pass
+    return finished, stale
+
+
+def _disk_usage(directory: str) -> int:
+    usage = 0
+    for path, _, file_names in os.walk(directory):
+        for file_name in file_names:
+            try:
+                usage += os.lstat(os.path.join(path, file_name)).st_size
+            except FileNotFoundError:
+                pass
+    return usage
@@ -1,9 +1,47 @@
+import functools
 import logging
 import os
+import time
 from datetime import timedelta
+from typing import Dict, List, NamedTuple
 
-from .sensor import AnsiblePlaybookSensorEntity
-from .process_manager import run_task
+from .sensor import (
+    AnsiblePlaybookSensorEntity,
+    AnsiblePlaybookHostExecutionResultSensorEntity,
+    AnsiblePlaybookMetricsSensorEntity,
+    host_result_signal,
+)
+from .metrics import metrics, PHASE_PRESS_TO_START
+from .trace import span
+from .result_store import AnsiblePlaybookResultStore
+from .shared_services import AnsiblePlaybookServices
+from .result_cache import AnsiblePlaybookFingerprinter, AnsiblePlaybookResultCache
+from .playbook_group import GROUP_PLAYBOOK_DIRECTORY, group_playbook_file, write_group_playbook
+from .playbook_paths import AnsiblePlaybookPaths, InvalidPlaybookPathsError, resolve_playbook_paths
+from .vault_secrets import AnsibleVaultSecrets
+from .shards import AnsibleShardPlanner, SHARDS_AUTO
+from .artifacts import AnsibleArtifacts, DEFAULT_ARTIFACT_RETENTION
+from .schedules import (
+    AnsiblePlaybookSchedule,
+    AnsiblePlaybookScheduleTimer,
+    CronExpression,
+    DEFAULT_SCHEDULE_JITTER,
+    DEFAULT_MAX_SCHEDULED_RUNS_PER_MINUTE,
+)
+from .history import AnsiblePlaybookHistory, AnsiblePlaybookRunRecord, DEFAULT_HISTORY_MAX_RUNS, DEFAULT_HISTORY_MAX_AGE_DAYS
+from .process_manager import (
+    AnsibleProcessManager,
+    AnsibleTaskState,
+    AnsiblePlaybookRunResult,
+    same_limits,
+    DEFAULT_MAX_CONCURRENT_RUNS,
+    TRIGGER_MODES,
+    TRIGGER_DROP,
+    DEFAULT_DEBOUNCE,
+)
+from .worker_pool import DEFAULT_WORKER_MAX_RUNS, DEFAULT_WORKER_MAX_MEMORY_MB
+from .runtime_directories import AnsibleRuntimeDirectories, DEFAULT_FACT_CACHE_TTL, DEFAULT_CONTROL_PERSIST
+from .ansible_playbook_runner import BACKENDS, BACKEND_FORK
 import homeassistant.helpers.config_validation as cv
 import homeassistant.helpers.dispatcher as dispatcher
 import voluptuous as vol
@@ -14,10 +52,14 @@ from homeassistant.const import (
     CONF_PORT,
     CONF_USERNAME,
     CONF_PASSWORD,
+    CONF_TIMEOUT,
     EVENT_HOMEASSISTANT_START,
+    EVENT_HOMEASSISTANT_STOP,
 )
 from homeassistant import core
+from homeassistant.exceptions import HomeAssistantError
 from homeassistant.core import HomeAssistant
+from homeassistant.util import dt as dt_util
 from .const import DOMAIN as CONST_DOMAIN
 from .const import (
     CONF_PLAYBOOKS,
@@ -27,6 +69,50 @@ from .const import (
     CONF_BUTTON_ID,
     CONF_VAULT_PASSWORD_FILE,
     CONF_EXTRA_VARS,
+    CONF_PRIORITY,
+    CONF_MAX_CONCURRENT_RUNS,
+    CONF_MAX_RUNS_PER_INVENTORY,
+    CONF_EXECUTION_BACKEND,
+    CONF_WORKER_MAX_RUNS,
+    CONF_WORKER_MAX_MEMORY_MB,
+    CONF_HISTORY_MAX_RUNS,
+    CONF_HISTORY_MAX_AGE_DAYS,
+    HISTORY_DATABASE,
+    SIGNAL_HISTORY_LOADED,
+    CONF_METRICS_FILE,
+    SIGNAL_METRICS_UPDATED,
+    CONF_SKIP_IF_UNCHANGED,
+    CONF_TRIGGER_MODE,
+    CONF_DEBOUNCE,
+    CONF_PLAYBOOK_GROUPS,
+    CONF_GROUP_ID,
+    CONF_GROUP_NAME,
+    CONF_MEMBERS,
+    CONF_FACT_CACHE_TTL,
+    CONF_CONTROL_PERSIST,
+    CONF_SHARDS,
+    CONF_ARTIFACT_DIRECTORY,
+    CONF_ARTIFACT_RETENTION,
+    CONF_SCHEDULE,
+    CONF_INTERVAL,
+    CONF_CRON,
+    CONF_JITTER,
+    CONF_MIN_INTERVAL,
+    CONF_MAX_SCHEDULED_RUNS_PER_MINUTE,
+    RUNTIME_DIRECTORY,
+    SERVICE_RUN_GROUP,
+    SERVICE_STOP,
+    SERVICE_PLAY,
+    DEFAULT_LIMIT,
+    DEFAULT_TAGS,
+    ATTR_LIMIT,
+    ATTR_TAGS,
+    DATA_PLAYBOOK_GROUPS,
+    DATA_BUTTONS,
+    DATA_SERVICES,
+    DATA_SHARED_SETTINGS,
+    ATTR_GROUP_ID,
+    ATTR_BUTTON_ID,
     ATTR_OK_COUNT,
     ATTR_FAILURE_COUNT,
     ATTR_CHANGED_COUNT,
@@ -41,6 +127,45 @@ DOMAIN = CONST_DOMAIN
 
 DEFAULT_NAME = "Ansible Playbook Button"
 
+# The settings of a platform which apply to all platforms of the integration: the first platform sets up the process
+# manager, the history, the artifacts and so on (see AnsiblePlaybookServices) with them
+SHARED_SETTINGS = (
+    CONF_MAX_CONCURRENT_RUNS,
+    CONF_MAX_RUNS_PER_INVENTORY,
+    CONF_EXECUTION_BACKEND,
+    CONF_WORKER_MAX_RUNS,
+    CONF_WORKER_MAX_MEMORY_MB,
+    CONF_FACT_CACHE_TTL,
+    CONF_CONTROL_PERSIST,
+    CONF_HISTORY_MAX_RUNS,
+    CONF_HISTORY_MAX_AGE_DAYS,
+    CONF_MAX_SCHEDULED_RUNS_PER_MINUTE,
+    CONF_ARTIFACT_DIRECTORY,
+    CONF_ARTIFACT_RETENTION,
+    CONF_METRICS_FILE,
+)
+
+
+def cron_expression(value) -> CronExpression:
+    """Validates a cron expression, into the parsed expression."""
+    try:
+        return CronExpression.parse(cv.string(value))
+    except ValueError as error:
+        raise vol.Invalid(str(error)) from error
+
+
+SCHEDULE_SCHEMA = vol.All(
+    vol.Schema(
+        {
+            vol.Exclusive(CONF_INTERVAL, CONF_SCHEDULE): vol.All(cv.positive_time_period, vol.Range(min=timedelta(seconds=1))),
+            vol.Exclusive(CONF_CRON, CONF_SCHEDULE): cron_expression,
+            vol.Optional(CONF_JITTER, default=timedelta(seconds=DEFAULT_SCHEDULE_JITTER)): cv.positive_time_period,
+            vol.Optional(CONF_MIN_INTERVAL, default=timedelta(0)): cv.positive_time_period,
+        }
+    ),
+    cv.has_at_least_one_key(CONF_INTERVAL, CONF_CRON),
+)
+
 PLAYBOOK_SCHEMA = vol.Schema(
     {
         vol.Required(CONF_PLAYBOOK_DIRECTORY): str,
@@ -49,6 +174,38 @@ PLAYBOOK_SCHEMA = vol.Schema(
         vol.Required(CONF_BUTTON_NAME): str,
         vol.Optional(CONF_EXTRA_VARS): dict,
         vol.Optional(CONF_VAULT_PASSWORD_FILE): str,
+        vol.Optional(CONF_PRIORITY, default=0): int,
+        vol.Optional(CONF_SKIP_IF_UNCHANGED): cv.positive_time_period,
+        vol.Optional(CONF_TRIGGER_MODE, default=TRIGGER_DROP): vol.In(TRIGGER_MODES),
+        vol.Optional(CONF_DEBOUNCE, default=timedelta(seconds=DEFAULT_DEBOUNCE)): cv.positive_time_period,
+        vol.Optional(CONF_TIMEOUT): cv.positive_time_period,
+        vol.Optional(CONF_SHARDS): vol.Any(SHARDS_AUTO, vol.All(int, vol.Range(min=1))),
+        vol.Optional(CONF_SCHEDULE): SCHEDULE_SCHEMA,
+    }
+)
+
+PLAYBOOK_GROUP_SCHEMA = vol.Schema(
+    {
+        vol.Required(CONF_GROUP_ID): str,
+        vol.Required(CONF_GROUP_NAME): str,
+        vol.Required(CONF_MEMBERS): vol.All([str], vol.Length(min=1)),
+        vol.Optional(CONF_PRIORITY, default=0): int,
+        vol.Optional(CONF_SKIP_IF_UNCHANGED): cv.positive_time_period,
+        vol.Optional(CONF_TRIGGER_MODE, default=TRIGGER_DROP): vol.In(TRIGGER_MODES),
+        vol.Optional(CONF_DEBOUNCE, default=timedelta(seconds=DEFAULT_DEBOUNCE)): cv.positive_time_period,
+        vol.Optional(CONF_TIMEOUT): cv.positive_time_period,
+        vol.Optional(CONF_SCHEDULE): SCHEDULE_SCHEMA,
+    }
+)
+
+RUN_GROUP_SCHEMA = vol.Schema({vol.Required(ATTR_GROUP_ID): str})
+STOP_SCHEMA = vol.Schema({vol.Required(ATTR_BUTTON_ID): str})
+PLAY_SCHEMA = vol.Schema(
+    {
+        vol.Required(ATTR_BUTTON_ID): str,
+        vol.Optional(ATTR_LIMIT, default=DEFAULT_LIMIT): vol.All(cv.ensure_list_csv, [str]),
+        vol.Optional(ATTR_TAGS, default=DEFAULT_TAGS): vol.All(cv.ensure_list_csv, [str]),
+        vol.Optional(CONF_EXTRA_VARS): dict,
     }
 )
 
@@ -57,13 +214,61 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
         vol.Required(CONF_PLAYBOOKS): vol.All(
             [PLAYBOOK_SCHEMA], vol.Length(min=1)
         ),
+        vol.Optional(CONF_PLAYBOOK_GROUPS, default=[]): [PLAYBOOK_GROUP_SCHEMA],
+        vol.Optional(CONF_MAX_CONCURRENT_RUNS, default=DEFAULT_MAX_CONCURRENT_RUNS): vol.All(int, vol.Range(min=1)),
+        vol.Optional(CONF_MAX_RUNS_PER_INVENTORY): vol.All(int, vol.Range(min=1)),
+        vol.Optional(CONF_EXECUTION_BACKEND, default=BACKEND_FORK): vol.In(BACKENDS),
+        vol.Optional(CONF_WORKER_MAX_RUNS, default=DEFAULT_WORKER_MAX_RUNS): vol.All(int, vol.Range(min=1)),
+        vol.Optional(CONF_WORKER_MAX_MEMORY_MB, default=DEFAULT_WORKER_MAX_MEMORY_MB): vol.All(int, vol.Range(min=1)),
+        vol.Optional(CONF_HISTORY_MAX_RUNS, default=DEFAULT_HISTORY_MAX_RUNS): vol.All(int, vol.Range(min=1)),
+        vol.Optional(CONF_HISTORY_MAX_AGE_DAYS, default=DEFAULT_HISTORY_MAX_AGE_DAYS): vol.All(int, vol.Range(min=1)),
+        vol.Optional(CONF_METRICS_FILE): str,
+        vol.Optional(CONF_ARTIFACT_DIRECTORY): str,
+        vol.Optional(CONF_ARTIFACT_RETENTION, default=DEFAULT_ARTIFACT_RETENTION): vol.All(int, vol.Range(min=1)),
+        vol.Optional(CONF_MAX_SCHEDULED_RUNS_PER_MINUTE, default=DEFAULT_MAX_SCHEDULED_RUNS_PER_MINUTE): vol.All(int, vol.Range(min=1)),
+        vol.Optional(CONF_FACT_CACHE_TTL, default=timedelta(seconds=DEFAULT_FACT_CACHE_TTL)): cv.positive_time_period,
+        vol.Optional(CONF_CONTROL_PERSIST, default=timedelta(seconds=DEFAULT_CONTROL_PERSIST)): cv.positive_time_period,
     }
 )
 
 
+class AnsiblePlaybookRunPreparation(NamedTuple):
+    """What "AnsiblePlaybookButton._prepare_run" found out about a run in the executor."""
+    paths: AnsiblePlaybookPaths
+    # None to leave the vault password file to ansible
+    vault_password: str | None = None
+    # The fingerprint of the inputs of a run which may be skipped
+    fingerprint: str | None = None
+    # The result of the last run with the same fingerprint, the run is skipped if there is one
+    cached_result: AnsiblePlaybookRunResult | None = None
+    # The hosts of the shards of a sharded run
+    shards: List[List[str]] | None = None
+    # The path of the playbook written for a playbook group
+    group_playbook: str | None = None
+
+
 class AnsiblePlaybookButton(ButtonEntity):
-    def __init__(self, hass, name: str, button_id: str, private_data_dir: str, playbook_file: str, extra_vars: dict, vault_password_file: str, unique_id: str):
-        _LOGGER.debug("AnsiblePlaybookButton.__init__ enter")
+    def __init__(
+        self,
+        hass,
+        name: str,
+        button_id: str,
+        private_data_dir: str,
+        playbook_file: str,
+        extra_vars: dict,
+        vault_password_file: str,
+        unique_id: str,
+        services: AnsiblePlaybookServices,
+        priority: int = 0,
+        async_add_entities=None,
+        skip_if_unchanged: timedelta | None = None,
+        trigger_mode: str = TRIGGER_DROP,
+        debounce: timedelta = timedelta(seconds=DEFAULT_DEBOUNCE),
+        members: List["AnsiblePlaybookButton"] | None = None,
+        timeout: timedelta | None = None,
+        paths: AnsiblePlaybookPaths = None,
+        shards: int | str | None = None,
+    ):
         self._name = name if name is not None else DEFAULT_NAME
         self._private_data_dir = private_data_dir
         self._playbook_file = playbook_file
@@ -73,7 +278,20 @@ class AnsiblePlaybookButton(ButtonEntity):
         self.entity_id = ENTITY_ID_FORMAT.format(self._unique_id)
         self.hass = hass
         self._button_id = button_id
-        _LOGGER.debug("AnsiblePlaybookButton.__init__ exit")
+        # The process manager, history, caches and so on shared by all buttons
+        self._services = services
+        self._priority = priority
+        self._async_add_entities = async_add_entities
+        self._skip_if_unchanged = skip_if_unchanged
+        self._trigger_mode = trigger_mode
+        self._debounce = debounce
+        # The buttons of the member playbooks, if this button runs a playbook group
+        self._members = members
+        self._timeout = timeout
+        # Resolved at setup, resolved again by "_current_paths" once their directories changed
+        self._paths = paths
+        # The number of host shards (or "auto") the runs are split into, None to run them in one piece
+        self._shards = shards
 
     @property
     def name(self) -> str:
@@ -92,26 +310,215 @@ class AnsiblePlaybookButton(ButtonEntity):
         return self._button_id
 
     async def async_press(self, **kwargs) -> None:
-        _LOGGER.debug("AnsiblePlaybookButton.async_press enter")
-        await self.hass.async_add_executor_job(self._run_playbook)
-        _LOGGER.debug("AnsiblePlaybookButton.async_press exit")
-
-    def _run_playbook(self) -> None:
-        _LOGGER.debug("AnsiblePlaybookButton.run_playbook enter")
-        try:
-            _LOGGER.debug("AnsiblePlaybookButton.run_playbook attempting to call run_task")
-            run_task(
-                entity_id=self._unique_id,
-                base_dir=get_absolute_path(self.hass.config.path(), self._private_data_dir),
-                playbook_file=self._playbook_file,
-                vault_password_file=self._vault_password_file
+        with span("AnsiblePlaybookButton.async_press"):
+            pressed_at = time.monotonic()
+            await self._async_run_playbook()
+            metrics.observe(PHASE_PRESS_TO_START, time.monotonic() - pressed_at)
+
+    async def async_play(self, limit: List[str] | None = None, tags: List[str] | None = None, extra_vars: dict | None = None) -> None:
+        """
+        Runs the playbook limited to the hosts (or patterns) in "limit" and the tasks tagged with one of "tags", with
+        "extra_vars" on top of the configured ones. Runs with other parameters than a running one start right away.
+        """
+        with span("AnsiblePlaybookButton.async_play", limit=limit, tags=tags):
+            pressed_at = time.monotonic()
+            await self._async_run_playbook(limit, tags, extra_vars)
+            metrics.observe(PHASE_PRESS_TO_START, time.monotonic() - pressed_at)
+
+    async def async_stop(self) -> None:
+        """Stops the playbook runs, if any; queued runs are dropped."""
+        with span("AnsiblePlaybookButton.async_stop", entity_id=self._unique_id):
+            task_state = self._services.process_manager.stop_task(self._unique_id)
+            if task_state != AnsibleTaskState.NOT_RUNNING:
+                # Running runs report their end through "_handle_playbook_finished", dropped queued runs don't
+                for signal in self._executed_signals():
+                    dispatcher.async_dispatcher_send(self.hass, signal, self._services.process_manager.get_task_state(self._unique_id))
+
+    async def _async_run_playbook(self, limit: List[str] | None = None, tags: List[str] | None = None, extra_vars: dict | None = None) -> None:
+        with span("AnsiblePlaybookButton._async_run_playbook", entity_id=self._unique_id) as trace:
+            try:
+                if extra_vars:
+                    # The extra vars of the call win over the configured ones
+                    extra_vars = {**(self._extra_vars or {}), **extra_vars}
+                else:
+                    extra_vars = self._extra_vars
+                # Only a run which would start right away may be skipped
+                skippable = self._skip_if_unchanged is not None and self._services.process_manager.get_task_state(self._unique_id) == AnsibleTaskState.NOT_RUNNING
+                preparation = await self.hass.async_add_executor_job(self._prepare_run, limit, tags, extra_vars, skippable)
+                if preparation.cached_result is not None:
+                    trace.event("unchanged since the run finished at %s, skipping", preparation.cached_result.finished_at)
+                    self._handle_playbook_finished(self._unique_id, preparation.cached_result._replace(cached=True))
+                    for signal in self._executed_signals():
+                        dispatcher.async_dispatcher_send(self.hass, signal, AnsibleTaskState.NOT_RUNNING)
+                    return
+                self._services.process_manager.run_task(
+                    entity_id=self._unique_id,
+                    base_dir=preparation.paths.base_dir,
+                    playbook_file=preparation.group_playbook if preparation.group_playbook is not None else self._playbook_file,
+                    vault_password_file=preparation.paths.vault_password_file,
+                    on_finished=functools.partial(self._handle_run_finished, fingerprint=preparation.fingerprint, limit=limit),
+                    on_started=self._handle_playbook_started,
+                    priority=self._priority,
+                    on_progress=self._handle_playbook_progress,
+                    limit=limit,
+                    tags=tags,
+                    extra_vars=extra_vars,
+                    trigger_mode=self._trigger_mode,
+                    debounce=self._debounce.total_seconds(),
+                    members=[member.unique_id for member in self._members] if self._members is not None else None,
+                    timeout=self._timeout.total_seconds() if self._timeout is not None else None,
+                    vault_password=preparation.vault_password,
+                    shards=preparation.shards,
+                    artifact_dir=self._services.artifacts.directory(preparation.paths.base_dir, self._button_id),
+                )
+                # Other runs of the playbook may be running or queued, the sensor shows the state of all of them
+                task_state = self._services.process_manager.get_task_state(self._unique_id)
+                trace.event("sending %s_executed %s", self._button_id, task_state)
+                # The process of the run is started by the loop once this returns, so "_executed" always precedes "_finished".
+                for signal in self._executed_signals():
+                    dispatcher.async_dispatcher_send(self.hass, signal, task_state)
+            except InvalidPlaybookPathsError as error:
+                _LOGGER.error("Not running the ansible playbook %s: %s", self._unique_id, error)
+            except Exception:
+                _LOGGER.exception("Error while executing the ansible playbook %s", self._unique_id)
+
+    def _prepare_run(
+        self, limit: List[str] | None, tags: List[str] | None, extra_vars: dict | None, skippable: bool
+    ) -> AnsiblePlaybookRunPreparation:
+        """
+        Checks the paths of the playbook, writes the playbook of a group, fingerprints the inputs if the run may be
+        skipped, reads the vault password and splits the hosts into shards if the run is sharded.
+        Blocks on file I/O, runs in the executor.
+        """
+        with span("AnsiblePlaybookButton._prepare_run", entity_id=self._unique_id):
+            paths = self._current_paths()
+            group_playbook = self._write_group_playbook() if self._members is not None else None
+            fingerprint = None
+            if skippable:
+                fingerprint = self._services.fingerprinter.fingerprint(
+                    paths.base_dir, self._playbook_file, extra_vars, self._vault_password_file, limit, tags
+                )
+                cached_result = self._services.result_cache.get(fingerprint, self._skip_if_unchanged.total_seconds())
+                if cached_result is not None:
+                    return AnsiblePlaybookRunPreparation(paths, fingerprint=fingerprint, cached_result=cached_result)
+            vault_password = None
+            if paths.vault_password_file is not None:
+                vault_password = self._services.vault_secrets.get(paths.vault_password_file)
+            shards = None
+            if self._shards is not None:
+                shards = self._services.shard_planner.plan(paths.base_dir, self._shards, limit)
+            return AnsiblePlaybookRunPreparation(paths, vault_password, fingerprint, shards=shards, group_playbook=group_playbook)
+
+    def _write_group_playbook(self) -> str:
+        """Writes the playbook of a group importing the current playbooks of its members, returns its path. Runs in the executor."""
+        return write_group_playbook(
+            self.hass.config.path(RUNTIME_DIRECTORY, GROUP_PLAYBOOK_DIRECTORY),
+            self._button_id,
+            [member._current_paths().playbook_file for member in self._members],
+        )
+
+    def _current_paths(self) -> AnsiblePlaybookPaths:
+        """
+        The paths resolved at setup, as long as their directories didn't change; otherwise they are resolved and
+        checked again, which raises InvalidPlaybookPathsError if a file is gone. Blocks on file I/O, runs in the executor.
+        """
+        if self._paths is None or not self._paths.is_current():
+            self._paths = resolve_playbook_paths(
+                get_absolute_path(self.hass.config.path(), self._private_data_dir),
+                # The playbook of a group is written before every run
+                self._playbook_file if self._members is None else None,
+                self._vault_password_file,
             )
-            _LOGGER.debug("AnsiblePlaybookButton.run_playbook Sending " + self._button_id + "_executed" + " event")
-            dispatcher.async_dispatcher_send(self.hass, self._button_id + "_executed", None)
-            _LOGGER.debug("AnsiblePlaybookButton.run_playbook Sent " + self._button_id + "_executed" + " event")
-        except Exception as e:
-            _LOGGER.error("Error while executing the ansible playbook", e)
-        _LOGGER.debug("AnsiblePlaybookButton.run_playbook exit")
+        return self._paths
+
+    @core.callback
+    def _handle_playbook_started(self, entity_id: str) -> None:
+        """Called on the event loop by the process manager when a queued playbook run got started."""
+        for signal in self._executed_signals():
+            dispatcher.async_dispatcher_send(self.hass, signal, AnsibleTaskState.RUNNING)
+
+    def _executed_signals(self) -> List[str]:
+        """The signals telling the task state of a run, for a playbook group also those of its members."""
+        return [button._button_id + "_executed" for button in [self] + (self._members or [])]
+
+    @core.callback
+    def _handle_schedule_due(self) -> None:
+        """Called on the event loop by the schedule timer when a scheduled run of this button is due."""
+        self.hass.async_create_task(self.async_press())
+
+    @core.callback
+    def _handle_playbook_progress(self, entity_id: str, progress: dict) -> None:
+        """Called on the event loop by the process manager while the playbook runs, throttled by the process manager."""
+        dispatcher.async_dispatcher_send(self.hass, self._button_id + "_progress", progress)
+
+    @core.callback
+    def _handle_run_finished(
+        self, entity_id: str, result: AnsiblePlaybookRunResult, fingerprint: str | None = None, limit: List[str] | None = None
+    ) -> None:
+        """
+        Called on the event loop by the process manager as soon as a run of this button is over. "fingerprint" and
+        "limit" are those of the request which started the run.
+        """
+        if fingerprint is not None and not same_limits(result.limit, limit):
+            # Coalesced with requests for other hosts, the result doesn't belong to the fingerprinted inputs
+            fingerprint = None
+        self._handle_playbook_finished(entity_id, result, fingerprint)
+        self.hass.async_create_task(self.async_prune_artifacts())
+
+    async def async_prune_artifacts(self) -> None:
+        """Removes the artifacts of older runs in the executor, the sensor then shows the size of the remaining ones."""
+        with span("AnsiblePlaybookButton.async_prune_artifacts", entity_id=self._unique_id):
+            try:
+                await self.hass.async_add_executor_job(self._services.artifacts.prune, self._paths.base_dir, self._button_id)
+            except Exception:
+                _LOGGER.exception("Error while pruning the artifacts of the ansible playbook %s", self._unique_id)
+                return
+            dispatcher.async_dispatcher_send(self.hass, self._button_id + "_artifacts")
+
+    @core.callback
+    def _handle_playbook_finished(self, entity_id: str, result: AnsiblePlaybookRunResult, fingerprint: str | None = None) -> None:
+        """
+        Called on the event loop by the process manager as soon as the playbook run is over, or with the cached
+        result when the run was skipped. "fingerprint" is the fingerprint of the inputs of a run which wasn't skipped.
+        """
+        if fingerprint is not None and result.status == "successful":
+            self._services.result_cache.put(fingerprint, result)
+        if not result.cached:
+            self._services.history.record(AnsiblePlaybookRunRecord.from_result(self._unique_id, self._playbook_file, result))
+        # Other runs of the playbook may still be running or queued
+        task_state = self._services.process_manager.get_task_state(self._unique_id)
+        dispatcher.async_dispatcher_send(self.hass, self._button_id + "_finished", result, task_state)
+        self._update_host_results(result)
+        if self._members is not None and result.members is not None:
+            for member in self._members:
+                member_result = result.members.get(member.unique_id)
+                if member_result is not None:
+                    member._handle_playbook_finished(member.unique_id, member_result._replace(cached=result.cached))
+        # The result handling of this run is measured once this callback returns
+        self.hass.loop.call_soon(self._publish_metrics)
+
+    @core.callback
+    def _publish_metrics(self) -> None:
+        dispatcher.async_dispatcher_send(self.hass, SIGNAL_METRICS_UPDATED)
+        if self._services.metrics_file is not None:
+            self.hass.async_add_executor_job(metrics.write_prometheus_file, self._services.metrics_file)
+
+    @core.callback
+    def _update_host_results(self, result: AnsiblePlaybookRunResult) -> None:
+        """Creates sensors for new hosts, and only writes the sensors of hosts whose results changed."""
+        new_hosts, changed_hosts = self._services.result_store.update(self._button_id, result.hosts)
+        if new_hosts and self._async_add_entities is not None:
+            self._async_add_entities([
+                AnsiblePlaybookHostExecutionResultSensorEntity(
+                    name=self._name + " " + host,
+                    button_id=self._button_id,
+                    host=host,
+                    result_store=self._services.result_store,
+                )
+                for host in new_hosts
+            ])
+        for host in changed_hosts:
+            dispatcher.async_dispatcher_send(self.hass, host_result_signal(self._button_id, host))
 
 
 # Home Assistant will call this method automatically when setting up the platform.
@@ -119,72 +526,286 @@ class AnsiblePlaybookButton(ButtonEntity):
 async def async_setup_platform(hass: core.HomeAssistant, config, async_add_entities, discovery_info=None):
     """Set up the Ansible playbook button platform."""
 
-    _LOGGER.debug("button.async_setup_platform enter")
-
-    # Validate the configuration for the platform
-    if not config.get(CONF_PLAYBOOKS):
-        _LOGGER.error("Missing required variable: playbooks")
-        return False
-
-    # Get the list of Ansible playbooks
-    playbooks = config.get(CONF_PLAYBOOKS)
-
-    # Create a list to store the button entities
-    entities = []
-
-    # Loop through the list of playbooks and create a button entity for each one
-    for playbook in playbooks:
-        button_name = playbook.get(CONF_BUTTON_NAME)
-        button_id = playbook.get(CONF_BUTTON_ID)
-        playbook_directory = playbook.get(CONF_PLAYBOOK_DIRECTORY)
-        playbook_file = playbook.get(CONF_PLAYBOOK_FILE)
-        extra_vars = playbook.get(CONF_EXTRA_VARS)
-        vault_password_file = playbook.get(CONF_VAULT_PASSWORD_FILE)
-
-        button_unique_id = "ansible_playbook_" + button_id
-        sensor_unique_id = "ansible_playbook_" + button_id + "_button_sensor"
-
-        # Create a button entity for the playbook
-        button = AnsiblePlaybookButton(
-            hass=hass,
-            name=button_name,
-            button_id=button_id,
-            private_data_dir=playbook_directory,
-            playbook_file=playbook_file,
-            extra_vars=extra_vars,
-            vault_password_file=vault_password_file,
-            unique_id=button_unique_id
+    with span("button.async_setup_platform"):
+
+        # Validate the configuration for the platform
+        if not config.get(CONF_PLAYBOOKS):
+            _LOGGER.error("Missing required variable: playbooks")
+            return False
+
+        # Create a list to store the button entities
+        entities = []
+
+        # One process manager, history, schedule timer and so on for all platforms of the integration
+        domain_data = hass.data.setdefault(DOMAIN, {})
+        if DATA_SERVICES not in domain_data:
+            async_setup_services(hass, config)
+            entities.append(AnsiblePlaybookMetricsSensorEntity())
+        else:
+            conflicting = [key for key in SHARED_SETTINGS if config.get(key) != domain_data[DATA_SHARED_SETTINGS][key]]
+            if conflicting:
+                _LOGGER.warning(
+                    "All ansible_playbook platforms share the settings of the first one, ignoring %s of this one",
+                    ", ".join(conflicting),
+                )
+        services: AnsiblePlaybookServices = domain_data[DATA_SERVICES]
+
+        # Get the list of Ansible playbooks
+        playbooks = config.get(CONF_PLAYBOOKS)
+
+        # Resolve and check the paths of all playbooks once, off the event loop, instead of failing their runs later
+        playbook_paths = await hass.async_add_executor_job(resolve_all_playbook_paths, hass.config.path(), playbooks)
+
+        # The buttons of this platform by button id, to look up the members of the playbook groups
+        buttons = {}
+        # The schedules of the buttons of this platform by button id, started once the buttons are added
+        schedules = {}
+        all_buttons = hass.data.setdefault(DOMAIN, {}).setdefault(DATA_BUTTONS, {})
+
+        # Loop through the list of playbooks and create a button entity for each one
+        for playbook in playbooks:
+            button_name = playbook.get(CONF_BUTTON_NAME)
+            button_id = playbook.get(CONF_BUTTON_ID)
+            playbook_directory = playbook.get(CONF_PLAYBOOK_DIRECTORY)
+            playbook_file = playbook.get(CONF_PLAYBOOK_FILE)
+            extra_vars = playbook.get(CONF_EXTRA_VARS)
+            vault_password_file = playbook.get(CONF_VAULT_PASSWORD_FILE)
+            if button_id not in playbook_paths:
+                continue
+
+            button_unique_id = "ansible_playbook_" + button_id
+            sensor_unique_id = "ansible_playbook_" + button_id + "_button_sensor"
+
+            # Create a button entity for the playbook
+            button = AnsiblePlaybookButton(
+                hass=hass,
+                name=button_name,
+                button_id=button_id,
+                private_data_dir=playbook_directory,
+                playbook_file=playbook_file,
+                extra_vars=extra_vars,
+                vault_password_file=vault_password_file,
+                unique_id=button_unique_id,
+                services=services,
+                priority=playbook.get(CONF_PRIORITY),
+                async_add_entities=async_add_entities,
+                skip_if_unchanged=playbook.get(CONF_SKIP_IF_UNCHANGED),
+                trigger_mode=playbook.get(CONF_TRIGGER_MODE),
+                debounce=playbook.get(CONF_DEBOUNCE),
+                timeout=playbook.get(CONF_TIMEOUT),
+                paths=playbook_paths[button_id],
+                shards=playbook.get(CONF_SHARDS),
+            )
+            entities.append(button)
+            buttons[button_id] = button
+            if playbook.get(CONF_SCHEDULE) is not None:
+                schedules[button_id] = playbook_schedule(playbook.get(CONF_SCHEDULE))
+
+            sensor = AnsiblePlaybookSensorEntity(
+                name=button_name + " Sensor",
+                button_unique_id=button_unique_id,
+                unique_id=sensor_unique_id,
+                button_id=button_id,
+                services=services,
+            )
+            entities.append(sensor)
+
+        # A playbook group runs its member playbooks in a single ansible-runner invocation
+        group_buttons = hass.data.setdefault(DOMAIN, {}).setdefault(DATA_PLAYBOOK_GROUPS, {})
+        for group in config.get(CONF_PLAYBOOK_GROUPS):
+            group_id = group.get(CONF_GROUP_ID)
+            unknown_members = [member for member in group.get(CONF_MEMBERS) if member not in buttons]
+            if unknown_members:
+                _LOGGER.error("Playbook group %s: unknown or invalid members %s", group_id, ", ".join(unknown_members))
+                continue
+            members = [buttons[member] for member in group.get(CONF_MEMBERS)]
+            if len({(member._private_data_dir, member._vault_password_file) for member in members}) > 1:
+                _LOGGER.error("Playbook group %s: the members must share their directory and vault password file", group_id)
+                continue
+
+            group_unique_id = "ansible_playbook_group_" + group_id
+            group_button = AnsiblePlaybookButton(
+                hass=hass,
+                name=group.get(CONF_GROUP_NAME),
+                button_id=group_id,
+                private_data_dir=members[0]._private_data_dir,
+                playbook_file=group_playbook_file(group_id),
+                extra_vars=None,
+                vault_password_file=members[0]._vault_password_file,
+                unique_id=group_unique_id,
+                services=services,
+                priority=group.get(CONF_PRIORITY),
+                async_add_entities=async_add_entities,
+                skip_if_unchanged=group.get(CONF_SKIP_IF_UNCHANGED),
+                trigger_mode=group.get(CONF_TRIGGER_MODE),
+                debounce=group.get(CONF_DEBOUNCE),
+                members=members,
+                timeout=group.get(CONF_TIMEOUT),
+                paths=members[0]._paths._replace(playbook_file=None),
+            )
+            entities.append(group_button)
+            group_buttons[group_id] = group_button
+            if group.get(CONF_SCHEDULE) is not None:
+                schedules[group_id] = playbook_schedule(group.get(CONF_SCHEDULE))
+            all_buttons[group_id] = group_button
+            entities.append(AnsiblePlaybookSensorEntity(
+                name=group.get(CONF_GROUP_NAME) + " Sensor",
+                button_unique_id=group_unique_id,
+                unique_id=group_unique_id + "_button_sensor",
+                button_id=group_id,
+                services=services,
+            ))
+
+        async def _async_run_group(call: core.ServiceCall) -> None:
+            group_button = group_buttons.get(call.data[ATTR_GROUP_ID])
+            if group_button is None:
+                raise HomeAssistantError(f"Unknown playbook group {call.data[ATTR_GROUP_ID]}")
+            await group_button.async_press()
+
+        if not hass.services.has_service(DOMAIN, SERVICE_RUN_GROUP):
+            hass.services.async_register(DOMAIN, SERVICE_RUN_GROUP, _async_run_group, schema=RUN_GROUP_SCHEMA)
+
+        all_buttons.update(buttons)
+
+        async def _async_stop(call: core.ServiceCall) -> None:
+            button = all_buttons.get(call.data[ATTR_BUTTON_ID])
+            if button is None:
+                raise HomeAssistantError(f"Unknown playbook {call.data[ATTR_BUTTON_ID]}")
+            await button.async_stop()
+
+        if not hass.services.has_service(DOMAIN, SERVICE_STOP):
+            hass.services.async_register(DOMAIN, SERVICE_STOP, _async_stop, schema=STOP_SCHEMA)
+
+        async def _async_play(call: core.ServiceCall) -> None:
+            button = all_buttons.get(call.data[ATTR_BUTTON_ID])
+            if button is None:
+                raise HomeAssistantError(f"Unknown playbook {call.data[ATTR_BUTTON_ID]}")
+            limit = call.data[ATTR_LIMIT]
+            tags = call.data[ATTR_TAGS]
+            await button.async_play(
+                limit=None if DEFAULT_LIMIT in limit else limit,
+                tags=None if DEFAULT_TAGS in tags else tags,
+                extra_vars=call.data.get(CONF_EXTRA_VARS),
+            )
+
+        if not hass.services.has_service(DOMAIN, SERVICE_PLAY):
+            hass.services.async_register(DOMAIN, SERVICE_PLAY, _async_play, schema=PLAY_SCHEMA)
+
+
+        # Add the button entities to Home Assistant
+        async_add_entities(entities)
+
+        # The artifacts left by earlier runs are pruned in the background
+        for entity in entities:
+            if isinstance(entity, AnsiblePlaybookButton):
+                hass.async_create_task(entity.async_prune_artifacts())
+
+        for button_id, schedule in schedules.items():
+            services.schedule_timer.add(button_id, schedule, all_buttons[button_id]._handle_schedule_due)
+
+        # Return True to indicate that the platform was successfully set up
+        return True
+
+
+@core.callback
+def async_setup_services(hass: core.HomeAssistant, config) -> None:
+    """
+    Sets up the services shared by all platforms with the settings of the first platform (see SHARED_SETTINGS), and
+    stores them in hass.data[DOMAIN].
+    """
+    with span("button.async_setup_services"):
+        domain_data = hass.data[DOMAIN]
+        domain_data[DATA_SHARED_SETTINGS] = {key: config.get(key) for key in SHARED_SETTINGS}
+
+        process_manager = AnsibleProcessManager(hass.loop)
+        process_manager.configure(
+            config.get(CONF_MAX_CONCURRENT_RUNS),
+            config.get(CONF_MAX_RUNS_PER_INVENTORY),
+            config.get(CONF_EXECUTION_BACKEND),
+            config.get(CONF_WORKER_MAX_RUNS),
+            config.get(CONF_WORKER_MAX_MEMORY_MB),
+            AnsibleRuntimeDirectories(
+                root=hass.config.path(RUNTIME_DIRECTORY),
+                fact_cache_ttl=int(config.get(CONF_FACT_CACHE_TTL).total_seconds()),
+                control_persist=int(config.get(CONF_CONTROL_PERSIST).total_seconds()),
+            ),
         )
-        entities.append(button)
+        # Warm up the worker pool (if any) without delaying the setup
+        hass.async_create_task(process_manager.async_start_worker_pool())
 
-        sensor = AnsiblePlaybookSensorEntity(
-            name=button_name + " Sensor",
-            button_unique_id=button_unique_id,
-            unique_id=sensor_unique_id,
-            button_id=button_id
+        schedule_timer = AnsiblePlaybookScheduleTimer(hass.loop, time_zone=dt_util.DEFAULT_TIME_ZONE)
+        schedule_timer.configure(config.get(CONF_MAX_SCHEDULED_RUNS_PER_MINUTE))
+
+        history = AnsiblePlaybookHistory(
+            loop=hass.loop,
+            path=hass.config.path(HISTORY_DATABASE),
+            max_runs_per_entity=config.get(CONF_HISTORY_MAX_RUNS),
+            max_age_days=config.get(CONF_HISTORY_MAX_AGE_DAYS),
         )
-        entities.append(sensor)
-    _LOGGER.debug("button.async_setup_platform exit")
 
+        async def _async_load_history():
+            await history.async_load()
+            dispatcher.async_dispatcher_send(hass, SIGNAL_HISTORY_LOADED)
+
+        # Loading the history must not delay the setup either
+        hass.async_create_task(_async_load_history())
+
+        async def _async_shutdown(event):
+            schedule_timer.shutdown()
+            await process_manager.async_shutdown()
+            await history.async_close()
+
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, _async_shutdown)
+
+        domain_data[DATA_SERVICES] = AnsiblePlaybookServices(
+            process_manager=process_manager,
+            history=history,
+            schedule_timer=schedule_timer,
+            result_store=AnsiblePlaybookResultStore(),
+            fingerprinter=AnsiblePlaybookFingerprinter(),
+            result_cache=AnsiblePlaybookResultCache(),
+            vault_secrets=AnsibleVaultSecrets(),
+            artifacts=AnsibleArtifacts(
+                root=hass.config.path(config.get(CONF_ARTIFACT_DIRECTORY)) if config.get(CONF_ARTIFACT_DIRECTORY) is not None else None,
+                retention=config.get(CONF_ARTIFACT_RETENTION),
+            ),
+            shard_planner=AnsibleShardPlanner(config.get(CONF_MAX_CONCURRENT_RUNS)),
+            metrics_file=hass.config.path(config.get(CONF_METRICS_FILE)) if config.get(CONF_METRICS_FILE) is not None else None,
+        )
 
-    # Add the button entities to Home Assistant
-    async_add_entities(entities)
 
-    # Return True to indicate that the platform was successfully set up
-    return True
+def resolve_all_playbook_paths(hass_config_location: str, playbooks: List[dict]) -> Dict[str, AnsiblePlaybookPaths]:
+    """
+    The resolved paths of the configured playbooks by button id. Playbooks whose directory, playbook file or vault
+    password file doesn't exist are logged and left out. Blocks on file I/O, must not be called on the event loop.
+    """
+    with span("button.resolve_all_playbook_paths"):
+        paths = {}
+        for playbook in playbooks:
+            button_id = playbook.get(CONF_BUTTON_ID)
+            try:
+                paths[button_id] = resolve_playbook_paths(
+                    get_absolute_path(hass_config_location, playbook.get(CONF_PLAYBOOK_DIRECTORY)),
+                    playbook.get(CONF_PLAYBOOK_FILE),
+                    playbook.get(CONF_VAULT_PASSWORD_FILE),
+                )
+            except InvalidPlaybookPathsError as error:
+                _LOGGER.error("Playbook %s isn't set up: %s", button_id, error)
+        return paths
 
 
-def check_location_exists(hass, path: str):
-    _LOGGER.debug("button.check_location_exists enter")
-    hass_config_location = hass.config.path()
-    absolute_path = get_absolute_path(hass_config_location, path)
-    os_path_exists = os.path.exists(absolute_path)
-    _LOGGER.debug("button.check_location_exists enter")
-    return os_path_exists
+def playbook_schedule(config: dict) -> AnsiblePlaybookSchedule:
+    """The schedule of a playbook, from its validated "schedule" configuration."""
+    interval = config.get(CONF_INTERVAL)
+    return AnsiblePlaybookSchedule(
+        interval=interval.total_seconds() if interval is not None else None,
+        cron=config.get(CONF_CRON),
+        jitter=config.get(CONF_JITTER).total_seconds(),
+        min_interval=config.get(CONF_MIN_INTERVAL).total_seconds(),
+    )
 
 
 def get_absolute_path(hass_config_location: str, path: str) -> str:
-    _LOGGER.debug("button.get_absolute_path enter")
-    absolute_path = os.path.join(hass_config_location, DOMAIN, path)
-    _LOGGER.debug("button.get_absolute_path exit")
-    return absolute_path
+    with span("button.get_absolute_path"):
+        absolute_path = os.path.join(hass_config_location, DOMAIN, path)
+        return absolute_path
@@ -16,16 +16,76 @@ CONF_BUTTON_ID = "button_id"
 CONF_EXTRA_VARS = "extra_vars"
 CONF_PLAYBOOKS = "playbooks"
 CONF_VAULT_PASSWORD_FILE = "fault_password_file"
+CONF_PRIORITY = "priority"
+CONF_MAX_CONCURRENT_RUNS = "max_concurrent_runs"
+CONF_MAX_RUNS_PER_INVENTORY = "max_runs_per_inventory"
+CONF_EXECUTION_BACKEND = "execution_backend"
+CONF_WORKER_MAX_RUNS = "worker_max_runs"
+CONF_WORKER_MAX_MEMORY_MB = "worker_max_memory_mb"
+CONF_HISTORY_MAX_RUNS = "history_max_runs"
+CONF_HISTORY_MAX_AGE_DAYS = "history_max_age_days"
+CONF_METRICS_FILE = "metrics_file"
+CONF_SKIP_IF_UNCHANGED = "skip_if_unchanged"
+CONF_TRIGGER_MODE = "trigger_mode"
+CONF_DEBOUNCE = "debounce"
+CONF_PLAYBOOK_GROUPS = "playbook_groups"
+CONF_GROUP_ID = "group_id"
+CONF_GROUP_NAME = "group_name"
+CONF_MEMBERS = "members"
+CONF_FACT_CACHE_TTL = "fact_cache_ttl"
+CONF_CONTROL_PERSIST = "control_persist"
+CONF_SHARDS = "shards"
+CONF_ARTIFACT_DIRECTORY = "artifact_directory"
+CONF_ARTIFACT_RETENTION = "artifact_retention"
+CONF_SCHEDULE = "schedule"
+CONF_INTERVAL = "interval"
+CONF_CRON = "cron"
+CONF_JITTER = "jitter"
+CONF_MIN_INTERVAL = "min_interval"
+CONF_MAX_SCHEDULED_RUNS_PER_MINUTE = "max_scheduled_runs_per_minute"
 
 ATTR_OK_COUNT = "ok_count"
 ATTR_FAILURE_COUNT = "failure_count"
 ATTR_CHANGED_COUNT = "changed_count"
 ATTR_SKIPPED_COUNT = "skipped_count"
 ATTR_IGNORED_COUNT = "ignored_count"
+ATTR_DARK_COUNT = "dark_count"
+ATTR_RESCUED_COUNT = "rescued_count"
 ATTR_PLAYBOOK = "playbook"
+ATTR_HOST = "host"
+ATTR_HOSTS = "hosts"
+ATTR_LAST_DURATIONS = "last_durations"
+ATTR_SUCCESS_RATE = "success_rate"
+ATTR_CACHED = "cached"
+ATTR_GROUP_ID = "group_id"
+ATTR_FACT_GATHERING = "fact_gathering"
+ATTR_BUTTON_ID = "button_id"
+ATTR_STATUS = "status"
+ATTR_ARTIFACTS_SIZE = "artifacts_size"
+ATTR_NEXT_SCHEDULED_RUN = "next_scheduled_run"
+
+HISTORY_DATABASE = "ansible_playbook_history.db"
+# The fact cache and ssh control sockets, in the Home Assistant configuration directory
+RUNTIME_DIRECTORY = ".ansible_playbook"
+SIGNAL_HISTORY_LOADED = DOMAIN + "_history_loaded"
+SIGNAL_METRICS_UPDATED = DOMAIN + "_metrics_updated"
+SERVICE_RUN_GROUP = "run_group"
+# The group buttons of all platforms by group id, in hass.data[DOMAIN]
+DATA_PLAYBOOK_GROUPS = "playbook_groups"
+# All buttons of all platforms (playbook groups included) by button id, in hass.data[DOMAIN]
+DATA_BUTTONS = "buttons"
+# The AnsiblePlaybookServices shared by all platforms, in hass.data[DOMAIN]
+DATA_SERVICES = "services"
+# The integration wide settings of the platform which set up the shared parts, in hass.data[DOMAIN]
+DATA_SHARED_SETTINGS = "shared_settings"
 ATTR_TAGS = "tags"
 ATTR_LIMIT = "limit"
 ATTR_OPTIONS = "options"
+ATTR_TASK_STATE = "task_state"
+ATTR_CURRENT_TASK = "current_task"
+ATTR_HOSTS_DONE = "hosts_done"
+ATTR_HOSTS_TOTAL = "hosts_total"
+ATTR_PROGRESS = "progress"
 
 SERVICE_PLAY = "play"
 SERVICE_STOP = "stop"
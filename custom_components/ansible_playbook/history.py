@@ -0,0 +1,254 @@
+import asyncio
+import collections
+import functools
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Deque, Dict, List, NamedTuple, Tuple
+
+from .process_manager import AnsiblePlaybookRunResult
+from .trace import span
+
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_HISTORY_MAX_RUNS = 100
+DEFAULT_HISTORY_MAX_AGE_DAYS = 30
+# Runs finishing within this delay are written in a single transaction
+HISTORY_FLUSH_DELAY = 5.0
+# How many of the latest runs per entity are kept in memory for the sensors
+HISTORY_STATISTICS_RUNS = 10
+# Records which couldn't be written are retried with the next batch, the oldest are dropped beyond this many
+MAX_PENDING_RECORDS = 1000
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY,
+        entity_id TEXT NOT NULL,
+        playbook TEXT NOT NULL,
+        started_at REAL NOT NULL,
+        finished_at REAL NOT NULL,
+        duration REAL NOT NULL,
+        status TEXT,
+        host_stats TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS runs_entity_started_at ON runs (entity_id, started_at)",
+    "CREATE INDEX IF NOT EXISTS runs_started_at ON runs (started_at)",
+]
+
+
+class AnsiblePlaybookRunRecord(NamedTuple):
+    entity_id: str
+    playbook: str
+    started_at: float
+    finished_at: float
+    status: str | None
+    # host -> counters in the order of STATS_KEYS
+    host_stats: Dict[str, Tuple[int, ...]]
+
+    @property
+    def duration(self) -> float:
+        return self.finished_at - self.started_at
+
+    @classmethod
+    def from_result(cls, entity_id: str, playbook: str, result: AnsiblePlaybookRunResult) -> "AnsiblePlaybookRunRecord":
+        return cls(
+            entity_id=entity_id,
+            playbook=playbook,
+            started_at=result.started_at,
+            finished_at=result.finished_at,
+            status=result.status,
+            host_stats={host: tuple(host_result[1:]) for host, host_result in result.hosts.items()},
+        )
+
+
+class AnsiblePlaybookRunStatistics(NamedTuple):
+    durations: List[float]
+    success_rate: float | None
+
+
+class AnsiblePlaybookHistory:
+    """
+    An append-only history of all playbook runs, stored in SQLite (WAL mode).
+
+    "record" is cheap and called on the event loop: records are buffered and written in batches in the
+    executor, which also enforces the retention (runs per entity and age). A batch which can't be written (the
+    database is locked, the disk is full) is retried with the next one. The latest runs per entity are kept in
+    memory, so "statistics" never touches the database; "async_query" reads the runs of an entity in a time range.
+    """
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        path: str,
+        max_runs_per_entity: int = DEFAULT_HISTORY_MAX_RUNS,
+        max_age_days: int = DEFAULT_HISTORY_MAX_AGE_DAYS,
+    ):
+        self._loop = loop
+        self._path = path
+        self._max_runs_per_entity = max_runs_per_entity
+        self._max_age_seconds = max_age_days * 24 * 60 * 60
+        self._connection: sqlite3.Connection = None
+        self._connection_lock = threading.Lock()
+        self._pending: List[AnsiblePlaybookRunRecord] = []
+        self._flush_handle: asyncio.TimerHandle = None
+        self._latest: Dict[str, Deque[AnsiblePlaybookRunRecord]] = {}
+
+    async def async_load(self) -> None:
+        """Opens the database and loads the latest runs of every entity."""
+        with span("AnsiblePlaybookHistory.async_load"):
+            latest = await self._loop.run_in_executor(None, self._load_latest)
+            for record in latest:
+                self._remember(record, loaded=True)
+
+    async def async_close(self) -> None:
+        """Writes the pending records and closes the database."""
+        with span("AnsiblePlaybookHistory.async_close"):
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+                self._flush_handle = None
+            pending, self._pending = self._pending, []
+            await self._loop.run_in_executor(None, self._write_and_close, pending)
+
+    def record(self, record: AnsiblePlaybookRunRecord) -> None:
+        """Adds a finished run, must be called on the event loop."""
+        self._remember(record)
+        self._pending.append(record)
+        if self._flush_handle is None:
+            self._flush_handle = self._loop.call_later(HISTORY_FLUSH_DELAY, self._flush)
+
+    async def async_query(self, entity_id: str, since: float | None = None, until: float | None = None) -> List[AnsiblePlaybookRunRecord]:
+        """
+        The runs of the entity which started at or after "since" and before "until" (seconds since the epoch, both
+        optional), newest first. Includes the runs which aren't written yet.
+        """
+        with span("AnsiblePlaybookHistory.async_query", entity_id=entity_id):
+            since = since if since is not None else float("-inf")
+            until = until if until is not None else float("inf")
+            pending = [
+                record for record in self._pending
+                if record.entity_id == entity_id and since <= record.started_at < until
+            ]
+            records = await self._loop.run_in_executor(None, self._query, entity_id, since, until)
+            return sorted(pending + records, key=lambda record: record.started_at, reverse=True)
+
+    def statistics(self, entity_id: str) -> AnsiblePlaybookRunStatistics:
+        """The durations (latest first) and the success rate (in percent) of the latest runs of the entity."""
+        latest = self._latest.get(entity_id)
+        if not latest:
+            return AnsiblePlaybookRunStatistics(durations=[], success_rate=None)
+        durations = [round(record.duration, 1) for record in reversed(latest)]
+        successful = sum(1 for record in latest if record.status == "successful")
+        return AnsiblePlaybookRunStatistics(durations=durations, success_rate=round(100 * successful / len(latest), 1))
+
+    def _remember(self, record: AnsiblePlaybookRunRecord, loaded: bool = False) -> None:
+        latest = self._latest.get(record.entity_id)
+        if latest is None:
+            latest = self._latest[record.entity_id] = collections.deque(maxlen=HISTORY_STATISTICS_RUNS)
+        if loaded:
+            # Runs recorded before loading finished are newer than anything in the database
+            if len(latest) < HISTORY_STATISTICS_RUNS:
+                latest.appendleft(record)
+        else:
+            latest.append(record)
+
+    def _flush(self) -> None:
+        self._flush_handle = None
+        pending, self._pending = self._pending, []
+        if pending:
+            future = self._loop.run_in_executor(None, self._write, pending)
+            future.add_done_callback(functools.partial(self._handle_written, pending))
+
+    def _handle_written(self, records: List[AnsiblePlaybookRunRecord], future: asyncio.Future) -> None:
+        """Puts the records of a failed write back in front of the pending ones, they are written with the next batch."""
+        if future.cancelled() or future.exception() is None:
+            return
+        _LOGGER.error("Can't write %s runs to the history %s, retrying: %s", len(records), self._path, future.exception())
+        self._pending[:0] = records
+        del self._pending[:-MAX_PENDING_RECORDS]
+        if self._flush_handle is None:
+            self._flush_handle = self._loop.call_later(HISTORY_FLUSH_DELAY, self._flush)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self._path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            for statement in SCHEMA:
+                self._connection.execute(statement)
+            self._connection.commit()
+        return self._connection
+
+    def _load_latest(self) -> List[AnsiblePlaybookRunRecord]:
+        """Returns the latest runs of every entity, newest first. Runs in the executor."""
+        with self._connection_lock:
+            rows = self._connect().execute(
+                """
+                SELECT entity_id, playbook, started_at, finished_at, status, host_stats FROM (
+                    SELECT *, ROW_NUMBER() OVER (PARTITION BY entity_id ORDER BY started_at DESC) AS position FROM runs
+                ) WHERE position <= ? ORDER BY started_at DESC
+                """,
+                (HISTORY_STATISTICS_RUNS,),
+            ).fetchall()
+        return [
+            AnsiblePlaybookRunRecord(entity_id, playbook, started_at, finished_at, status, json.loads(host_stats))
+            for entity_id, playbook, started_at, finished_at, status, host_stats in rows
+        ]
+
+    def _query(self, entity_id: str, since: float, until: float) -> List[AnsiblePlaybookRunRecord]:
+        """The runs of the entity in the time range, newest first, through the index by entity. Runs in the executor."""
+        with self._connection_lock:
+            rows = self._connect().execute(
+                """
+                SELECT entity_id, playbook, started_at, finished_at, status, host_stats FROM runs
+                WHERE entity_id = ? AND started_at >= ? AND started_at < ? ORDER BY started_at DESC
+                """,
+                (entity_id, since, until),
+            ).fetchall()
+        return [
+            AnsiblePlaybookRunRecord(entity_id, playbook, started_at, finished_at, status, json.loads(host_stats))
+            for entity_id, playbook, started_at, finished_at, status, host_stats in rows
+        ]
+
+    def _write(self, records: List[AnsiblePlaybookRunRecord]) -> None:
+        """Appends the records and enforces the retention in one transaction. Runs in the executor."""
+        with span("AnsiblePlaybookHistory._write"):
+            with self._connection_lock:
+                connection = self._connect()
+                with connection:
+                    connection.executemany(
+                        "INSERT INTO runs (entity_id, playbook, started_at, finished_at, duration, status, host_stats) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        [
+                            (
+                                record.entity_id,
+                                record.playbook,
+                                record.started_at,
+                                record.finished_at,
+                                record.duration,
+                                record.status,
+                                json.dumps(record.host_stats, separators=(",", ":")),
+                            )
+                            for record in records
+                        ],
+                    )
+                    connection.execute("DELETE FROM runs WHERE started_at < ?", (time.time() - self._max_age_seconds,))
+                    for entity_id in {record.entity_id for record in records}:
+                        connection.execute(
+                            """
+                            DELETE FROM runs WHERE entity_id = ? AND started_at < (
+                                SELECT started_at FROM runs WHERE entity_id = ? ORDER BY started_at DESC LIMIT 1 OFFSET ?
+                            )
+                            """,
+                            (entity_id, entity_id, self._max_runs_per_entity - 1),
+                        )
+
+    def _write_and_close(self, records: List[AnsiblePlaybookRunRecord]) -> None:
+        if records:
+            self._write(records)
+        with self._connection_lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -0,0 +1,117 @@
+import collections
+import logging
+import os
+import threading
+from typing import Deque, Dict
+
+_LOGGER = logging.getLogger(__name__)
+
+# The phases of a playbook run, in the order they happen
+PHASE_PRESS_TO_START = "press_to_start"
+PHASE_QUEUE_WAIT = "queue_wait"
+PHASE_PROCESS_SPAWN = "process_spawn"
+PHASE_RUNNER_STARTUP = "runner_startup"
+PHASE_PLAYBOOK_EXECUTION = "playbook_execution"
+# Part of the playbook execution: the time spent in fact gathering tasks
+PHASE_FACT_GATHERING = "fact_gathering"
+PHASE_IPC_TRANSFER = "ipc_transfer"
+PHASE_RESULT_HANDLING = "result_handling"
+PHASES = [
+    PHASE_PRESS_TO_START,
+    PHASE_QUEUE_WAIT,
+    PHASE_PROCESS_SPAWN,
+    PHASE_RUNNER_STARTUP,
+    PHASE_PLAYBOOK_EXECUTION,
+    PHASE_FACT_GATHERING,
+    PHASE_IPC_TRANSFER,
+    PHASE_RESULT_HANDLING,
+]
+
+# Percentiles are computed over the latest samples only
+HISTOGRAM_SAMPLES = 512
+
+
+class DurationHistogram:
+    """Durations in seconds: the latest HISTOGRAM_SAMPLES samples for the percentiles, count, sum and max of all."""
+    def __init__(self):
+        self._samples: Deque[float] = collections.deque(maxlen=HISTOGRAM_SAMPLES)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self._samples.append(seconds)
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent: float) -> float | None:
+        if not self._samples:
+            return None
+        samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+
+class AnsiblePlaybookMetrics:
+    """
+    Histograms of the durations of the phases of playbook runs.
+
+    "observe" is cheap and thread safe, the percentiles are only computed when the metrics are read.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, DurationHistogram] = {phase: DurationHistogram() for phase in PHASES}
+
+    def observe(self, phase: str, seconds: float) -> None:
+        with self._lock:
+            self._histograms[phase].observe(seconds)
+
+    def snapshot(self) -> Dict[str, dict]:
+        """phase -> count, p50, p95 and max in seconds, for the phases which have been observed."""
+        with self._lock:
+            return {
+                phase: {
+                    "count": histogram.count,
+                    "p50": _round(histogram.percentile(50)),
+                    "p95": _round(histogram.percentile(95)),
+                    "max": _round(histogram.max),
+                }
+                for phase, histogram in self._histograms.items()
+                if histogram.count > 0
+            }
+
+    def prometheus_text(self) -> str:
+        """The histograms in the Prometheus text exposition format, as summaries."""
+        lines = [
+            "# HELP ansible_playbook_phase_seconds Duration of the phases of playbook runs.",
+            "# TYPE ansible_playbook_phase_seconds summary",
+        ]
+        maxima = [
+            "# HELP ansible_playbook_phase_seconds_max Longest duration of the phases of playbook runs.",
+            "# TYPE ansible_playbook_phase_seconds_max gauge",
+        ]
+        with self._lock:
+            for phase, histogram in self._histograms.items():
+                if histogram.count == 0:
+                    continue
+                for quantile in (50, 95):
+                    lines.append(f'ansible_playbook_phase_seconds{{phase="{phase}",quantile="{quantile / 100}"}} {histogram.percentile(quantile)}')
+                lines.append(f'ansible_playbook_phase_seconds_sum{{phase="{phase}"}} {histogram.sum}')
+                lines.append(f'ansible_playbook_phase_seconds_count{{phase="{phase}"}} {histogram.count}')
+                maxima.append(f'ansible_playbook_phase_seconds_max{{phase="{phase}"}} {histogram.max}')
+        return "\n".join(lines + maxima) + "\n"
+
+    def write_prometheus_file(self, path: str) -> None:
+        """Replaces the file atomically, so a scraper never reads a partial file. Blocks, run it in the executor."""
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "w") as metrics_file:
+            metrics_file.write(self.prometheus_text())
+        os.replace(temporary_path, path)
+
+
+def _round(seconds: float | None) -> float | None:
+    return round(seconds, 3) if seconds is not None else None
+
+
+metrics = AnsiblePlaybookMetrics()
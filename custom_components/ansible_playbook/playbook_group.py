@@ -0,0 +1,56 @@
+import json
+import logging
+import os
+from typing import List
+
+from .ansible_playbook_runner import GROUP_MEMBER_PLAY
+from .trace import span
+
+
+_LOGGER = logging.getLogger(__name__)
+
+# Written to this directory in the runtime directory of the component, not to the project of the group
+GROUP_PLAYBOOK_DIRECTORY = "groups"
+GROUP_PLAYBOOK_FILE = "group_{group_id}.yml"
+
+
+def group_playbook_file(group_id: str) -> str:
+    return GROUP_PLAYBOOK_FILE.format(group_id=group_id)
+
+
+def build_group_playbook(member_playbook_files: List[str]) -> str:
+    """
+    A playbook importing the member playbooks in order, so ansible runs them in a single invocation. Each member
+    is preceded by an empty play whose name tells the index of the member, which splits the job events by member.
+    """
+    lines = ["# Generated by the ansible_playbook component, changes are overwritten", "---"]
+    for index, playbook_file in enumerate(member_playbook_files):
+        lines += [
+            f'- name: "{GROUP_MEMBER_PLAY} {index}"',
+            "  hosts: localhost",
+            "  gather_facts: false",
+            "  tasks: []",
+            f"- import_playbook: {json.dumps(playbook_file)}",
+        ]
+    return "\n".join(lines) + "\n"
+
+
+def write_group_playbook(directory: str, group_id: str, member_playbook_paths: List[str]) -> str:
+    """
+    Writes the playbook of the group to "directory", unless it is up to date, and returns its path. It imports the
+    members by their absolute paths, so ansible-runner can run it from there. Blocks on file I/O, must not be called
+    on the event loop.
+    """
+    with span("playbook_group.write_group_playbook", group_id=group_id):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, group_playbook_file(group_id))
+        content = build_group_playbook(member_playbook_paths)
+        try:
+            with open(path) as existing:
+                if existing.read() == content:
+                    return path
+        except OSError:
+            pass
+        with open(path, "w") as group_playbook:
+            group_playbook.write(content)
+        return path
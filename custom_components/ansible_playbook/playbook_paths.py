@@ -0,0 +1,63 @@
+import logging
+import os
+from typing import NamedTuple, Tuple
+
+from .trace import span
+
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class InvalidPlaybookPathsError(Exception):
+    """The playbook directory, the playbook file or the vault password file of a playbook doesn't exist."""
+
+
+class AnsiblePlaybookPaths(NamedTuple):
+    """The resolved, absolute paths of a playbook, checked to exist when they were resolved."""
+    base_dir: str
+    # None for a playbook group, whose playbook is generated before every run
+    playbook_file: str | None
+    vault_password_file: str | None
+    # The directories holding the paths with their mtime_ns; files are only added, removed or renamed by changing them
+    watched: Tuple[Tuple[str, int], ...]
+
+    def is_current(self) -> bool:
+        """
+        Whether none of the watched directories changed since the paths were resolved. Costs a stat per directory.
+        Blocks on file I/O, must not be called on the event loop.
+        """
+        try:
+            return all(os.stat(directory).st_mtime_ns == mtime_ns for directory, mtime_ns in self.watched)
+        except OSError:
+            return False
+
+
+def resolve_playbook_paths(base_dir: str, playbook_file: str | None, vault_password_file: str | None) -> AnsiblePlaybookPaths:
+    """
+    Resolves the playbook file and the vault password file the way ansible-runner does: relative to the project
+    directory of "base_dir", or to "base_dir" itself if it has none. Raises InvalidPlaybookPathsError if one of them
+    doesn't exist. Blocks on file I/O, must not be called on the event loop.
+    """
+    with span("playbook_paths.resolve_playbook_paths", base_dir=base_dir):
+        if not os.path.isdir(base_dir):
+            raise InvalidPlaybookPathsError(f"the playbook directory {base_dir} doesn't exist")
+        project_dir = os.path.join(base_dir, "project")
+        working_dir = project_dir if os.path.isdir(project_dir) else base_dir
+        watched = [base_dir, working_dir]
+        playbook_path = None
+        if playbook_file is not None:
+            playbook_path = os.path.join(working_dir, playbook_file)
+            if not os.path.isfile(playbook_path):
+                raise InvalidPlaybookPathsError(f"the playbook file {playbook_path} doesn't exist")
+            watched.append(os.path.dirname(playbook_path))
+        vault_password_path = None
+        if vault_password_file is not None:
+            vault_password_path = os.path.join(working_dir, vault_password_file)
+            if not os.path.isfile(vault_password_path):
+                raise InvalidPlaybookPathsError(f"the vault password file {vault_password_path} doesn't exist")
+            watched.append(os.path.dirname(vault_password_path))
+        try:
+            mtimes = tuple((directory, os.stat(directory).st_mtime_ns) for directory in dict.fromkeys(watched))
+        except OSError as error:
+            raise InvalidPlaybookPathsError(str(error)) from error
+        return AnsiblePlaybookPaths(base_dir, playbook_path, vault_password_path, mtimes)
@@ -3,146 +3,783 @@ import datetime
 from datetime import timedelta
 import multiprocessing
 import enum
+import asyncio
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import signal
 from multiprocessing.connection import Connection
-from typing import Dict, List
-import pprint
+from multiprocessing.process import BaseProcess
+from typing import Callable, Dict, List, NamedTuple, Tuple
 import math
-from .ansible_playbook_runner import execute_playbook
+import time
+from .ansible_playbook_runner import (
+    cancel_on_sigterm,
+    PlaybookGroupStats,
+    PlaybookProgress,
+    PlaybookRunner,
+    ProgressReporter,
+    BACKEND_FORK,
+    BACKEND_SUBPROCESS,
+    BACKEND_POOL,
+    MESSAGE_PROGRESS,
+    MESSAGE_RESULT,
+    PROGRESS_INTERVAL,
+    STATS_KEYS,
+    TIMINGS_SENT_AT,
+    GROUP_ENVVARS,
+    GROUP_ENVVARS_SETTINGS,
+    STATUS_CANCELED,
+    STATUS_TIMEOUT,
+    STOP_GRACE_PERIOD,
+    RunTimer,
+)
+from .metrics import (
+    metrics,
+    PHASE_QUEUE_WAIT,
+    PHASE_PROCESS_SPAWN,
+    PHASE_IPC_TRANSFER,
+    PHASE_RESULT_HANDLING,
+    PHASE_FACT_GATHERING,
+)
+from .runtime_directories import AnsibleRuntimeDirectories, project_settings
+from .worker_pool import AnsiblePoolWorker, AnsibleWorkerPool, DEFAULT_WORKER_MAX_RUNS, DEFAULT_WORKER_MAX_MEMORY_MB
+from .trace import span
 
 
 _LOGGER = logging.getLogger(__name__)
 
 
-class AnsiblePlaybookResult(dict):
-    def __init__(
-        self,
-        changed: int = 0, 
-        dark: int = 0, 
-        failures: int = 0,
-        ignored: int = 0,
-        ok: int = 0,
-        processed: int = 0,
-        rescued: int = 0,
-        skipped: int = 0,
-    ):
-        self["changed"] = changed
-        self["dark"] = dark
-        self["failures"] = failures
-        self["ignored"] = ignored
-        self["ok"] = ok
-        self["processed"] = processed
-        self["rescued"] = rescued
-        self["skipped"] = skipped
-    
-    @property
-    def host(self):
-        return self._host
+class AnsiblePlaybookResult(NamedTuple):
+    """The counters of a single host, the fields after "host" are in the order of STATS_KEYS."""
+    host: str
+    changed: int = 0
+    dark: int = 0
+    failures: int = 0
+    ignored: int = 0
+    ok: int = 0
+    processed: int = 0
+    rescued: int = 0
+    skipped: int = 0
+
+
+class AnsiblePlaybookSummary(NamedTuple):
+    """The counters summed up over all hosts of a run."""
+    hosts: int = 0
+    changed: int = 0
+    dark: int = 0
+    failures: int = 0
+    ignored: int = 0
+    ok: int = 0
+    processed: int = 0
+    rescued: int = 0
+    skipped: int = 0
 
-    @property
-    def changed(self):
-        return self["changed"]
-    
-    @property
-    def dark(self):
-        return self["dark"]
-    
-    @property
-    def failures(self):
-        return self["failures"]
-    
-    @property
-    def ignored(self):
-        return self["ignored"]
-    
-    @property
-    def ok(self):
-        return self["ok"]
-    
-    @property
-    def processed(self):
-        return self["processed"]
-    
-    @property
-    def rescued(self):
-        return self["rescued"]
-    
-    @property
-    def skipped(self):
-        return self["skipped"]
+
+class AnsiblePlaybookRunResult(NamedTuple):
+    hosts: Dict[str, AnsiblePlaybookResult]
+    summary: AnsiblePlaybookSummary
+    # The final runner status ("successful", "failed", ...) and the timestamps of the run (seconds since the epoch)
+    status: str | None = None
+    started_at: float | None = None
+    finished_at: float | None = None
+    # True if the run was skipped because nothing changed since the run this result is from
+    cached: bool = False
+    # The results of the members of a playbook group run, by member id
+    members: Dict[str, "AnsiblePlaybookRunResult"] | None = None
+    # Seconds spent in fact gathering tasks, None if the run didn't gather facts
+    fact_gathering: float | None = None
+    # The hosts (or patterns) the run was limited to, the union of the limits of coalesced requests; None for all hosts
+    limit: List[str] | None = None
 
 
 class AnsiblePlaybookExecution(dict):
-    def __init__(self, entity_id: str, base_dir: str, playbook_file: str, vault_password_file: str):
+    def __init__(
+        self,
+        entity_id: str,
+        base_dir: str,
+        playbook_file: str,
+        vault_password_file: str,
+        members: List[str] | None = None,
+        tags: List[str] | None = None,
+        extra_vars: dict | None = None,
+    ):
         super()
-        _LOGGER.debug("AnsiblePlaybookExecution.__init__ enter")
         self._base_dir = base_dir
         self._playbook_file = playbook_file
         self._vault_password_file = vault_password_file
         self._running = False
         self._parent_pipe: Connection = None
+        self._process: BaseProcess = None
         self._result_data: dict = None
         self._entity_id = entity_id
-        self._last_result = None
-        _LOGGER.debug("AnsiblePlaybookExecution.__init__ exit")
-    
+        self._started_at: float = None
+        self._loop: asyncio.AbstractEventLoop = None
+        self._on_finished: Callable[[str, AnsiblePlaybookRunResult], None] = None
+        self._backend = BACKEND_FORK
+        self._on_progress: Callable[[str, dict], None] = None
+        self._progress: dict = None
+        self._progress_handle: asyncio.TimerHandle = None
+        self._progress_published_at = 0.0
+        self._limit: List[str] | None = None
+        # The member ids in the order they run, if the playbook runs a playbook group
+        self._members = members
+        # The environment variables ansible is run with, set up by "run"
+        self._envvars: Dict[str, str] | None = None
+        self._tags = tags
+        self._extra_vars = extra_vars
+        self._timeout: float | None = None
+        self._timeout_handle: asyncio.TimerHandle = None
+        # Identifies the current run, callbacks of a stopped run must not touch the next one
+        self._run_token: object = None
+        # The token of the last run which was stopped, a process started after the stop is stopped right away
+        self._stopped_token: object = None
+        self._starting: asyncio.Task = None
+        self._subprocess_task: asyncio.Task = None
+        self._pool: AnsibleWorkerPool = None
+        self._pool_worker: AnsiblePoolWorker = None
+        self._runner: PlaybookRunner = None
+        # The content of the vault password file, handed to the worker instead of the path where possible
+        self._vault_password: str | None = None
+        self._artifact_dir: str | None = None
+
     def is_running(self) -> bool:
-        _LOGGER.debug("AnsiblePlaybookExecution.is_running enter")
-        if self._running:
-            _LOGGER.debug("AnsiblePlaybookExecution.is_running checking _parent_pipe.poll()")
-            if self._parent_pipe.poll():
-                _LOGGER.debug("AnsiblePlaybookExecution.is_running checking _parent_pipe.recv()")
-                data = self._parent_pipe.recv()
-                self.handle_finished_process(data) # TODO
-                _LOGGER.debug("AnsiblePlaybookExecution.is_running exit")
+        """Whether the run is running, from "start" until it is over or stopped. Only the loop changes it."""
+        return self._running
+
+    def handle_finished_process(self, status: str, stats: dict | None, timings: dict | None = None, member_stats: dict | None = None) -> None:
+        with span("AnsiblePlaybookExecution.handle_finished_process"):
+            handling_started = time.monotonic()
+            if timings:
+                self._observe_timings(timings)
+            if self._parent_pipe is not None:
+                self._parent_pipe.close()
+                self._parent_pipe = None
+            self._running = False
+            self._run_token = None
+            self._process = None
+            self._subprocess_task = None
+            self._pool_worker = None
+            if self._timeout_handle is not None:
+                self._timeout_handle.cancel()
+                self._timeout_handle = None
+            if self._progress_handle is not None:
+                self._progress_handle.cancel()
+                self._progress_handle = None
+            self._progress = None
+            result = transformStatsToPlaybookResult(stats if stats is not None else {})
+            finished_at = time.time()
+            members = self._member_results(status, member_stats or {}, finished_at) if self._members is not None else None
+            result = result._replace(
+                status=status,
+                started_at=self._started_at,
+                finished_at=finished_at,
+                members=members,
+                fact_gathering=timings.get(PHASE_FACT_GATHERING) if timings else None,
+                limit=self._limit,
+            )
+            if self._on_finished is not None:
+                self._on_finished(self._entity_id, result)
+            metrics.observe(PHASE_RESULT_HANDLING, time.monotonic() - handling_started)
+
+    def _member_results(self, status: str, member_stats: dict, finished_at: float) -> Dict[str, AnsiblePlaybookRunResult]:
+        """
+        The result of every member by member id. A member fails if one of its tasks failed or a host was unreachable;
+        members which never started get the status of the whole run.
+        """
+        results = {}
+        for member in self._members:
+            if member not in member_stats:
+                results[member] = AnsiblePlaybookRunResult(
+                    hosts={}, summary=AnsiblePlaybookSummary(), status=status, started_at=finished_at, finished_at=finished_at
+                )
+                continue
+            stats, started_at, member_finished_at = member_stats[member]
+            result = transformStatsToPlaybookResult(stats)
+            results[member] = result._replace(
+                status="failed" if result.summary.failures or result.summary.dark else "successful",
+                started_at=started_at,
+                finished_at=member_finished_at if member_finished_at is not None else finished_at,
+            )
+        return results
+
+    def _observe_timings(self, timings: dict) -> None:
+        """Records the timings measured by the worker, and how long its result took to get here."""
+        timings = dict(timings)
+        sent_at = timings.pop(TIMINGS_SENT_AT, None)
+        if sent_at is not None:
+            metrics.observe(PHASE_IPC_TRANSFER, max(0.0, time.time() - sent_at))
+        for phase, seconds in timings.items():
+            metrics.observe(phase, seconds)
+
+    def start(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        on_finished: Callable[[str, AnsiblePlaybookRunResult], None] = None,
+        backend: str = BACKEND_FORK,
+        pool: AnsibleWorkerPool = None,
+        on_progress: Callable[[str, dict], None] = None,
+        runtime_directories: AnsibleRuntimeDirectories = None,
+        runner: PlaybookRunner = None,
+    ) -> None:
+        """
+        Starts the run using the given execution backend and "runner" (ansible-runner by default), ansible uses the
+        fact cache and ssh control sockets of "runtime_directories", if given. Call it on the loop: the run is running
+        as soon as this returns, its process is started by a task of the loop, which does the blocking parts in the
+        executor. A run stopped in the meantime stops its process as soon as it is up.
+
+        The loop is the only owner of the run: it reads the parent pipe (or the subprocess, or the pool worker) and
+        calls "on_finished" as soon as the run is over. "on_progress" gets progress snapshots while the playbook runs,
+        at most once per PROGRESS_INTERVAL.
+
+        The "subprocess" backend starts ansible-runner as a subprocess of the event loop instead of forking
+        this process, the "pool" backend hands the run to a warm worker of the given pool.
+
+        The run is stopped with the status "timeout" once it ran for "timeout" seconds, if a timeout is set.
+        """
+        with span("AnsiblePlaybookExecution.start", entity_id=self._entity_id, backend=backend):
+            self._running = True
+            token = self._run_token = object()
+            self._result_data = None
+            self._started_at = time.time()
+            self._loop = loop
+            self._on_finished = on_finished
+            self._on_progress = on_progress
+            self._progress = None
+            self._progress_published_at = 0.0
+            self._backend = backend
+            self._pool = pool
+            self._runner = runner if runner is not None else PlaybookRunner()
+            if self._timeout is not None:
+                self._timeout_handle = loop.call_later(self._timeout, self._handle_timeout, token)
+            self._starting = loop.create_task(self._async_start(token, runtime_directories))
+
+    async def _async_start(self, token: object, runtime_directories: AnsibleRuntimeDirectories | None) -> None:
+        with span("AnsiblePlaybookExecution._async_start", entity_id=self._entity_id, backend=self._backend):
+            try:
+                envvars = await self._loop.run_in_executor(None, self._build_envvars, runtime_directories)
+                if token is not self._run_token:
+                    return
+                self._envvars = envvars
+                if self._backend == BACKEND_SUBPROCESS:
+                    self._subprocess_task = self._loop.create_task(self._run_subprocess(token))
+                elif self._backend == BACKEND_POOL:
+                    await self._start_pool_job(token)
+                else:
+                    await self._start_worker(token)
+            except Exception:
+                _LOGGER.exception("Error while starting the ansible playbook %s", self._entity_id)
+                if token is self._run_token:
+                    self.handle_finished_process("failed", None)
+
+    async def _start_pool_job(self, token: object) -> None:
+        spawn_started = time.monotonic()
+        # Blocks while a worker has to be spawned
+        worker = await self._loop.run_in_executor(None, functools.partial(
+            self._pool.submit,
+            self._loop,
+            self._base_dir,
+            self._playbook_file,
+            self._vault_password_file,
+            on_done=functools.partial(self._handle_pool_result, token),
+            on_progress=functools.partial(self._handle_pool_progress, token),
+            limit=self._limit,
+            members=self._members,
+            envvars=self._envvars,
+            tags=self._tags,
+            extra_vars=self._extra_vars,
+            vault_password=self._vault_password,
+            artifact_dir=self._artifact_dir,
+        ))
+        metrics.observe(PHASE_PROCESS_SPAWN, time.monotonic() - spawn_started)
+        if token is self._stopped_token:
+            self._pool.cancel(self._loop, worker)
+        elif token is self._run_token:
+            self._pool_worker = worker
+
+    async def _start_worker(self, token: object) -> None:
+        spawn_started = time.monotonic()
+        # Forking is too slow for the event loop
+        parent_pipe, process = await self._loop.run_in_executor(None, self._fork_worker)
+        metrics.observe(PHASE_PROCESS_SPAWN, time.monotonic() - spawn_started)
+        if token is not self._run_token:
+            # Stopped while the worker was forked
+            self._stop_worker(parent_pipe, process)
+            parent_pipe.close()
+            return
+        self._parent_pipe = parent_pipe
+        self._process = process
+        self._watch(parent_pipe, process)
+
+    def _fork_worker(self) -> Tuple[Connection, BaseProcess]:
+        """Forks the worker process of the run. Blocks, runs in the executor."""
+        # Imported once in this process (on the first run), not in every forked worker
+        self._runner.preload()
+        parent_pipe, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=self.worker, args=(child_conn,))
+        process.start()
+        child_conn.close()
+        return parent_pipe, process
+
+    async def _run_subprocess(self, token: object) -> None:
+        with span("AnsiblePlaybookExecution._run_subprocess", entity_id=self._entity_id) as trace:
+            begin_timestamp = datetime.datetime.now()
+            status = "failed"
+            stats = None
+            progress = PlaybookProgress()
+            timer = RunTimer()
+            group_stats = PlaybookGroupStats(self._members) if self._members is not None else None
+
+            def handle_event(event: dict) -> None:
+                if group_stats is not None:
+                    group_stats.update(event)
+                if progress.update(event):
+                    self._publish_progress(progress.snapshot())
+
+            try:
+                status, stats = await self._runner.async_execute(
+                    private_data_dir=self._base_dir,
+                    playbook=self._playbook_file,
+                    vault_password_file=self._vault_password_file,
+                    event_handler=handle_event,
+                    timer=timer,
+                    limit=self._limit,
+                    envvars=self._envvars,
+                    tags=self._tags,
+                    extra_vars=self._extra_vars,
+                    artifact_dir=self._artifact_dir,
+                )
+                trace.event("status = %s", status)
+            except Exception:
+                _LOGGER.exception("Error while executing the ansible playbook %s", self._entity_id)
+            duration = datetime.datetime.now() - begin_timestamp
+            trace.event("duration = %s seconds", math.ceil(duration.total_seconds()))
+            if token is self._run_token:
+                self.handle_finished_process(status, stats, timer.timings, group_stats.member_stats() if group_stats is not None else None)
+
+    def _build_envvars(self, runtime_directories: AnsibleRuntimeDirectories | None) -> Dict[str, str] | None:
+        envvars = {}
+        if runtime_directories is not None:
+            envvars.update(runtime_directories.envvars(self._base_dir))
+        # The environment variables would win over the ansible.cfg of the project
+        if self._members is not None and not project_settings(self._base_dir).intersection(GROUP_ENVVARS_SETTINGS):
+            envvars.update(GROUP_ENVVARS)
+        return envvars or None
+
+    def _handle_pool_result(self, token: object, status: str, stats: dict | None, timings: dict | None, member_stats: dict | None) -> None:
+        with span("AnsiblePlaybookExecution._handle_pool_result", entity_id=self._entity_id, status=status):
+            if token is self._run_token:
+                self.handle_finished_process(status, stats, timings, member_stats)
+
+    def _handle_pool_progress(self, token: object, progress: dict) -> None:
+        if token is self._run_token:
+            self._publish_progress(progress)
+
+    def _handle_timeout(self, token: object) -> None:
+        self._timeout_handle = None
+        if token is self._run_token:
+            _LOGGER.warning("Ansible playbook %s didn't finish within %s seconds, stopping it", self._entity_id, self._timeout)
+            self.stop(STATUS_TIMEOUT)
+
+    def stop(self, status: str = STATUS_CANCELED) -> bool:
+        """
+        Stops the run: its processes get SIGTERM, which cancels ansible, and are killed if they are still around
+        after STOP_GRACE_PERIOD. The run is over right away, with the status "status" ("canceled" or "timeout").
+        A process which is still being started is stopped once it is up. Call it on the loop.
+        Returns False if there is no run to stop.
+        """
+        with span("AnsiblePlaybookExecution.stop", entity_id=self._entity_id, status=status):
+            if not self._running:
                 return False
+            self._stopped_token = self._run_token
+            if self._backend == BACKEND_SUBPROCESS:
+                if self._subprocess_task is not None:
+                    # Cancelling "_run_subprocess" terminates ansible-runner
+                    self._subprocess_task.cancel()
+            elif self._backend == BACKEND_POOL:
+                if self._pool_worker is not None:
+                    self._pool.cancel(self._loop, self._pool_worker)
+            elif self._process is not None:
+                self._stop_worker(self._parent_pipe, self._process)
+            self.handle_finished_process(status, None)
+            return True
+
+    def _stop_worker(self, parent_pipe: Connection, process: BaseProcess) -> None:
+        """Terminates a forked worker, its sentinel is watched so it is reaped once it exits."""
+        self._loop.remove_reader(parent_pipe.fileno())
+        self._loop.add_reader(process.sentinel, self._handle_process_exit, parent_pipe, process)
+        process.terminate()
+        self._loop.call_later(STOP_GRACE_PERIOD, _kill_process_group, process)
+
+    def _watch(self, parent_pipe: Connection, process: BaseProcess) -> None:
+        with span("AnsiblePlaybookExecution._watch"):
+            self._loop.add_reader(parent_pipe.fileno(), self._handle_pipe_readable, parent_pipe)
+            self._loop.add_reader(process.sentinel, self._handle_process_exit, parent_pipe, process)
+
+    def _handle_pipe_readable(self, parent_pipe: Connection) -> None:
+        with span("AnsiblePlaybookExecution._handle_pipe_readable"):
+            if parent_pipe is self._parent_pipe:
+                self._receive_messages()
             else:
-                _LOGGER.debug("AnsiblePlaybookExecution.is_running exit")
-                return True
-        else:
-            _LOGGER.debug("AnsiblePlaybookExecution.is_running exit")
-            return False
-    
-    def handle_finished_process(self, data: dict) -> None:
-        _LOGGER.debug("AnsiblePlaybookExecution.handle_finished_process enter")
-        self._parent_pipe.close()
-        self._parent_pipe = None
-        self._running = False
-        self._last_result = transformStatsToPlaybookResult(data)
-        _LOGGER.debug("AnsiblePlaybookExecution.handle_finished_process exit")
-    
-    def collect_last_result(self) -> AnsiblePlaybookResult | None:
-        _LOGGER.debug("AnsiblePlaybookExecution.collect_last_result enter")
-        last_result = self._last_result
-        self._last_result = None
-        _LOGGER.debug("AnsiblePlaybookExecution.collect_last_result exit")
-        return last_result
-    
-    def run(self) -> None:
-        _LOGGER.debug("AnsiblePlaybookExecution.run enter")
-        child_conn: Connection = None
-        self._parent_pipe, child_conn = multiprocessing.Pipe()
-        p = multiprocessing.Process(target=self.worker, args=(child_conn,))
-        p.start()
-        _LOGGER.debug("AnsiblePlaybookExecution.run sub-process started")
-        self._result_data = None
-        self._running = True
-        _LOGGER.debug("AnsiblePlaybookExecution.run exit")
-    
+                self._loop.remove_reader(parent_pipe.fileno())
+
+    def _handle_process_exit(self, parent_pipe: Connection, process: BaseProcess) -> None:
+        with span("AnsiblePlaybookExecution._handle_process_exit"):
+            self._loop.remove_reader(process.sentinel)
+            process.join()
+            if parent_pipe is self._parent_pipe:
+                # The sub-process is gone before the pipe reader got its turn, or it died without sending anything.
+                self._receive_messages()
+
+    def _receive_messages(self) -> None:
+        """Drains the parent pipe. Only the latest progress snapshot is kept, the result ends the run."""
+        with span("AnsiblePlaybookExecution._receive_messages"):
+            parent_pipe = self._parent_pipe
+            progress = None
+            try:
+                while parent_pipe.poll():
+                    kind, payload = parent_pipe.recv()
+                    if kind == MESSAGE_PROGRESS:
+                        progress = payload
+                    elif kind == MESSAGE_RESULT:
+                        status, stats, timings, member_stats = payload
+                        self._finish_pipe(parent_pipe, status, stats, timings, member_stats)
+                        return
+            except EOFError:
+                _LOGGER.error("Ansible playbook sub-process for %s exited without sending a result", self._entity_id)
+                self._finish_pipe(parent_pipe, "failed", None)
+                return
+            if progress is not None:
+                self._publish_progress(progress)
+
+    def _finish_pipe(self, parent_pipe: Connection, status: str, stats: dict | None, timings: dict | None = None, member_stats: dict | None = None) -> None:
+        self._loop.remove_reader(parent_pipe.fileno())
+        self.handle_finished_process(status, stats, timings, member_stats)
+
+    def _publish_progress(self, progress: dict) -> None:
+        """Passes the progress to "on_progress", throttled to PROGRESS_INTERVAL on the loop. Intermediate snapshots are dropped."""
+        if self._on_progress is None or not self._running:
+            return
+        self._progress = progress
+        if self._progress_handle is None:
+            delay = self._progress_published_at + PROGRESS_INTERVAL - self._loop.time()
+            if delay <= 0:
+                self._flush_progress()
+            else:
+                self._progress_handle = self._loop.call_later(delay, self._flush_progress)
+
+    def _flush_progress(self) -> None:
+        self._progress_handle = None
+        self._progress_published_at = self._loop.time()
+        if self._progress is not None:
+            self._on_progress(self._entity_id, self._progress)
+
+    @property
+    def entity_id(self) -> str:
+        return self._entity_id
+
+    @property
+    def base_dir(self) -> str:
+        return self._base_dir
+
+    @property
+    def limit(self) -> List[str] | None:
+        """The hosts (or patterns) the next run is limited to, None for all hosts."""
+        return self._limit
+
+    @limit.setter
+    def limit(self, limit: List[str] | None) -> None:
+        self._limit = limit
+
+    @property
+    def timeout(self) -> float | None:
+        """Seconds the next run may take before it is stopped, None for no limit."""
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, timeout: float | None) -> None:
+        self._timeout = timeout
+
+    @property
+    def vault_password(self) -> str | None:
+        """The vault password of the next run, None to let ansible read the vault password file."""
+        return self._vault_password
+
+    @vault_password.setter
+    def vault_password(self, vault_password: str | None) -> None:
+        self._vault_password = vault_password
+
+    @property
+    def artifact_dir(self) -> str | None:
+        """Where ansible-runner writes the artifacts of the next run, None for its default."""
+        return self._artifact_dir
+
+    @artifact_dir.setter
+    def artifact_dir(self, artifact_dir: str | None) -> None:
+        self._artifact_dir = artifact_dir
+
     def worker(self, conn: Connection) -> None:
-        _LOGGER.debug("AnsiblePlaybookExecution.worker enter")
-        begin_timestamp = datetime.datetime.now()
-        runner = execute_playbook(private_data_dir=self._base_dir, playbook=self._playbook_file, vault_password_file=self._vault_password_file)
-        end_timestamp = datetime.datetime.now()
-        duration = end_timestamp - begin_timestamp
-        _LOGGER.debug("AnsiblePlaybookExecution.worker " + "Duration = " + str(math.ceil(duration.total_seconds())) + " seconds")
-        conn.send(runner.stats)
-        conn.close()
-        _LOGGER.debug("AnsiblePlaybookExecution.worker exit")
+        with span("AnsiblePlaybookExecution.worker", entity_id=self._entity_id) as trace:
+            begin_timestamp = datetime.datetime.now()
+            # Its own process group, so the worker is killed along with the processes it started, if it has to be
+            os.setpgrp()
+            canceled = cancel_on_sigterm()
+            timer = RunTimer()
+            group_stats = PlaybookGroupStats(self._members) if self._members is not None else None
+            reporter = ProgressReporter(lambda snapshot: conn.send((MESSAGE_PROGRESS, snapshot)), timer=timer, group_stats=group_stats)
+            reporter.start()
+            try:
+                result = self._runner.execute(
+                    private_data_dir=self._base_dir,
+                    playbook=self._playbook_file,
+                    vault_password_file=self._vault_password_file,
+                    event_handler=reporter,
+                    limit=self._limit,
+                    envvars=self._envvars,
+                    cancel_callback=canceled.is_set,
+                    tags=self._tags,
+                    extra_vars=self._extra_vars,
+                    vault_password=self._vault_password,
+                    artifact_dir=self._artifact_dir,
+                )
+            finally:
+                reporter.stop()
+            end_timestamp = datetime.datetime.now()
+            duration = end_timestamp - begin_timestamp
+            trace.event("duration = %s seconds", math.ceil(duration.total_seconds()))
+            timings = timer.finished()
+            timings[TIMINGS_SENT_AT] = time.time()
+            member_stats = group_stats.member_stats() if group_stats is not None else None
+            try:
+                conn.send((MESSAGE_RESULT, (result.status, result.stats, timings, member_stats)))
+            except (BrokenPipeError, OSError):
+                # The run was stopped, nobody is listening anymore
+                pass
+            conn.close()
+
+
+def _kill_process_group(process: BaseProcess) -> None:
+    """Kills the process group of a stopped worker which is still around."""
+    if process.is_alive():
+        _LOGGER.warning("Ansible playbook worker %s didn't stop within %s seconds, killing it", process.pid, STOP_GRACE_PERIOD)
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
 
 
 class AnsibleTaskState(enum.Enum):
     RUNNING = 1
     NOT_RUNNING = 2
+    QUEUED = 3
+
+
+DEFAULT_MAX_CONCURRENT_RUNS = 2
+
+# What happens to requests for an entity which is already running or queued
+TRIGGER_DROP = "drop"
+TRIGGER_QUEUE_ONE = "queue_one"
+TRIGGER_DEBOUNCE = "debounce"
+TRIGGER_MODES = [TRIGGER_DROP, TRIGGER_QUEUE_ONE, TRIGGER_DEBOUNCE]
+DEFAULT_DEBOUNCE = 2.0
+
+
+def merge_limits(first: List[str] | None, second: List[str] | None) -> List[str] | None:
+    """The union of two host limits; None stands for all hosts, so it absorbs every limit."""
+    if first is None or second is None:
+        return None
+    return sorted(set(first).union(second))
+
+
+def same_limits(first: List[str] | None, second: List[str] | None) -> bool:
+    """Whether two host limits select the same hosts (or patterns), whatever their order."""
+    if first is None or second is None:
+        return first is None and second is None
+    return set(first) == set(second)
+
+
+def run_key(entity_id: str, tags: List[str] | None, extra_vars: dict | None, shard: List[str] | None = None) -> str:
+    """
+    The id of the runs of an entity with these parameters: the entity id itself for a plain run, otherwise followed by
+    a digest of the parameters in brackets. Runs with the same id never run at the same time, runs with different ids may.
+    The limit isn't part of it, runs which only differ in their limits are coalesced; the runs over the host shards of
+    a sharded run have an id per shard.
+    """
+    if tags is None and not extra_vars and shard is None:
+        return entity_id
+    parameters = json.dumps(
+        [sorted(tags) if tags is not None else None, extra_vars or None]
+        + ([sorted(shard)] if shard is not None else []),
+        sort_keys=True,
+        default=str,
+    )
+    return f"{entity_id}[{hashlib.sha256(parameters.encode()).hexdigest()[:12]}]"
+
+
+class AnsiblePlaybookRequest(NamedTuple):
+    """A request to run the playbook of an entity, with the arguments of "run_task"."""
+    base_dir: str
+    playbook_file: str
+    vault_password_file: str | None
+    on_finished: Callable[[str, AnsiblePlaybookRunResult], None] | None
+    on_started: Callable[[str], None] | None
+    priority: int
+    on_progress: Callable[[str, dict], None] | None
+    limit: List[str] | None
+    members: List[str] | None = None
+    timeout: float | None = None
+    tags: List[str] | None = None
+    extra_vars: dict | None = None
+    vault_password: str | None = None
+    artifact_dir: str | None = None
+
+    def merge(self, newer: "AnsiblePlaybookRequest") -> "AnsiblePlaybookRequest":
+        """Coalesces a newer request into this one: the newer request wins, limits and priorities are merged."""
+        return newer._replace(limit=merge_limits(self.limit, newer.limit), priority=max(self.priority, newer.priority))
+
+
+class AnsiblePlaybookShardedRun:
+    """
+    A run split into runs over disjoint host shards (see "AnsibleProcessManager.run_task"). Collects the results of the
+    shard runs and reports a single result, merged by "merge_run_results", once all of them are over.
+    """
+    def __init__(self, run_id: str, shard_run_ids: List[str], on_finished: Callable[[str, AnsiblePlaybookRunResult], None]):
+        self._run_id = run_id
+        # shard run id -> its result, None while the shard isn't over
+        self._results: Dict[str, AnsiblePlaybookRunResult | None] = dict.fromkeys(shard_run_ids)
+        self._on_finished = on_finished
+        self._over = False
+
+    @property
+    def run_id(self) -> str:
+        return self._run_id
+
+    @property
+    def shard_run_ids(self) -> List[str]:
+        return list(self._results)
+
+    def handle_finished(self, shard_run_id: str, result: AnsiblePlaybookRunResult) -> None:
+        """The "on_finished" callback of the shard runs."""
+        if self._over or shard_run_id not in self._results:
+            return
+        self._results[shard_run_id] = result
+        if all(result is not None for result in self._results.values()):
+            self._finish()
+
+    def cancel_pending(self) -> None:
+        """The shards which aren't over were dropped before they started: they are over with the status "canceled"."""
+        if self._over:
+            return
+        now = time.time()
+        for shard_run_id, result in self._results.items():
+            if result is None:
+                self._results[shard_run_id] = AnsiblePlaybookRunResult(
+                    hosts={}, summary=AnsiblePlaybookSummary(), status=STATUS_CANCELED, started_at=now, finished_at=now
+                )
+        self._finish()
+
+    def _finish(self) -> None:
+        self._over = True
+        self._on_finished(self._run_id, merge_run_results(list(self._results.values())))
+
+
+class AnsiblePlaybookScheduler:
+    """
+    Limits how many playbook runs are executed at the same time.
+
+    Runs that can't start right away are queued by priority (higher first); runs with the same priority
+    start in the order they were submitted. Besides the global limit, an optional limit caps the number
+    of concurrent runs per inventory (the private data dir of the playbook).
+
+    It isn't thread-safe: the process manager only uses it on the event loop.
+    """
+    def __init__(self, max_concurrent_runs: int = DEFAULT_MAX_CONCURRENT_RUNS, max_runs_per_inventory: int | None = None):
+        self._max_concurrent_runs = max_concurrent_runs
+        self._max_runs_per_inventory = max_runs_per_inventory
+        self._queue: List[tuple] = []
+        self._queued: Dict[str, tuple] = {}
+        self._running: Dict[str, str] = {}
+        self._running_per_inventory: Dict[str, int] = {}
+        self._sequence = itertools.count()
+
+    def configure(self, max_concurrent_runs: int, max_runs_per_inventory: int | None) -> List[Callable[[], None]]:
+        """Changes the limits, returns the queued runs which may start now."""
+        with span("AnsiblePlaybookScheduler.configure"):
+            self._max_concurrent_runs = max_concurrent_runs
+            self._max_runs_per_inventory = max_runs_per_inventory
+            return self._pop_startable()
+
+    def is_queued(self, entity_id: str) -> bool:
+        return entity_id in self._queued
+
+    def running_count(self) -> int:
+        """The number of runs holding a slot."""
+        return len(self._running)
+
+    def cancel(self, entity_id: str) -> bool:
+        """Drops the queued run of the entity, returns False if it has none."""
+        with span("AnsiblePlaybookScheduler.cancel"):
+            entry = self._queued.pop(entity_id, None)
+            if entry is None:
+                return False
+            self._queue.remove(entry)
+            heapq.heapify(self._queue)
+            return True
+
+    def submit(self, entity_id: str, inventory: str, priority: int, start: Callable[[], None]) -> AnsibleTaskState:
+        """
+        Either marks the run as started (the caller has to call "start" then) and returns RUNNING,
+        or queues it and returns QUEUED. Queued runs are handed out by "release".
+        """
+        with span("AnsiblePlaybookScheduler.submit"):
+            if self._has_capacity(inventory):
+                self._mark_running(entity_id, inventory)
+                return AnsibleTaskState.RUNNING
+            entry = (-priority, next(self._sequence), entity_id, inventory, start)
+            heapq.heappush(self._queue, entry)
+            self._queued[entity_id] = entry
+            return AnsibleTaskState.QUEUED
+
+    def release(self, entity_id: str) -> List[Callable[[], None]]:
+        """Frees the slot of a finished run, returns the queued runs which may start now."""
+        with span("AnsiblePlaybookScheduler.release"):
+            inventory = self._running.pop(entity_id, None)
+            if inventory is not None:
+                self._running_per_inventory[inventory] -= 1
+                if self._running_per_inventory[inventory] == 0:
+                    del self._running_per_inventory[inventory]
+            return self._pop_startable()
+
+    def _has_capacity(self, inventory: str) -> bool:
+        if len(self._running) >= self._max_concurrent_runs:
+            return False
+        if self._max_runs_per_inventory is not None:
+            return self._running_per_inventory.get(inventory, 0) < self._max_runs_per_inventory
+        return True
+
+    def _mark_running(self, entity_id: str, inventory: str) -> None:
+        self._running[entity_id] = inventory
+        self._running_per_inventory[inventory] = self._running_per_inventory.get(inventory, 0) + 1
+
+    def _pop_startable(self) -> List[Callable[[], None]]:
+        startable = []
+        skipped = []
+        while self._queue and len(self._running) < self._max_concurrent_runs:
+            entry = heapq.heappop(self._queue)
+            _, _, entity_id, inventory, start = entry
+            if self._has_capacity(inventory):
+                del self._queued[entity_id]
+                self._mark_running(entity_id, inventory)
+                startable.append(start)
+            else:
+                # Blocked by its inventory limit, must not hold back runs of other inventories.
+                skipped.append(entry)
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
+        return startable
 
 
 class AnsibleProcessManager:
@@ -151,96 +788,404 @@ class AnsibleProcessManager:
     There's only one AnsiblePlaybookExecution for each base_dir/playbook_file combination.
 
     It can run a task (sub process) for a given base_dir/playbook_file pair using "run_task", or retrieve the running state using "get_task_state".
+    Runs are started through an AnsiblePlaybookScheduler, so a run may be QUEUED until a slot is free.
+    Requests for a running entity are dropped or coalesced into a follow-up run, depending on their trigger mode.
+
+    Runs are tracked by their run id (see "run_key"), so runs of the same entity with different tags or extra vars are
+    independent of each other: they may run at the same time, and each has its own trigger mode handling. Runs which
+    only differ in their limits share the run id, so their requests are coalesced. "get_task_state" and "stop_task" cover all
+    runs of an entity. The executions of runs with tags, extra vars or shards are dropped once their runs are over.
+
+    The manager is owned by its event loop, all methods must be called on it. The loop is the only reader of the
+    pipes of the runs and makes all state transitions, each of them in a single callback, so concurrent presses
+    can't interleave and no lock is needed. Blocking work (forking a worker, handing a run to the pool) is awaited
+    in the executor by the run, which counts as running from the moment it got its slot.
+    Home Assistant keeps the manager in hass.data[DOMAIN].
     """
-    def __init__(self):
-        _LOGGER.debug("AnsibleProcessManager.__init__ enter")
-        self._sub_processes = {}
-        _LOGGER.debug("AnsibleProcessManager.__init__ exit")
-
-    def run_task(self, entity_id: str, base_dir: str, playbook_file: str, vault_password_file: str) -> None:
-        _LOGGER.debug("AnsibleProcessManager.run_task enter")
-        if self._sub_processes.get(entity_id) is None:
-            task = AnsiblePlaybookExecution(entity_id=entity_id, base_dir=base_dir, playbook_file=playbook_file, vault_password_file=vault_password_file)
-            self._sub_processes[entity_id] = task
-            task.run()
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self._sub_processes: Dict[str, AnsiblePlaybookExecution] = {}
+        self._scheduler = AnsiblePlaybookScheduler()
+        self._backend = BACKEND_FORK
+        self._pool: AnsibleWorkerPool = None
+        self._runtime_directories: AnsibleRuntimeDirectories = None
+        self._runner: PlaybookRunner = None
+        # run id -> coalesced request, which runs once the current run is over
+        self._follow_ups: Dict[str, AnsiblePlaybookRequest] = {}
+        # run id -> coalesced request and its timer
+        self._debounced: Dict[str, Tuple[AnsiblePlaybookRequest, asyncio.TimerHandle]] = {}
+        # run id -> the run split into host shards, while one of its shards isn't over
+        self._sharded_runs: Dict[str, AnsiblePlaybookShardedRun] = {}
+
+    def configure(
+        self,
+        max_concurrent_runs: int,
+        max_runs_per_inventory: int | None,
+        backend: str = BACKEND_FORK,
+        worker_max_runs: int = DEFAULT_WORKER_MAX_RUNS,
+        worker_max_memory_mb: int = DEFAULT_WORKER_MAX_MEMORY_MB,
+        runtime_directories: AnsibleRuntimeDirectories = None,
+        runner: PlaybookRunner = None,
+    ) -> None:
+        """
+        Sets the limits and the execution backend. Workers of the "pool" backend are started by "async_start_worker_pool".
+        Runs reuse facts and ssh connections through "runtime_directories", if given. Playbooks are executed by
+        "runner", ansible-runner by default; the tests plug in a FakePlaybookRunner.
+        """
+        with span("AnsibleProcessManager.configure"):
+            self._backend = backend
+            self._runtime_directories = runtime_directories
+            self._runner = runner
+            if backend == BACKEND_POOL and self._pool is None:
+                # The scheduler never runs more than max_concurrent_runs playbooks, so neither does the pool.
+                self._pool = AnsibleWorkerPool(
+                    size=max_concurrent_runs,
+                    max_runs_per_worker=worker_max_runs,
+                    max_memory_mb=worker_max_memory_mb,
+                    runner=runner,
+                )
+            for start in self._scheduler.configure(max_concurrent_runs, max_runs_per_inventory):
+                start()
+
+    async def async_start_worker_pool(self) -> None:
+        """Spawns the pool workers in the executor, if the "pool" backend is used."""
+        if self._pool is not None:
+            await self._loop.run_in_executor(None, self._pool.start)
+
+    async def async_shutdown(self) -> None:
+        """Drops the queued, debounced and follow-up runs and stops the pool workers. Running runs are left alone."""
+        with span("AnsibleProcessManager.async_shutdown"):
+            for _, handle in self._debounced.values():
+                handle.cancel()
+            self._debounced.clear()
+            self._follow_ups.clear()
+            self._sharded_runs.clear()
+            for run_id in self._sub_processes:
+                self._scheduler.cancel(run_id)
+            pool = self._pool
+            self._pool = None
+            if pool is not None:
+                await self._loop.run_in_executor(None, pool.shutdown)
+
+    def run_task(
+        self,
+        entity_id: str,
+        base_dir: str,
+        playbook_file: str,
+        vault_password_file: str,
+        on_finished: Callable[[str, AnsiblePlaybookRunResult], None] = None,
+        on_started: Callable[[str], None] = None,
+        priority: int = 0,
+        on_progress: Callable[[str, dict], None] = None,
+        limit: List[str] | None = None,
+        trigger_mode: str = TRIGGER_DROP,
+        debounce: float = DEFAULT_DEBOUNCE,
+        members: List[str] | None = None,
+        timeout: float | None = None,
+        tags: List[str] | None = None,
+        extra_vars: dict | None = None,
+        vault_password: str | None = None,
+        shards: List[List[str]] | None = None,
+        artifact_dir: str | None = None,
+    ) -> AnsibleTaskState:
+        """
+        Runs the playbook of the entity, limited to the hosts (or patterns) in "limit" and the tasks tagged with
+        one of "tags", with "extra_vars" (all optional). If the playbook
+        runs a playbook group, "members" are the ids of its members in the order they run: the result then has a result per member.
+        A run taking longer than "timeout" seconds is stopped with the status "timeout". "vault_password" is handed to
+        the worker in memory; the subprocess backend, which can't, lets ansible read "vault_password_file".
+        ansible-runner writes the artifacts of the run to "artifact_dir".
+
+        With more than one host shard in "shards", the playbook runs once per shard, limited to the hosts of the shard,
+        as independent runs under the concurrency limits. "on_finished" is called once, with the results of the
+        shards merged, when all of them are over. Sharded requests are dropped while a shard run is running or
+        queued, whatever the trigger mode.
+
+        Requests for a run id which is already running or queued depend on "trigger_mode": "drop" ignores them,
+        "queue_one" coalesces them into a single follow-up run, which starts once the current run is over.
+        "debounce" waits until there was no request for "debounce" seconds, then handles the coalesced request
+        like "queue_one". Coalesced requests run on the union of their limits.
+
+        Returns RUNNING if the run was started, QUEUED if it has to wait for a free slot (or the debounce window),
+        and the state of the run id if the request was dropped or coalesced. Doesn't block: the process of the run is
+        started by the loop afterwards. "on_started" is called when a queued run (or a follow-up run) gets started,
+        "on_progress" while it runs and "on_finished" when the run is over. The callbacks get the run id.
+        """
+        run_id = run_key(entity_id, tags, extra_vars)
+        with span("AnsibleProcessManager.run_task", run_id=run_id, trigger_mode=trigger_mode):
+            request = AnsiblePlaybookRequest(
+                base_dir, playbook_file, vault_password_file, on_finished, on_started, priority, on_progress, limit,
+                members, timeout, tags, extra_vars, vault_password, artifact_dir
+            )
+            if shards is not None and len(shards) > 1:
+                return self._submit_shards(run_id, entity_id, request, shards)
+            if trigger_mode == TRIGGER_DEBOUNCE:
+                self._debounce(run_id, request, debounce)
+                return AnsibleTaskState.QUEUED
+            return self._submit(run_id, request, coalesce=trigger_mode != TRIGGER_DROP)
+
+    def _submit(self, run_id: str, request: AnsiblePlaybookRequest, coalesce: bool) -> AnsibleTaskState:
+        task = self._sub_processes.get(run_id)
+        if task is None:
+            task = AnsiblePlaybookExecution(
+                entity_id=run_id,
+                base_dir=request.base_dir,
+                playbook_file=request.playbook_file,
+                vault_password_file=request.vault_password_file,
+                members=request.members,
+                tags=request.tags,
+                extra_vars=request.extra_vars,
+            )
+            self._sub_processes[run_id] = task
         else:
-            if self.get_task_state(entity_id=entity_id) == AnsibleTaskState.RUNNING:
-                pass
+            task_state = self._run_state(run_id)
+            if task_state == AnsibleTaskState.QUEUED and coalesce:
+                # Not started yet, so it can still take the hosts of this request
+                task.limit = merge_limits(task.limit, request.limit)
+            elif task_state == AnsibleTaskState.RUNNING and coalesce:
+                follow_up = self._follow_ups.get(run_id)
+                self._follow_ups[run_id] = follow_up.merge(request) if follow_up is not None else request
+            if task_state != AnsibleTaskState.NOT_RUNNING:
+                return task_state
+        task.limit = request.limit
+        task.timeout = request.timeout
+        task.vault_password = request.vault_password
+        task.artifact_dir = request.artifact_dir
+        task_finished = functools.partial(self._handle_task_finished, on_finished=request.on_finished)
+        start = functools.partial(
+            self._start_queued_task,
+            submitted_at=time.monotonic(),
+            task=task,
+            on_finished=task_finished,
+            on_started=request.on_started,
+            on_progress=request.on_progress,
+        )
+        task_state = self._scheduler.submit(entity_id=run_id, inventory=request.base_dir, priority=request.priority, start=start)
+        if task_state == AnsibleTaskState.RUNNING:
+            metrics.observe(PHASE_QUEUE_WAIT, 0.0)
+            self._start_task(task, task_finished, request.on_progress)
+        return task_state
+
+    def _submit_shards(self, run_id: str, entity_id: str, request: AnsiblePlaybookRequest, shards: List[List[str]]) -> AnsibleTaskState:
+        shard_run_ids = [run_key(entity_id, request.tags, request.extra_vars, shard) for shard in shards]
+        task_state = _combined_state([self._run_state(shard_run_id) for shard_run_id in shard_run_ids])
+        if task_state != AnsibleTaskState.NOT_RUNNING:
+            return task_state
+        sharded_run = self._sharded_runs.get(run_id)
+        if sharded_run is not None:
+            # A sharded run of other host shards (for another limit) isn't over yet
+            return _combined_state([self._run_state(shard_run_id) for shard_run_id in sharded_run.shard_run_ids])
+        sharded_run = AnsiblePlaybookShardedRun(
+            run_id,
+            shard_run_ids,
+            functools.partial(self._handle_sharded_run_finished, on_finished=request.on_finished, limit=request.limit),
+        )
+        self._sharded_runs[run_id] = sharded_run
+        return _combined_state([
+            self._submit(shard_run_id, request._replace(limit=shard, on_finished=sharded_run.handle_finished), coalesce=False)
+            for shard_run_id, shard in zip(shard_run_ids, shards)
+        ])
+
+    def _handle_sharded_run_finished(self, run_id: str, result: AnsiblePlaybookRunResult, on_finished, limit: List[str] | None) -> None:
+        self._sharded_runs.pop(run_id, None)
+        if on_finished is not None:
+            # The shards cover the hosts of the limit of the sharded request
+            on_finished(run_id, result._replace(limit=limit))
+
+    def stop_task(self, entity_id: str) -> AnsibleTaskState:
+        """
+        Stops all runs of the entity: running runs are stopped and reported as "canceled", queued (or debounced) runs
+        and follow-up runs are dropped. Returns the state the entity was in.
+        """
+        with span("AnsibleProcessManager.stop_task", entity_id=entity_id):
+            # Queued runs first, or the slots freed by the running runs would start them
+            run_ids = sorted(self._run_ids(entity_id), key=lambda run_id: self._run_state(run_id) == AnsibleTaskState.RUNNING)
+            task_state = _combined_state([self._stop_run(run_id) for run_id in run_ids])
+            # Shards which were dropped while queued are over as well, which reports the result of their sharded run
+            for run_id, sharded_run in list(self._sharded_runs.items()):
+                if _is_run_of(run_id, entity_id):
+                    sharded_run.cancel_pending()
+            return task_state
+
+    def _stop_run(self, run_id: str) -> AnsibleTaskState:
+        pending = self._debounced.pop(run_id, None)
+        if pending is not None:
+            pending[1].cancel()
+        self._follow_ups.pop(run_id, None)
+        task_state = self._run_state(run_id)
+        if task_state == AnsibleTaskState.QUEUED:
+            self._scheduler.cancel(run_id)
+            self._forget(run_id)
+        elif task_state == AnsibleTaskState.RUNNING:
+            # Frees the slot of the run right away, through "_handle_task_finished"
+            self._sub_processes[run_id].stop(STATUS_CANCELED)
+        elif pending is not None:
+            task_state = AnsibleTaskState.QUEUED
+        return task_state
+
+    def _run_ids(self, entity_id: str) -> List[str]:
+        """The ids of the runs of the entity which are known, or pending in the debounce window."""
+        run_ids = set(self._sub_processes) | set(self._debounced)
+        return [run_id for run_id in run_ids if _is_run_of(run_id, entity_id)]
+
+    def _debounce(self, run_id: str, request: AnsiblePlaybookRequest, delay: float) -> None:
+        """Coalesces the request with the pending one and restarts the debounce window."""
+        pending = self._debounced.pop(run_id, None)
+        if pending is not None:
+            pending_request, handle = pending
+            handle.cancel()
+            request = pending_request.merge(request)
+        handle = self._loop.call_later(delay, self._handle_debounced, run_id)
+        self._debounced[run_id] = (request, handle)
+
+    def _handle_debounced(self, run_id: str) -> None:
+        request, _ = self._debounced.pop(run_id)
+        self._submit_follow_up(run_id, request)
+
+    def _submit_follow_up(self, run_id: str, request: AnsiblePlaybookRequest) -> None:
+        if self._submit(run_id, request, coalesce=True) == AnsibleTaskState.RUNNING and request.on_started is not None:
+            request.on_started(run_id)
+
+    def _start_queued_task(self, submitted_at: float, task: AnsiblePlaybookExecution, on_finished, on_started, on_progress) -> None:
+        with span("AnsibleProcessManager._start_queued_task"):
+            metrics.observe(PHASE_QUEUE_WAIT, time.monotonic() - submitted_at)
+            self._start_task(task, on_finished, on_progress)
+            if on_started is not None:
+                on_started(task.entity_id)
+
+    def _start_task(self, task: AnsiblePlaybookExecution, on_finished, on_progress) -> None:
+        # A run which fails to start is over with the status "failed", which frees its slot through "on_finished".
+        task.start(
+            loop=self._loop,
+            on_finished=on_finished,
+            backend=self._backend,
+            pool=self._pool,
+            on_progress=on_progress,
+            runtime_directories=self._runtime_directories,
+            runner=self._runner,
+        )
+
+    def _handle_task_finished(self, run_id: str, result: AnsiblePlaybookRunResult, on_finished) -> None:
+        with span("AnsibleProcessManager._handle_task_finished"):
+            self._release(run_id)
+            if on_finished is not None:
+                on_finished(run_id, result)
+            follow_up = self._follow_ups.pop(run_id, None)
+            if follow_up is not None:
+                self._submit_follow_up(run_id, follow_up)
             else:
-                self._sub_processes[entity_id].run()
-        _LOGGER.debug("AnsibleProcessManager.run_task exit")
-    
+                self._forget(run_id)
+
+    def _forget(self, run_id: str) -> None:
+        """
+        Drops the execution of a parameterized run which is over, so executions don't pile up with every combination
+        of tags and extra vars. The execution of the plain run of an entity is kept.
+        """
+        if (
+            _is_parameterized(run_id)
+            and run_id not in self._debounced
+            and run_id not in self._follow_ups
+            and self._run_state(run_id) == AnsibleTaskState.NOT_RUNNING
+        ):
+            self._sub_processes.pop(run_id, None)
+
+    def _release(self, run_id: str) -> None:
+        for start in self._scheduler.release(run_id):
+            start()
+
     def get_task_state(self, entity_id: str) -> AnsibleTaskState:
-        _LOGGER.debug("AnsibleProcessManager.get_task_state enter")
-        if self._sub_processes.get(entity_id) is None:
-            _LOGGER.debug("AnsibleProcessManager.get_task_state exit")
-            return AnsibleTaskState.NOT_RUNNING
-        else:
-            result = AnsibleTaskState.RUNNING if self._sub_processes[entity_id].is_running() else AnsibleTaskState.NOT_RUNNING
-            _LOGGER.debug("AnsibleProcessManager.get_task_state exit")
-            return result
-    
-    def collect_result(self, entity_id: str) -> AnsiblePlaybookResult | None:
-        _LOGGER.debug("AnsibleProcessManager.collect_result enter")
-        if self._sub_processes.get(entity_id) is None:
-            _LOGGER.debug("AnsibleProcessManager.collect_result exit")
-            return None
+        """
+        RUNNING if a run of the entity is running, otherwise QUEUED if one is queued (or pending in the debounce
+        window), otherwise NOT_RUNNING.
+        """
+        with span("AnsibleProcessManager.get_task_state"):
+            task_states = [self._run_state(run_id) for run_id in self._run_ids(entity_id)]
+            task_states += [AnsibleTaskState.QUEUED for run_id in self._debounced if _is_run_of(run_id, entity_id)]
+            return _combined_state(task_states)
+
+    def _run_state(self, run_id: str) -> AnsibleTaskState:
+        if self._scheduler.is_queued(run_id):
+            return AnsibleTaskState.QUEUED
+        task = self._sub_processes.get(run_id)
+        if task is not None and task.is_running():
+            return AnsibleTaskState.RUNNING
+        return AnsibleTaskState.NOT_RUNNING
+
+    def running_count(self) -> int:
+        """The number of runs which are running (or being started) right now."""
+        return self._scheduler.running_count()
+
+
+def _is_run_of(run_id: str, entity_id: str) -> bool:
+    """Whether the run id (see "run_key") is the id of a run of the entity."""
+    return run_id == entity_id or run_id.startswith(entity_id + "[")
+
+
+def _is_parameterized(run_id: str) -> bool:
+    """Whether the run id (see "run_key") is the id of a run with tags, extra vars or a shard."""
+    return run_id.endswith("]")
+
+
+def _combined_state(task_states: List[AnsibleTaskState]) -> AnsibleTaskState:
+    if AnsibleTaskState.RUNNING in task_states:
+        return AnsibleTaskState.RUNNING
+    if AnsibleTaskState.QUEUED in task_states:
+        return AnsibleTaskState.QUEUED
+    return AnsibleTaskState.NOT_RUNNING
+
+STATS_INDEX = {key: index for index, key in enumerate(STATS_KEYS)}
+
+
+def transformStatsToPlaybookResult(runner_stats: dict) -> AnsiblePlaybookRunResult:
+    """
+    Turns "Runner.stats" (counter -> host -> count) into per-host results and their summary.
+
+    Every count is visited exactly once; hosts missing from a counter count 0.
+    """
+    with span("process_manager.transformStatsToPlaybookResult"):
+        counters: Dict[str, list] = {}
+        totals = [0] * len(STATS_KEYS)
+        for key, counts in runner_stats.items():
+            index = STATS_INDEX.get(key)
+            if index is None or not counts:
+                continue
+            for host, count in counts.items():
+                host_counters = counters.get(host)
+                if host_counters is None:
+                    host_counters = counters[host] = [0] * len(STATS_KEYS)
+                host_counters[index] = count
+                totals[index] += count
+        result = AnsiblePlaybookRunResult(
+            hosts={host: AnsiblePlaybookResult(host, *host_counters) for host, host_counters in counters.items()},
+            summary=AnsiblePlaybookSummary(len(counters), *totals),
+        )
+        return result
+
+
+def merge_run_results(results: List[AnsiblePlaybookRunResult]) -> AnsiblePlaybookRunResult:
+    """
+    Merges the results of runs over disjoint hosts, like the shards of a run, through their stats. The merged run
+    timed out or was canceled if one of the runs did, it failed if one of them didn't succeed.
+    """
+    with span("process_manager.merge_run_results", runs=len(results)):
+        stats: Dict[str, Dict[str, int]] = {key: {} for key in STATS_KEYS}
+        for result in results:
+            for host, host_result in result.hosts.items():
+                for key, count in zip(STATS_KEYS, host_result[1:]):
+                    stats[key][host] = count
+        statuses = {result.status for result in results}
+        for status in (STATUS_TIMEOUT, STATUS_CANCELED):
+            if status in statuses:
+                break
         else:
-            last_result = self._sub_processes[entity_id].collect_last_result()
-            _LOGGER.debug("AnsibleProcessManager.collect_result exit")
-            return last_result
-
-def transformStatsToPlaybookResult(runner_stats: dict) -> dict:
-    _LOGGER.debug("process_manager.transformStatsToPlaybookResult enter")
-    hosts = set()
-    for high_level_key in runner_stats.keys():
-        for host_name in runner_stats[high_level_key].keys():
-            hosts.add(host_name)
-    result = {}
-    for host in hosts:
-        ansible_playbook_result = AnsiblePlaybookResult(
-            changed=runner_stats["changed"][host] if runner_stats["changed"].get(host) is not None else 0,
-            dark=runner_stats["dark"][host] if runner_stats["dark"].get(host) is not None else 0,
-            failures=runner_stats["failures"][host] if runner_stats["failures"].get(host) is not None else 0,
-            ignored=runner_stats["ignored"][host] if runner_stats["ignored"].get(host) is not None else 0,
-            ok=runner_stats["ok"][host] if runner_stats["ok"].get(host) is not None else 0,
-            processed=runner_stats["processed"][host] if runner_stats["processed"].get(host) is not None else 0,
-            rescued=runner_stats["rescued"][host] if runner_stats["rescued"].get(host) is not None else 0,
-            skipped=runner_stats["skipped"][host] if runner_stats["skipped"].get(host) is not None else 0,
+            status = "successful" if statuses == {"successful"} else "failed"
+        started_at = [result.started_at for result in results if result.started_at is not None]
+        finished_at = [result.finished_at for result in results if result.finished_at is not None]
+        fact_gathering = [result.fact_gathering for result in results if result.fact_gathering is not None]
+        return transformStatsToPlaybookResult(stats)._replace(
+            status=status,
+            started_at=min(started_at) if started_at else None,
+            finished_at=max(finished_at) if finished_at else None,
+            # The shards gather their facts at the same time
+            fact_gathering=max(fact_gathering) if fact_gathering else None,
         )
-        result[host] = (ansible_playbook_result)
-    _LOGGER.debug("process_manager.transformStatsToPlaybookResult exit")
-    return result
-
-
-process_manager = AnsibleProcessManager()
-
-def run_task(entity_id: str, base_dir: str, playbook_file: str, vault_password_file: str) -> None:
-    _LOGGER.debug("process_manager.run_task enter")
-    process_manager.run_task(entity_id, base_dir, playbook_file, vault_password_file)
-    _LOGGER.debug("process_manager.run_task exit")
-
-def get_task_state(entity_id: str) -> AnsibleTaskState:
-    _LOGGER.debug("process_manager.get_task_state enter")
-    task_state = process_manager.get_task_state(entity_id)
-    _LOGGER.debug("process_manager.get_task_state return")
-    return task_state
-
-def collect_result(entity_id: str) -> AnsiblePlaybookResult:
-    _LOGGER.debug("process_manager.collect_result enter")
-    result = process_manager.collect_result(entity_id)
-    _LOGGER.debug("process_manager.collect_result exit")
-    return result
-
-
-if __name__ == "__main__":
-    import time
-
-    base_dir = "./custom_components/ansible_playbook/test"
-    playbook_file = "main.yaml"
-    vault_password_file = "vault.txt"
-    entity_id = "entity-id"
-    process_manager.run_task(entity_id=entity_id, base_dir=base_dir, playbook_file=playbook_file, vault_password_file=vault_password_file)
-    while process_manager.get_task_state(entity_id=entity_id) == AnsibleTaskState.RUNNING:
-        time.sleep(1)
-    pprint.pprint(process_manager.collect_result(entity_id=entity_id))
@@ -0,0 +1,115 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from .process_manager import AnsiblePlaybookRunResult
+from .trace import span
+
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_RESULT_CACHE_SIZE = 64
+# Written by ansible-runner during every run, never part of the fingerprint
+FINGERPRINT_EXCLUDED_DIRECTORIES = {"artifacts"}
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class AnsiblePlaybookFingerprinter:
+    """
+    Fingerprints everything a run depends on: the files of the private data dir (project, inventory, env),
+    the playbook, the extra vars, the vault password file, and the limit and tags of the run.
+
+    Files are indexed by mtime and size, only files whose mtime or size changed since the last fingerprint
+    are hashed again. Touching a file therefore costs a hash but doesn't change the fingerprint.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # private data dir -> relative path -> (mtime_ns, size, digest)
+        self._index: Dict[str, Dict[str, Tuple[int, int, str]]] = {}
+
+    def fingerprint(
+        self,
+        private_data_dir: str,
+        playbook: str,
+        extra_vars: dict | None,
+        vault_password_file: str | None,
+        limit: List[str] | None = None,
+        tags: List[str] | None = None,
+    ) -> str:
+        """Blocks on file I/O, must not be called on the event loop."""
+        with span("AnsiblePlaybookFingerprinter.fingerprint", private_data_dir=private_data_dir):
+            digest = hashlib.sha256()
+            digest.update(json.dumps([playbook, extra_vars, vault_password_file, limit, tags], sort_keys=True, default=str).encode())
+            with self._lock:
+                files = self._index_directory(private_data_dir)
+            for path in sorted(files):
+                digest.update(path.encode())
+                digest.update(files[path][2].encode())
+            return digest.hexdigest()
+
+    def _index_directory(self, private_data_dir: str) -> Dict[str, Tuple[int, int, str]]:
+        previous = self._index.get(private_data_dir, {})
+        index = {}
+        for directory, directories, file_names in os.walk(private_data_dir):
+            if directory == private_data_dir:
+                directories[:] = [name for name in directories if name not in FINGERPRINT_EXCLUDED_DIRECTORIES]
+            for file_name in file_names:
+                path = os.path.join(directory, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                relative_path = os.path.relpath(path, private_data_dir)
+                entry = previous.get(relative_path)
+                if entry is None or entry[0] != stat.st_mtime_ns or entry[1] != stat.st_size:
+                    entry = (stat.st_mtime_ns, stat.st_size, _hash_file(path))
+                index[relative_path] = entry
+        # Replacing the index drops the files which are gone
+        self._index[private_data_dir] = index
+        return index
+
+
+class AnsiblePlaybookResultCache:
+    """The results of successful runs by fingerprint, the least recently used ones are evicted first."""
+    def __init__(self, max_entries: int = DEFAULT_RESULT_CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._max_entries = max_entries
+        # fingerprint -> (result, monotonic time it was stored)
+        self._entries: collections.OrderedDict[str, Tuple[AnsiblePlaybookRunResult, float]] = collections.OrderedDict()
+
+    def get(self, fingerprint: str, ttl: float) -> AnsiblePlaybookRunResult | None:
+        """The result stored for the fingerprint, if it isn't older than "ttl" seconds."""
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry is None:
+                return None
+            result, stored_at = entry
+            if time.monotonic() - stored_at > ttl:
+                del self._entries[fingerprint]
+                return None
+            self._entries.move_to_end(fingerprint)
+            return result
+
+    def put(self, fingerprint: str, result: AnsiblePlaybookRunResult) -> None:
+        with self._lock:
+            self._entries[fingerprint] = (result, time.monotonic())
+            self._entries.move_to_end(fingerprint)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+    except OSError:
+        # Unreadable files still change the fingerprint when their mtime or size changes
+        return ""
+    return digest.hexdigest()
@@ -0,0 +1,42 @@
+import logging
+from typing import Dict, List, Tuple
+
+from .process_manager import AnsiblePlaybookResult
+from .trace import span
+
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class AnsiblePlaybookResultStore:
+    """
+    Keeps the latest per-host result of every playbook, keyed by button id and host.
+
+    "update" tells which hosts are new and which hosts' counters changed, so only the entities of
+    those hosts have to be created or written.
+    """
+    def __init__(self):
+        self._results: Dict[str, Dict[str, AnsiblePlaybookResult]] = {}
+
+    def update(self, button_id: str, results: Dict[str, AnsiblePlaybookResult]) -> Tuple[List[str], List[str]]:
+        """Stores the results of a run, returns the new hosts and the known hosts whose results changed."""
+        with span("AnsiblePlaybookResultStore.update"):
+            stored = self._results.setdefault(button_id, {})
+            new_hosts = []
+            changed_hosts = []
+            for host, result in results.items():
+                previous = stored.get(host)
+                if previous is None:
+                    new_hosts.append(host)
+                elif previous != result:
+                    changed_hosts.append(host)
+                else:
+                    continue
+                stored[host] = result
+            return new_hosts, changed_hosts
+
+    def get(self, button_id: str, host: str) -> AnsiblePlaybookResult | None:
+        return self._results.get(button_id, {}).get(host)
+
+    def hosts(self, button_id: str) -> List[str]:
+        return list(self._results.get(button_id, {}).keys())
@@ -0,0 +1,139 @@
+import configparser
+import errno
+import hashlib
+import logging
+import os
+import socket
+import stat
+import threading
+import time
+from typing import Dict, Set, Tuple
+
+from .trace import span
+
+
+_LOGGER = logging.getLogger(__name__)
+
+# Off by default: the environment variables override the ansible.cfg of the project
+DEFAULT_FACT_CACHE_TTL = 0
+DEFAULT_CONTROL_PERSIST = 0
+# The settings of ansible.cfg the environment variables of the fact cache and of ControlPersist override. If the
+# project sets one of them, the feature is left out for its runs.
+FACT_CACHE_SETTINGS = (
+    ("defaults", "gathering"),
+    ("defaults", "fact_caching"),
+    ("defaults", "fact_caching_connection"),
+    ("defaults", "fact_caching_timeout"),
+)
+CONTROL_PERSIST_SETTINGS = (
+    ("ssh_connection", "ssh_args"),
+    ("ssh_connection", "control_path"),
+    ("ssh_connection", "control_path_dir"),
+)
+# ssh refuses control paths longer than the limit of unix socket paths (104 bytes on some platforms). ansible adds
+# a hash of 10 characters to the control path dir.
+MAX_CONTROL_PATH_DIR_LENGTH = 104 - 11
+
+
+class AnsibleRuntimeDirectories:
+    """
+    Keeps state of ansible across runs, per private data dir: a jsonfile fact cache, so facts gathered by one run are
+    reused by the following runs for "fact_cache_ttl" seconds, and a directory for the ControlPersist sockets of ssh,
+    so connections to the hosts stay open for "control_persist" seconds after a run.
+
+    Both are passed to ansible as environment variables, which win over ansible.cfg. So either is left out for a
+    private data dir whose project configures one of the settings it would override in its ansible.cfg, while
+    settings in "env/envvars" of the private data dir win over them anyway. A TTL of 0 (the default) turns the fact
+    cache (or ControlPersist) off.
+    """
+    def __init__(self, root: str, fact_cache_ttl: int = DEFAULT_FACT_CACHE_TTL, control_persist: int = DEFAULT_CONTROL_PERSIST):
+        self._root = root
+        self._fact_cache_ttl = fact_cache_ttl
+        self._control_persist = control_persist
+        self._lock = threading.Lock()
+        # control path dir -> monotonic time of its last cleanup
+        self._cleaned_at: Dict[str, float] = {}
+
+    def envvars(self, private_data_dir: str) -> Dict[str, str]:
+        """
+        The environment of a run in the private data dir. Creates the directories and removes stale control sockets.
+        Blocks on file I/O, must not be called on the event loop.
+        """
+        with span("AnsibleRuntimeDirectories.envvars", private_data_dir=private_data_dir) as trace:
+            if self._fact_cache_ttl <= 0 and self._control_persist <= 0:
+                return {}
+            key = hashlib.sha256(os.path.abspath(private_data_dir).encode()).hexdigest()[:10]
+            settings = project_settings(private_data_dir)
+            envvars = {}
+            if self._fact_cache_ttl > 0 and settings.intersection(FACT_CACHE_SETTINGS):
+                trace.event("the ansible.cfg of the project configures the fact cache, leaving it alone")
+            elif self._fact_cache_ttl > 0:
+                fact_cache_dir = self._directory("facts", key)
+                envvars.update({
+                    "ANSIBLE_GATHERING": "smart",
+                    "ANSIBLE_CACHE_PLUGIN": "jsonfile",
+                    "ANSIBLE_CACHE_PLUGIN_CONNECTION": fact_cache_dir,
+                    "ANSIBLE_CACHE_PLUGIN_TIMEOUT": str(self._fact_cache_ttl),
+                })
+            if self._control_persist > 0 and settings.intersection(CONTROL_PERSIST_SETTINGS):
+                trace.event("the ansible.cfg of the project configures ssh, leaving it alone")
+            elif self._control_persist > 0:
+                control_path_dir = self._directory("cp", key)
+                if len(control_path_dir) > MAX_CONTROL_PATH_DIR_LENGTH:
+                    _LOGGER.warning("Not reusing ssh connections, the control path dir %s is too long", control_path_dir)
+                    return envvars
+                self._cleanup_control_sockets(control_path_dir)
+                envvars.update({
+                    "ANSIBLE_SSH_ARGS": f"-C -o ControlMaster=auto -o ControlPersist={self._control_persist}s",
+                    "ANSIBLE_SSH_CONTROL_PATH_DIR": control_path_dir,
+                })
+            return envvars
+
+    def _directory(self, kind: str, key: str) -> str:
+        directory = os.path.join(self._root, kind, key)
+        # Facts may hold secrets, and anyone who can open a control socket gets a shell on the host.
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        return directory
+
+    def _cleanup_control_sockets(self, control_path_dir: str) -> None:
+        """Removes the sockets of ssh masters which are gone, at most once per ControlPersist period."""
+        with self._lock:
+            now = time.monotonic()
+            cleaned_at = self._cleaned_at.get(control_path_dir)
+            if cleaned_at is not None and now - cleaned_at < self._control_persist:
+                return
+            self._cleaned_at[control_path_dir] = now
+        with span("AnsibleRuntimeDirectories._cleanup_control_sockets", control_path_dir=control_path_dir) as trace:
+            for entry in os.scandir(control_path_dir):
+                try:
+                    if not stat.S_ISSOCK(entry.stat(follow_symlinks=False).st_mode) or _is_listening(entry.path):
+                        continue
+                    os.unlink(entry.path)
+                    trace.event("removed stale control socket %s", entry.name)
+                except FileNotFoundError:
+                    pass
+
+
+def project_settings(private_data_dir: str) -> Set[Tuple[str, str]]:
+    """
+    The (section, option) pairs set in the ansible.cfg ansible reads for runs in the private data dir: the one in its
+    project directory, where ansible-runner starts ansible. Blocks on file I/O.
+    """
+    project_dir = os.path.join(private_data_dir, "project")
+    path = os.path.join(project_dir if os.path.isdir(project_dir) else private_data_dir, "ansible.cfg")
+    parser = configparser.ConfigParser(interpolation=None, strict=False)
+    try:
+        parser.read(path)
+    except configparser.Error as error:
+        _LOGGER.warning("Can't read %s: %s", path, error)
+    return {(section, option) for section in parser.sections() for option in parser.options(section)}
+
+
+def _is_listening(path: str) -> bool:
+    """Whether a process still accepts connections on the unix socket, like the master of a ControlPersist socket."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as unix_socket:
+        try:
+            unix_socket.connect(path)
+        except OSError as error:
+            return error.errno not in (errno.ECONNREFUSED, errno.ENOENT)
+        return True
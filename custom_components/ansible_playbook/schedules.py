@@ -0,0 +1,256 @@
+import asyncio
+import datetime
+import heapq
+import logging
+import math
+import random
+import time
+from typing import Callable, Dict, FrozenSet, List, NamedTuple, Tuple
+
+from .trace import span
+
+
+_LOGGER = logging.getLogger(__name__)
+
+# Scheduled runs are spread by a random delay of up to this many seconds, by default
+DEFAULT_SCHEDULE_JITTER = 60
+# At most this many scheduled runs start per minute, all playbooks together, evenly spaced
+DEFAULT_MAX_SCHEDULED_RUNS_PER_MINUTE = 6
+# The timer wakes up at least this often, so the schedules follow changes of the wall clock
+MAX_TIMER_DELAY = 300
+# A cron expression has to match within this many years
+CRON_SEARCH_YEARS = 5
+
+CRON_ALIASES = {
+    "@hourly": "0 * * * *",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@weekly": "0 0 * * 0",
+    "@monthly": "0 0 1 * *",
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+}
+# The ranges of minute, hour, day of month, month and day of week (0 and 7 are Sunday)
+CRON_FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+
+class CronExpression(NamedTuple):
+    """
+    A cron expression of five fields: minute, hour, day of month, month and day of week. A field is "*" or a comma
+    separated list of numbers and ranges ("1-5"), each optionally with a step ("*/15", "0-30/10"). As in cron, a day
+    matches if either the day of month or the day of week matches, when both are restricted.
+    """
+    minutes: FrozenSet[int]
+    hours: FrozenSet[int]
+    days: FrozenSet[int]
+    months: FrozenSet[int]
+    weekdays: FrozenSet[int]
+    any_day: bool
+    any_weekday: bool
+
+    @classmethod
+    def parse(cls, expression: str) -> "CronExpression":
+        """Parses the expression, or one of CRON_ALIASES. Raises ValueError if it's invalid or never matches."""
+        fields = CRON_ALIASES.get(expression.strip(), expression).split()
+        if len(fields) != len(CRON_FIELDS):
+            raise ValueError(f"a cron expression has {len(CRON_FIELDS)} fields, not {len(fields)}: {expression}")
+        minutes, hours, days, months, weekdays = (
+            _parse_cron_field(field, low, high) for field, (low, high) in zip(fields, CRON_FIELDS)
+        )
+        cron = cls(minutes, hours, days, months, frozenset(weekday % 7 for weekday in weekdays), fields[2] == "*", fields[4] == "*")
+        # E.g. "0 0 31 2 *"
+        cron.next_after(datetime.datetime(2000, 1, 1))
+        return cron
+
+    def next_after(self, moment: datetime.datetime) -> datetime.datetime:
+        """
+        The first minute after "moment" which matches, in the time zone of "moment". Raises ValueError if none does
+        within CRON_SEARCH_YEARS.
+        """
+        candidate = moment.replace(tzinfo=None, second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        last_year = candidate.year + CRON_SEARCH_YEARS
+        while candidate.year <= last_year:
+            if candidate.month not in self.months:
+                candidate = (candidate.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self._matches_day(candidate):
+                candidate = candidate.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif candidate.hour not in self.hours:
+                candidate = candidate.replace(minute=0) + datetime.timedelta(hours=1)
+            elif candidate.minute not in self.minutes:
+                candidate += datetime.timedelta(minutes=1)
+            else:
+                return candidate.replace(tzinfo=moment.tzinfo)
+        raise ValueError("the cron expression never matches")
+
+    def _matches_day(self, moment: datetime.datetime) -> bool:
+        day = moment.day in self.days
+        # Sunday is 0 in cron, 6 in Python
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+
+def _parse_cron_field(field: str, low: int, high: int) -> FrozenSet[int]:
+    values = set()
+    for item in field.split(","):
+        value_range, _, step = item.partition("/")
+        try:
+            if value_range == "*":
+                first, last = low, high
+            elif "-" in value_range:
+                first, last = (int(value) for value in value_range.split("-", 1))
+            else:
+                first = int(value_range)
+                # "5/10" is "5-<high>/10"
+                last = high if step else first
+            step = int(step) if step else 1
+        except ValueError:
+            raise ValueError(f"invalid cron field {field}") from None
+        if not low <= first <= last <= high or step < 1:
+            raise ValueError(f"invalid cron field {field}, the values are {low}-{high}")
+        values.update(range(first, last + 1, step))
+    return frozenset(values)
+
+
+class AnsiblePlaybookSchedule(NamedTuple):
+    """When a playbook runs by itself: every "interval" seconds or whenever "cron" matches."""
+    interval: float | None = None
+    cron: CronExpression | None = None
+    # Every run is delayed by a random number of seconds up to this, at most half the interval
+    jitter: float = DEFAULT_SCHEDULE_JITTER
+    # The seconds which have to pass between two scheduled runs, however they are delayed
+    min_interval: float = 0.0
+
+    def first_planned(self, now: float, time_zone: datetime.tzinfo | None, random_source: random.Random) -> float:
+        """The (wall clock) time of the first run, before its jitter. Interval schedules start at a random phase."""
+        if self.cron is not None:
+            return self.cron.next_after(datetime.datetime.fromtimestamp(now, time_zone)).timestamp()
+        return now + random_source.uniform(0, self.interval)
+
+    def next_planned(self, planned: float, now: float, time_zone: datetime.tzinfo | None) -> float:
+        """The time of the run after the one planned at "planned", before its jitter. Runs missed meanwhile are skipped."""
+        if self.cron is not None:
+            return self.cron.next_after(datetime.datetime.fromtimestamp(max(planned, now), time_zone)).timestamp()
+        return planned + self.interval * (math.floor(max(now - planned, 0) / self.interval) + 1)
+
+    def delay(self, random_source: random.Random) -> float:
+        """The jitter of a run."""
+        jitter = self.jitter if self.interval is None else min(self.jitter, self.interval / 2)
+        return random_source.uniform(0, jitter)
+
+
+class _ScheduledPlaybook:
+    def __init__(self, schedule: AnsiblePlaybookSchedule, run: Callable[[], None]):
+        self.schedule = schedule
+        self.run = run
+        # The time of the next run, without and with its jitter
+        self.planned = 0.0
+        self.due = 0.0
+        self.last_started: float | None = None
+
+
+class AnsiblePlaybookScheduleTimer:
+    """
+    Starts the scheduled runs of all playbooks, with a single timer on the event loop which wakes up for the run due
+    next. At most "max_runs_per_minute" scheduled runs start per minute, evenly spaced: runs which are due together
+    start one after the other, in the order they became due.
+
+    Times are wall clock times, cron expressions match in "time_zone" (the local time zone if None). Owned by the
+    event loop, all methods must be called on it.
+    """
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        max_runs_per_minute: int | None = DEFAULT_MAX_SCHEDULED_RUNS_PER_MINUTE,
+        time_zone: datetime.tzinfo | None = None,
+        clock: Callable[[], float] = time.time,
+        random_source: random.Random | None = None,
+    ):
+        self._loop = loop
+        self._time_zone = time_zone
+        self._clock = clock
+        self._random = random_source if random_source is not None else random.Random()
+        self._spacing = 0.0
+        self.configure(max_runs_per_minute)
+        self._scheduled: Dict[str, _ScheduledPlaybook] = {}
+        # (due, key), entries of rescheduled playbooks are dropped when they come up
+        self._queue: List[Tuple[float, str]] = []
+        self._handle: asyncio.TimerHandle | None = None
+        # No scheduled run starts before this time
+        self._next_start = 0.0
+
+    def configure(self, max_runs_per_minute: int | None) -> None:
+        """Changes the rate limit, None for none."""
+        self._spacing = 60 / max_runs_per_minute if max_runs_per_minute else 0.0
+
+    def add(self, key: str, schedule: AnsiblePlaybookSchedule, run: Callable[[], None]) -> None:
+        """Schedules "run", a callback which starts the run of a playbook, replacing the schedule of "key", if any."""
+        with span("AnsiblePlaybookScheduleTimer.add", key=key) as trace:
+            scheduled = self._scheduled[key] = _ScheduledPlaybook(schedule, run)
+            scheduled.planned = schedule.first_planned(self._clock(), self._time_zone, self._random)
+            self._push(key, scheduled.planned + schedule.delay(self._random))
+            trace.event("first run at %s", datetime.datetime.fromtimestamp(scheduled.due, self._time_zone))
+            self._arm()
+
+    def remove(self, key: str) -> None:
+        self._scheduled.pop(key, None)
+
+    def next_run(self, key: str) -> float | None:
+        """The time of the next run of "key", jitter included but not the rate limit, None if it has no schedule."""
+        scheduled = self._scheduled.get(key)
+        return scheduled.due if scheduled is not None else None
+
+    def shutdown(self) -> None:
+        """Drops all schedules."""
+        self._scheduled.clear()
+        self._queue.clear()
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _push(self, key: str, due: float) -> None:
+        self._scheduled[key].due = due
+        heapq.heappush(self._queue, (due, key))
+
+    def _is_current(self, due: float, key: str) -> bool:
+        scheduled = self._scheduled.get(key)
+        return scheduled is not None and scheduled.due == due
+
+    def _arm(self) -> None:
+        """Sets the timer to the next due run, or to when the rate limit lets it start."""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        while self._queue and not self._is_current(*self._queue[0]):
+            heapq.heappop(self._queue)
+        if not self._queue:
+            return
+        wake_at = max(self._queue[0][0], self._next_start)
+        delay = min(max(wake_at - self._clock(), 0.0), MAX_TIMER_DELAY)
+        self._handle = self._loop.call_later(delay, self._handle_timer)
+
+    def _handle_timer(self) -> None:
+        self._handle = None
+        with span("AnsiblePlaybookScheduleTimer._handle_timer") as trace:
+            now = self._clock()
+            while self._queue and self._queue[0][0] <= now and now >= self._next_start:
+                due, key = heapq.heappop(self._queue)
+                if not self._is_current(due, key):
+                    continue
+                scheduled = self._scheduled[key]
+                schedule = scheduled.schedule
+                if scheduled.last_started is not None and now < scheduled.last_started + schedule.min_interval:
+                    trace.event("%s ran at %s, postponed", key, scheduled.last_started)
+                    self._push(key, scheduled.last_started + schedule.min_interval)
+                    continue
+                scheduled.last_started = now
+                self._next_start = now + self._spacing
+                scheduled.planned = schedule.next_planned(scheduled.planned, now, self._time_zone)
+                self._push(key, scheduled.planned + schedule.delay(self._random))
+                trace.event("starting %s, %.1f seconds late", key, now - due)
+                try:
+                    scheduled.run()
+                except Exception:
+                    _LOGGER.exception("Error while starting the scheduled run of %s", key)
+            self._arm()
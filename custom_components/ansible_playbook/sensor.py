@@ -1,86 +1,290 @@
 import logging
-from .process_manager import get_task_state, AnsibleTaskState, collect_result
+import hashlib
 from homeassistant.const import CONF_NAME
 from homeassistant.core import HomeAssistant, callback
 from homeassistant.components.sensor import ENTITY_ID_FORMAT, SensorEntity
 import homeassistant.helpers.dispatcher as dispatcher
 from datetime import timedelta
 import asyncio
+from .const import (
+    ATTR_TASK_STATE,
+    ATTR_CURRENT_TASK,
+    ATTR_HOSTS_DONE,
+    ATTR_HOSTS_TOTAL,
+    ATTR_PROGRESS,
+    ATTR_HOST,
+    ATTR_HOSTS,
+    ATTR_OK_COUNT,
+    ATTR_CHANGED_COUNT,
+    ATTR_FAILURE_COUNT,
+    ATTR_SKIPPED_COUNT,
+    ATTR_IGNORED_COUNT,
+    ATTR_DARK_COUNT,
+    ATTR_RESCUED_COUNT,
+    ATTR_LAST_DURATIONS,
+    ATTR_SUCCESS_RATE,
+    ATTR_CACHED,
+    ATTR_FACT_GATHERING,
+    ATTR_STATUS,
+    ATTR_ARTIFACTS_SIZE,
+    ATTR_NEXT_SCHEDULED_RUN,
+    SIGNAL_HISTORY_LOADED,
+    SIGNAL_METRICS_UPDATED,
+)
+from .process_manager import AnsibleTaskState, AnsiblePlaybookSummary
+from .result_store import AnsiblePlaybookResultStore
+from .shared_services import AnsiblePlaybookServices
+from .metrics import metrics, PHASE_RESULT_HANDLING
+from .trace import span
+from homeassistant.const import EntityCategory
+from homeassistant.util import slugify
+from homeassistant.util import dt as dt_util
 
 
 _LOGGER = logging.getLogger(__name__)
 
 
 class AnsiblePlaybookSensorEntity(SensorEntity):
-    SCAN_INTERVAL = timedelta(seconds=10)
-
-    def __init__(self, name: str, button_unique_id: str, button_id: str, unique_id: str):
+    def __init__(self, name: str, button_unique_id: str, button_id: str, unique_id: str, services: AnsiblePlaybookServices = None):
         self._name = name
         self._state = False
         self._button_unique_id = button_unique_id
         self._unique_id = unique_id
-        _LOGGER.debug("Newly created AnsiblePlaybookSensorEntity ID: " + f"sensor.{ENTITY_ID_FORMAT.format(self._unique_id).split('.')[1]}")
         self.entity_id = f"sensor.{ENTITY_ID_FORMAT.format(self._unique_id).split('.')[1]}"
         self._button_id = button_id
-        self._should_poll = True
+        self._should_poll = False
+        self._task_state = None
+        self._progress = {}
+        self._summary: AnsiblePlaybookSummary = None
+        self._cached = False
+        self._fact_gathering: float | None = None
+        self._status: str | None = None
+        # The history, artifacts and schedule timer shown in the attributes
+        self._services = services
 
     @property
     def name(self):
-        _LOGGER.debug("AnsiblePlaybookSensorEntity.name: " + self._name)
         return self._name
 
     @property
     def state(self):
-        _LOGGER.debug("AnsiblePlaybookSensorEntity.state: " + str(self._state))
         return self._state
     
     @property
     def unique_id(self):
-        _LOGGER.debug("AnsiblePlaybookSensorEntity.unique_id: " + str(self._unique_id))
         return self._unique_id
     
     @property
     def device(self):
-        _LOGGER.debug("AnsiblePlaybookSensorEntity.device: " + str(self._button_id))
         return self._button_id
     
     @property
     def should_poll(self):
-        _LOGGER.debug("AnsiblePlaybookSensorEntity.should_poll: " + str(self._should_poll))
         return self._should_poll
 
+    @property
+    def extra_state_attributes(self):
+        attributes = {
+            ATTR_TASK_STATE: self._task_state,
+            ATTR_CURRENT_TASK: self._progress.get("current_task"),
+            ATTR_HOSTS_DONE: self._progress.get("hosts_done"),
+            ATTR_HOSTS_TOTAL: self._progress.get("hosts_total"),
+            ATTR_PROGRESS: self._progress.get("percent"),
+        }
+        if self._summary is not None:
+            attributes.update({
+                ATTR_STATUS: self._status,
+                ATTR_HOSTS: self._summary.hosts,
+                ATTR_OK_COUNT: self._summary.ok,
+                ATTR_CHANGED_COUNT: self._summary.changed,
+                ATTR_FAILURE_COUNT: self._summary.failures,
+                ATTR_SKIPPED_COUNT: self._summary.skipped,
+                ATTR_IGNORED_COUNT: self._summary.ignored,
+                ATTR_DARK_COUNT: self._summary.dark,
+                ATTR_RESCUED_COUNT: self._summary.rescued,
+                ATTR_CACHED: self._cached,
+                ATTR_FACT_GATHERING: round(self._fact_gathering, 3) if self._fact_gathering is not None else None,
+            })
+        if self._services is None:
+            return attributes
+        statistics = self._services.history.statistics(self._button_unique_id)
+        attributes[ATTR_LAST_DURATIONS] = statistics.durations
+        attributes[ATTR_SUCCESS_RATE] = statistics.success_rate
+        attributes[ATTR_ARTIFACTS_SIZE] = self._services.artifacts.usage(self._button_id)
+        next_run = self._services.schedule_timer.next_run(self._button_id)
+        if next_run is not None:
+            attributes[ATTR_NEXT_SCHEDULED_RUN] = dt_util.as_local(dt_util.utc_from_timestamp(next_run)).isoformat()
+        return attributes
+
     async def async_added_to_hass(self):
         """Run when the entity is added to the registry."""
-        _LOGGER.debug("AnsiblePlaybookSensorEntity.async_added_to_hass enter")
-        # Register a callback for the custom event
-        dispatcher.async_dispatcher_connect(self.hass, self._button_id + "_executed", self._handle_playbook_executed_event)
-        _LOGGER.debug("AnsiblePlaybookSensorEntity.async_added_to_hass exit")
+        with span("AnsiblePlaybookSensorEntity.async_added_to_hass"):
+            # Register a callback for the custom event
+            self.async_on_remove(
+                dispatcher.async_dispatcher_connect(self.hass, self._button_id + "_executed", self._handle_playbook_executed_event)
+            )
+            self.async_on_remove(
+                dispatcher.async_dispatcher_connect(self.hass, self._button_id + "_progress", self._handle_playbook_progress_event)
+            )
+            self.async_on_remove(
+                dispatcher.async_dispatcher_connect(self.hass, SIGNAL_HISTORY_LOADED, self.async_write_ha_state)
+            )
+            self.async_on_remove(
+                dispatcher.async_dispatcher_connect(self.hass, self._button_id + "_finished", self._handle_playbook_finished_event)
+            )
+            self.async_on_remove(
+                dispatcher.async_dispatcher_connect(self.hass, self._button_id + "_artifacts", self.async_write_ha_state)
+            )
 
     @callback
     async def _handle_playbook_executed_event(self, event):
         """Handle the custom event and update the entity state."""
-        _LOGGER.debug("AnsiblePlaybookSensorEntity._handle_playbook_executed_event enter")
-        self._state = True
-        self.async_write_ha_state()
-        _LOGGER.debug("AnsiblePlaybookSensorEntity._handle_playbook_executed_event exit")
+        with span("AnsiblePlaybookSensorEntity._handle_playbook_executed_event"):
+            # A skipped run is reported as NOT_RUNNING, it may arrive after its (cached) result
+            self._state = event in (AnsibleTaskState.RUNNING, AnsibleTaskState.QUEUED)
+            self._task_state = event.name.lower() if event is not None else None
+            self.async_write_ha_state()
     
-    async def async_update(self):
-        _LOGGER.debug("AnsiblePlaybookSensorEntity.async_update enter")
-        future = self.hass.async_add_executor_job(get_task_state, self._button_unique_id)
-        when_done_lambda = lambda task_state: self._update_with_state(task_state.result())
-        future.add_done_callback(when_done_lambda)
-        _LOGGER.debug("AnsiblePlaybookSensorEntity.async_update exit")
-
-    def _update_with_state(self, task_state: AnsibleTaskState):
-        _LOGGER.debug("AnsiblePlaybookSensorEntity._update_with_state enter")
-        if task_state == AnsibleTaskState.NOT_RUNNING and self._state == True:
-            _LOGGER.debug("AnsiblePlaybookSensorEntity._update_with_state playbook NOT_RUNNING: turning off sensor")
-            result = collect_result(self._button_unique_id)
-            _LOGGER.debug(result)
-            self._state = False
+    @callback
+    def _handle_playbook_progress_event(self, progress):
+        """Handle a progress snapshot of the running playbook."""
+        self._progress = progress
+        self.async_write_ha_state()
+
+    @callback
+    def _handle_playbook_finished_event(self, result, task_state: AnsibleTaskState):
+        """Handle the end of a playbook run, pushed by the process manager, with the state of the other runs of the playbook."""
+        with span("AnsiblePlaybookSensorEntity._handle_playbook_finished_event", task_state=task_state) as trace:
+            if result is not None:
+                trace.event("status=%s hosts=%d", result.status, result.summary.hosts)
+                self._summary = result.summary
+                self._cached = result.cached
+                self._fact_gathering = result.fact_gathering
+                self._status = result.status
+            self._state = task_state in (AnsibleTaskState.RUNNING, AnsibleTaskState.QUEUED)
+            self._task_state = task_state.name.lower()
+            if task_state != AnsibleTaskState.RUNNING:
+                self._progress = {}
             self.async_write_ha_state()
-        _LOGGER.debug("AnsiblePlaybookSensorEntity._update_with_state exit")
 
 class AnsiblePlaybookHostExecutionResultSensorEntity(SensorEntity):
+    """The result of the last playbook run for a single host, created once the host shows up in a result."""
+
+    def __init__(self, name: str, button_id: str, host: str, result_store: AnsiblePlaybookResultStore):
+        self._name = name
+        self._button_id = button_id
+        self._host = host
+        self._result_store = result_store
+        self._unique_id = "ansible_playbook_" + button_id + "_" + host_slug(host) + "_host_sensor"
+        self.entity_id = f"sensor.{self._unique_id}"
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def unique_id(self):
+        return self._unique_id
+
+    @property
+    def device(self):
+        return self._button_id
+
+    @property
+    def should_poll(self):
+        return False
+
+    @property
+    def state(self):
+        result = self._result_store.get(self._button_id, self._host)
+        if result is None:
+            return None
+        if result.dark > 0:
+            return "unreachable"
+        if result.failures > 0:
+            return "failed"
+        if result.changed > 0:
+            return "changed"
+        return "ok"
+
+    @property
+    def extra_state_attributes(self):
+        result = self._result_store.get(self._button_id, self._host)
+        if result is None:
+            return {ATTR_HOST: self._host}
+        return {
+            ATTR_HOST: self._host,
+            ATTR_OK_COUNT: result.ok,
+            ATTR_CHANGED_COUNT: result.changed,
+            ATTR_FAILURE_COUNT: result.failures,
+            ATTR_SKIPPED_COUNT: result.skipped,
+            ATTR_IGNORED_COUNT: result.ignored,
+            ATTR_DARK_COUNT: result.dark,
+            ATTR_RESCUED_COUNT: result.rescued,
+        }
+
+    async def async_added_to_hass(self):
+        """Run when the entity is added to the registry."""
+        self.async_on_remove(
+            dispatcher.async_dispatcher_connect(self.hass, host_result_signal(self._button_id, self._host), self.async_write_ha_state)
+        )
+
+
+def host_result_signal(button_id: str, host: str) -> str:
+    """The dispatcher signal sent when the result of the host changed."""
+    return button_id + "_" + host + "_result"
+
+
+def host_slug(host: str) -> str:
+    """The slug of the host in entity ids, with a short hash of the host name since "web.1" and "web_1" slugify alike."""
+    return slugify(host) + "_" + hashlib.sha256(host.encode()).hexdigest()[:8]
+
+
+class AnsiblePlaybookMetricsSensorEntity(SensorEntity):
+    """
+    Diagnostic sensor with the durations of the phases of all playbook runs: the state is the number of
+    finished runs, the attributes are p50, p95 and max (in seconds) of every phase.
+    """
+
+    _attr_entity_category = EntityCategory.DIAGNOSTIC
+
     def __init__(self):
-        super()
+        self._unique_id = "ansible_playbook_metrics"
+        self.entity_id = f"sensor.{self._unique_id}"
+        self._snapshot = {}
+
+    @property
+    def name(self):
+        return "Ansible Playbook Metrics"
+
+    @property
+    def unique_id(self):
+        return self._unique_id
+
+    @property
+    def should_poll(self):
+        return False
+
+    @property
+    def state(self):
+        return self._snapshot.get(PHASE_RESULT_HANDLING, {}).get("count", 0)
+
+    @property
+    def extra_state_attributes(self):
+        return {
+            phase + "_" + statistic: value
+            for phase, statistics in self._snapshot.items()
+            for statistic, value in statistics.items()
+            if statistic != "count"
+        }
+
+    async def async_added_to_hass(self):
+        """Run when the entity is added to the registry."""
+        self.async_on_remove(
+            dispatcher.async_dispatcher_connect(self.hass, SIGNAL_METRICS_UPDATED, self._handle_metrics_updated)
+        )
+
+    @callback
+    def _handle_metrics_updated(self):
+        self._snapshot = metrics.snapshot()
+        self.async_write_ha_state()
@@ -0,0 +1,133 @@
+import json
+import logging
+import os
+import subprocess
+import threading
+from typing import Dict, List, Tuple
+
+from .trace import span
+
+
+_LOGGER = logging.getLogger(__name__)
+
+# "shards: auto" only splits a run if every shard gets at least this many hosts, a shard costs an ansible startup
+MIN_HOSTS_PER_SHARD = 20
+SHARDS_AUTO = "auto"
+INVENTORY_TIMEOUT = 60
+
+
+class InventoryError(Exception):
+    """The hosts of the inventory couldn't be listed."""
+
+
+class AnsibleShardPlanner:
+    """
+    Splits the hosts a run would run on into shards, which run as separate ansible-runner invocations in parallel.
+    The hosts are listed with "ansible-inventory", once per private data dir and limit, and again only after a file
+    of the inventory changed.
+
+    "max_shards" caps the number of shards, it is the number of runs which may run at the same time.
+    """
+    def __init__(self, max_shards: int):
+        self._max_shards = max_shards
+        self._lock = threading.Lock()
+        # (private data dir, limit) -> (signature of the inventory files, hosts)
+        self._hosts: Dict[Tuple[str, Tuple[str, ...] | None], Tuple[tuple, List[str]]] = {}
+
+    def plan(self, private_data_dir: str, shards: int | str, limit: List[str] | None = None) -> List[List[str]] | None:
+        """
+        The hosts of the shards, "shards" of them or, with "auto", as many as the CPU count, "max_shards" and
+        MIN_HOSTS_PER_SHARD allow. None if the run isn't split, also if the inventory can't be listed.
+        Blocks on file I/O and ansible-inventory, must not be called on the event loop.
+        """
+        with span("AnsibleShardPlanner.plan", private_data_dir=private_data_dir, shards=shards) as trace:
+            try:
+                hosts = self.hosts(private_data_dir, limit)
+            except InventoryError as error:
+                _LOGGER.warning("Not splitting the run of %s into shards: %s", private_data_dir, error)
+                return None
+            count = shard_count(len(hosts), shards, os.cpu_count() or 1, self._max_shards)
+            trace.event("%s hosts, %s shards", len(hosts), count)
+            if count < 2:
+                return None
+            return split_hosts(hosts, count)
+
+    def hosts(self, private_data_dir: str, limit: List[str] | None = None) -> List[str]:
+        """The names of the hosts in the inventory of the private data dir, limited by "limit". Blocks."""
+        inventory = os.path.join(private_data_dir, "inventory")
+        key = (private_data_dir, tuple(limit) if limit is not None else None)
+        signature = _inventory_signature(inventory)
+        with self._lock:
+            cached = self._hosts.get(key)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        hosts = list_inventory_hosts(private_data_dir, limit)
+        with self._lock:
+            self._hosts[key] = (signature, hosts)
+        return hosts
+
+
+def shard_count(hosts: int, shards: int | str, cpu_count: int, max_shards: int) -> int:
+    """How many shards a run over "hosts" hosts is split into, for the configured "shards" (a number or "auto")."""
+    if shards == SHARDS_AUTO:
+        shards = min(cpu_count, max_shards, hosts // MIN_HOSTS_PER_SHARD)
+    return max(1, min(shards, hosts))
+
+
+def split_hosts(hosts: List[str], count: int) -> List[List[str]]:
+    """Deals the hosts out to "count" shards of (almost) the same size."""
+    return [hosts[index::count] for index in range(count)]
+
+
+def list_inventory_hosts(private_data_dir: str, limit: List[str] | None = None) -> List[str]:
+    """
+    The names of the hosts of the inventory of the private data dir (the ansible.cfg of its project otherwise), as
+    listed by "ansible-inventory". Raises InventoryError if that fails. Blocks, must not be called on the event loop.
+    """
+    with span("shards.list_inventory_hosts", private_data_dir=private_data_dir):
+        project_dir = os.path.join(private_data_dir, "project")
+        inventory = os.path.join(private_data_dir, "inventory")
+        command = ["ansible-inventory", "--list"]
+        if os.path.exists(inventory):
+            command += ["-i", inventory]
+        if limit is not None:
+            command += ["--limit", ",".join(limit)]
+        try:
+            completed = subprocess.run(
+                command,
+                cwd=project_dir if os.path.isdir(project_dir) else private_data_dir,
+                stdin=subprocess.DEVNULL,
+                capture_output=True,
+                text=True,
+                timeout=INVENTORY_TIMEOUT,
+            )
+        except (OSError, subprocess.TimeoutExpired) as error:
+            raise InventoryError(str(error)) from error
+        if completed.returncode != 0:
+            raise InventoryError(completed.stderr.strip() or f"ansible-inventory exited with {completed.returncode}")
+        try:
+            inventory_data = json.loads(completed.stdout)
+        except ValueError as error:
+            raise InventoryError(f"unexpected output of ansible-inventory: {error}") from error
+        # Hosts are listed by their groups; hosts without variables may be missing from the hostvars
+        hosts = set(inventory_data.get("_meta", {}).get("hostvars", {}))
+        for name, group in inventory_data.items():
+            if name != "_meta" and isinstance(group, dict):
+                hosts.update(group.get("hosts", []))
+        return sorted(hosts)
+
+
+def _inventory_signature(inventory: str) -> tuple:
+    """The paths, mtimes and sizes of the files of the inventory (a file or a directory)."""
+    if os.path.isfile(inventory):
+        paths = [inventory]
+    else:
+        paths = [os.path.join(directory, file_name) for directory, _, file_names in os.walk(inventory) for file_name in file_names]
+    signature = []
+    for path in sorted(paths):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        signature.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
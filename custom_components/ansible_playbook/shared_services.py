@@ -0,0 +1,35 @@
+from typing import NamedTuple
+
+from .artifacts import AnsibleArtifacts
+from .history import AnsiblePlaybookHistory
+from .process_manager import AnsibleProcessManager
+from .result_cache import AnsiblePlaybookFingerprinter, AnsiblePlaybookResultCache
+from .result_store import AnsiblePlaybookResultStore
+from .schedules import AnsiblePlaybookScheduleTimer
+from .shards import AnsibleShardPlanner
+from .vault_secrets import AnsibleVaultSecrets
+
+
+class AnsiblePlaybookServices(NamedTuple):
+    """
+    The parts shared by all buttons and sensors of all platforms, set up once by the first platform and kept in
+    hass.data[DOMAIN].
+    """
+    # Owned by the event loop
+    process_manager: AnsibleProcessManager
+    history: AnsiblePlaybookHistory
+    # One timer for the schedules of all playbooks
+    schedule_timer: AnsiblePlaybookScheduleTimer
+    # The per-host results of all playbooks, which back the per-host sensors
+    result_store: AnsiblePlaybookResultStore
+    # Used by the playbooks which are skipped if unchanged
+    fingerprinter: AnsiblePlaybookFingerprinter
+    result_cache: AnsiblePlaybookResultCache
+    # The vault password files are read once, not by ansible on every run
+    vault_secrets: AnsibleVaultSecrets
+    # The artifacts of the runs, pruned after every run
+    artifacts: AnsibleArtifacts
+    # Sharded runs get at most as many shards as runs may run at the same time
+    shard_planner: AnsibleShardPlanner
+    # The Prometheus file the metrics are written to after every run, if any
+    metrics_file: str | None = None
@@ -0,0 +1,80 @@
+"""
+Tracing for the ansible_playbook component.
+
+A span marks a function (or any block): it logs when the block is entered and left, with its duration,
+attributes and events. Spans are written at debug level to the "custom_components.ansible_playbook.trace"
+logger, so tracing is turned on by the usual logger configuration of Home Assistant:
+
+    logger:
+      logs:
+        custom_components.ansible_playbook.trace: debug
+
+When tracing is off, "span" costs a single "isEnabledFor" check and returns a shared no-op span: nothing is
+formatted. The call still evaluates its attributes and packs them into a dict though, so spans on hot paths take no
+attributes, or only values at hand, and anything computed goes to "event" behind the span instead.
+"""
+import logging
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Span:
+    """A traced block, use it as a context manager. Attributes and events are only formatted when logged."""
+    __slots__ = ("_name", "_attributes", "_started")
+
+    def __init__(self, name: str, attributes: dict):
+        self._name = name
+        self._attributes = attributes
+        self._started = 0.0
+
+    def __enter__(self) -> "Span":
+        self._started = time.perf_counter()
+        _LOGGER.debug("%s enter%s", self._name, _format_attributes(self._attributes))
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> bool:
+        duration_ms = (time.perf_counter() - self._started) * 1000
+        if exc_type is None:
+            _LOGGER.debug("%s exit %.3f ms", self._name, duration_ms)
+        else:
+            _LOGGER.debug("%s exit %.3f ms with %s", self._name, duration_ms, exc_type.__name__)
+        return False
+
+    def event(self, message: str, *args) -> None:
+        """Logs something that happened within the span, "message" is formatted with "args" like a log message."""
+        _LOGGER.debug("%s " + message, self._name, *args)
+
+
+class _DisabledSpan:
+    """The span handed out while tracing is off, shared by all callers."""
+    __slots__ = ()
+
+    def __enter__(self) -> "_DisabledSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> bool:
+        return False
+
+    def event(self, message: str, *args) -> None:
+        pass
+
+
+DISABLED_SPAN = _DisabledSpan()
+
+
+def span(name: str, **attributes) -> Span | _DisabledSpan:
+    """Starts a span named "<Class>.<method>" or "<module>.<function>", e.g. "with span("X.run", entity_id=...) as trace:"."""
+    if not _LOGGER.isEnabledFor(logging.DEBUG):
+        return DISABLED_SPAN
+    return Span(name, attributes)
+
+
+def tracing_enabled() -> bool:
+    return _LOGGER.isEnabledFor(logging.DEBUG)
+
+
+def _format_attributes(attributes: dict) -> str:
+    if not attributes:
+        return ""
+    return " " + " ".join(f"{key}={value!r}" for key, value in attributes.items())
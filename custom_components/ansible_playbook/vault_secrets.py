@@ -0,0 +1,41 @@
+import logging
+import os
+import threading
+from typing import Dict, Tuple
+
+from .trace import span
+
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class AnsibleVaultSecrets:
+    """
+    The vault passwords of the playbooks by vault password file. A file is read once, and again only after its mtime
+    or size changed, so runs get the password in memory instead of ansible reading the file on every run.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # path -> (mtime_ns, size, password)
+        self._passwords: Dict[str, Tuple[int, int, str]] = {}
+
+    def get(self, path: str) -> str | None:
+        """
+        The password in the vault password file, or None if the file is a script: ansible runs those to get the
+        password, so the file is left to ansible. Raises OSError if the file can't be read.
+        Blocks on file I/O, must not be called on the event loop.
+        """
+        with span("AnsibleVaultSecrets.get"):
+            if os.access(path, os.X_OK):
+                return None
+            stat = os.stat(path)
+            with self._lock:
+                entry = self._passwords.get(path)
+            if entry is not None and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+                return entry[2]
+            # Like ansible, which strips the content of a vault password file
+            with open(path) as vault_password_file:
+                password = vault_password_file.read().strip()
+            with self._lock:
+                self._passwords[path] = (stat.st_mtime_ns, stat.st_size, password)
+            return password
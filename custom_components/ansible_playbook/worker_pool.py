@@ -0,0 +1,301 @@
+import asyncio
+import logging
+import multiprocessing
+import multiprocessing.synchronize
+import os
+import resource
+import signal
+import threading
+import time
+from multiprocessing.connection import Connection
+from typing import Callable, Dict, List
+
+from .ansible_playbook_runner import (
+    PlaybookGroupStats,
+    PlaybookRunner,
+    ProgressReporter,
+    RunTimer,
+    MESSAGE_PROGRESS,
+    MESSAGE_RESULT,
+    TIMINGS_SENT_AT,
+    STOP_GRACE_PERIOD,
+)
+from .trace import span
+
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_WORKER_MAX_RUNS = 20
+DEFAULT_WORKER_MAX_MEMORY_MB = 512
+
+# Jobs and replies are plain tuples, they're pickled on every run:
+#   job:      (private_data_dir, playbook, vault_password_file, limit, members, envvars, tags, extra_vars, vault_password,
+#             artifact_dir), or None to stop the worker
+#   replies:  (MESSAGE_PROGRESS, snapshot) while the playbook runs, then
+#             (MESSAGE_RESULT, (runner_status, runner_stats, worker_max_rss_kib, timings, member_stats))
+# Setting the "canceled" event of a worker cancels the job it is running, the worker replies with the status "canceled"
+# and keeps serving. The pool clears the event before it sends a job.
+# "members" are the member ids of a playbook group, in the order they run (None for a single playbook), "member_stats" their stats.
+
+
+def _worker_main(conn: Connection, runner: PlaybookRunner, canceled: multiprocessing.synchronize.Event) -> None:
+    """
+    Entry point of a pool worker, which runs its jobs with "runner". ansible_runner is imported once, before the first
+    job. "canceled" is set by the pool to cancel the job.
+    """
+    # Its own process group, so the worker is killed along with the processes it started, if it has to be. First
+    # thing, a worker may be killed while it preloads.
+    os.setpgrp()
+    runner.preload()
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        private_data_dir, playbook, vault_password_file, limit, members, envvars, tags, extra_vars, vault_password, artifact_dir = job
+        timer = RunTimer()
+        group_stats = PlaybookGroupStats(members) if members is not None else None
+        reporter = ProgressReporter(lambda snapshot: conn.send((MESSAGE_PROGRESS, snapshot)), timer=timer, group_stats=group_stats)
+        reporter.start()
+        try:
+            result = runner.execute(
+                private_data_dir=private_data_dir,
+                playbook=playbook,
+                vault_password_file=vault_password_file,
+                event_handler=reporter,
+                limit=limit,
+                envvars=envvars,
+                cancel_callback=canceled.is_set,
+                tags=tags,
+                extra_vars=extra_vars,
+                vault_password=vault_password,
+                artifact_dir=artifact_dir,
+            )
+            reply = (result.status, result.stats)
+        except Exception:
+            _LOGGER.exception("Error while executing the ansible playbook %s", playbook)
+            reply = ("failed", None)
+        finally:
+            reporter.stop()
+        timings = timer.finished()
+        timings[TIMINGS_SENT_AT] = time.time()
+        member_stats = group_stats.member_stats() if group_stats is not None else None
+        conn.send((MESSAGE_RESULT, reply + (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, timings, member_stats)))
+    conn.close()
+
+
+class AnsiblePoolWorker:
+    def __init__(self, context: multiprocessing.context.BaseContext, runner: PlaybookRunner):
+        self._connection, child_conn = context.Pipe()
+        # Not SIGTERM: a job may be canceled while the worker is still starting, before it could handle the signal
+        self._canceled = context.Event()
+        self._process = context.Process(target=_worker_main, args=(child_conn, runner, self._canceled), daemon=True)
+        self._process.start()
+        child_conn.close()
+        self.runs = 0
+
+    @property
+    def connection(self) -> Connection:
+        return self._connection
+
+    @property
+    def sentinel(self) -> int:
+        return self._process.sentinel
+
+    def is_alive(self) -> bool:
+        return self._process.is_alive()
+
+    def send(self, job: tuple) -> None:
+        """Sends the job to the worker, a cancellation of the previous job doesn't carry over."""
+        self._canceled.clear()
+        self._connection.send(job)
+
+    def cancel(self) -> None:
+        """Cancels the job the worker is running, the worker replies as soon as ansible is gone."""
+        self._canceled.set()
+
+    def kill(self) -> None:
+        """Kills the worker and the processes it started."""
+        try:
+            os.killpg(self._process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            # Still starting, it has neither its own process group nor processes of its own yet
+            self._process.kill()
+
+    def stop(self, timeout: float = 5) -> None:
+        with span("AnsiblePoolWorker.stop"):
+            try:
+                self._connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            self._process.join(timeout)
+            if self._process.is_alive():
+                # SIGTERM would only cancel the job of the worker
+                self.kill()
+                self._process.join(timeout)
+                if self._process.is_alive():
+                    _LOGGER.warning("The pool worker %s didn't exit after it was killed", self._process.pid)
+            self._connection.close()
+
+
+class AnsibleWorkerPool:
+    """
+    A pool of long-lived, spawn-started worker processes which have already imported ansible_runner.
+
+    Unlike the fork backend, this doesn't copy the Home Assistant process for every run. Workers are
+    recycled after "max_runs_per_worker" runs or when their peak RSS exceeds "max_memory_mb". The workers execute
+    the playbooks with "runner", ansible-runner by default.
+    """
+    def __init__(
+        self,
+        size: int,
+        max_runs_per_worker: int = DEFAULT_WORKER_MAX_RUNS,
+        max_memory_mb: int = DEFAULT_WORKER_MAX_MEMORY_MB,
+        runner: PlaybookRunner = None,
+    ):
+        self._context = multiprocessing.get_context("spawn")
+        self._runner = runner if runner is not None else PlaybookRunner()
+        self._lock = threading.Lock()
+        self._size = size
+        self._max_runs_per_worker = max_runs_per_worker
+        self._max_rss_kib = max_memory_mb * 1024
+        self._idle: List[AnsiblePoolWorker] = []
+        self._busy: List[AnsiblePoolWorker] = []
+        self._closed = False
+
+    def start(self) -> None:
+        """Spawns the workers up front so the first runs don't pay for it. Blocks, run it in the executor."""
+        with span("AnsibleWorkerPool.start"):
+            while True:
+                with self._lock:
+                    if self._closed or len(self._idle) + len(self._busy) >= self._size:
+                        break
+                worker = AnsiblePoolWorker(self._context, self._runner)
+                with self._lock:
+                    self._idle.append(worker)
+
+    def shutdown(self) -> None:
+        """Stops all workers. Blocks, run it in the executor."""
+        with span("AnsibleWorkerPool.shutdown"):
+            with self._lock:
+                self._closed = True
+                workers = self._idle + self._busy
+                self._idle = []
+                self._busy = []
+            for worker in workers:
+                worker.stop()
+
+    def submit(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        private_data_dir: str,
+        playbook: str,
+        vault_password_file: str | None,
+        on_done: Callable[[str, dict | None, dict | None, dict | None], None],
+        on_progress: Callable[[dict], None] = None,
+        limit: List[str] | None = None,
+        members: List[str] | None = None,
+        envvars: Dict[str, str] | None = None,
+        tags: List[str] | None = None,
+        extra_vars: dict | None = None,
+        vault_password: str | None = None,
+        artifact_dir: str | None = None,
+    ) -> AnsiblePoolWorker:
+        """
+        Hands the job to an idle worker (spawning one if there is none), "on_done" is called on the loop
+        with the runner status, stats, timings and member stats, "on_progress" with progress snapshots.
+        Returns the worker, to "cancel" the job. May block while spawning, so don't call it from the loop.
+        """
+        with span("AnsibleWorkerPool.submit"):
+            worker = self._acquire()
+            with self._lock:
+                worker.send((private_data_dir, playbook, vault_password_file, limit, members, envvars, tags, extra_vars, vault_password, artifact_dir))
+            loop.call_soon_threadsafe(self._watch, loop, worker, on_done, on_progress)
+            return worker
+
+    def cancel(self, loop: asyncio.AbstractEventLoop, worker: AnsiblePoolWorker) -> None:
+        """
+        Cancels the job of the worker. "on_done" of the job is still called, with the status "canceled" once the
+        worker replied, or "failed" if the worker had to be killed because it didn't reply within STOP_GRACE_PERIOD.
+        Call it on the loop.
+        """
+        with span("AnsibleWorkerPool.cancel"):
+            worker.cancel()
+            loop.call_later(STOP_GRACE_PERIOD, self._kill_if_stuck, worker, worker.runs)
+
+    def _kill_if_stuck(self, worker: AnsiblePoolWorker, runs: int) -> None:
+        with self._lock:
+            stuck = worker in self._busy and worker.runs == runs
+        if stuck and worker.is_alive():
+            _LOGGER.warning("Ansible pool worker didn't cancel its playbook within %s seconds, killing it", STOP_GRACE_PERIOD)
+            # The sentinel of the worker retires it
+            worker.kill()
+
+    def _acquire(self) -> AnsiblePoolWorker:
+        with self._lock:
+            while self._idle:
+                worker = self._idle.pop()
+                if worker.is_alive():
+                    self._busy.append(worker)
+                    return worker
+                worker.stop()
+        worker = AnsiblePoolWorker(self._context, self._runner)
+        with self._lock:
+            self._busy.append(worker)
+        return worker
+
+    def _watch(self, loop: asyncio.AbstractEventLoop, worker: AnsiblePoolWorker, on_done, on_progress) -> None:
+        loop.add_reader(worker.connection.fileno(), self._handle_worker_readable, loop, worker, on_done, on_progress)
+        loop.add_reader(worker.sentinel, self._handle_worker_readable, loop, worker, on_done, on_progress)
+
+    def _handle_worker_readable(self, loop: asyncio.AbstractEventLoop, worker: AnsiblePoolWorker, on_done, on_progress) -> None:
+        with span("AnsibleWorkerPool._handle_worker_readable") as trace:
+            progress = None
+            result = None
+            try:
+                while result is None and worker.connection.poll():
+                    kind, payload = worker.connection.recv()
+                    if kind == MESSAGE_PROGRESS:
+                        progress = payload
+                    elif kind == MESSAGE_RESULT:
+                        result = payload
+                if result is None and not worker.is_alive():
+                    raise EOFError
+            except (EOFError, OSError):
+                _LOGGER.error("Ansible pool worker died while executing a playbook")
+                self._unwatch(loop, worker)
+                self._retire(loop, worker)
+                on_done("failed", None, None, None)
+                return
+            if result is None:
+                if progress is not None and on_progress is not None:
+                    on_progress(progress)
+                return
+            self._unwatch(loop, worker)
+            status, stats, max_rss_kib, timings, member_stats = result
+            worker.runs += 1
+            if worker.runs >= self._max_runs_per_worker or max_rss_kib >= self._max_rss_kib:
+                trace.event("recycling worker after %s runs, max RSS %s KiB", worker.runs, max_rss_kib)
+                self._retire(loop, worker)
+                loop.run_in_executor(None, self.start)
+            else:
+                with self._lock:
+                    self._busy.remove(worker)
+                    if self._closed or len(self._idle) + len(self._busy) >= self._size:
+                        # A surplus worker, spawned because no idle one was left.
+                        loop.run_in_executor(None, worker.stop)
+                    else:
+                        self._idle.append(worker)
+            on_done(status, stats, timings, member_stats)
+
+    def _unwatch(self, loop: asyncio.AbstractEventLoop, worker: AnsiblePoolWorker) -> None:
+        loop.remove_reader(worker.connection.fileno())
+        loop.remove_reader(worker.sentinel)
+
+    def _retire(self, loop: asyncio.AbstractEventLoop, worker: AnsiblePoolWorker) -> None:
+        with self._lock:
+            if worker in self._busy:
+                self._busy.remove(worker)
+        loop.run_in_executor(None, worker.stop)
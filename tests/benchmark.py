@@ -0,0 +1,836 @@
+"""
+Benchmarks for the ansible_playbook component. They don't need Home Assistant, only ansible and ansible-runner.
+
+Run them from the repository root, e.g.:
+
+    python -m tests.benchmark backends
+    python -m tests.benchmark stats
+    python -m tests.benchmark stress
+    python -m tests.benchmark load
+    python -m tests.benchmark importtime
+    python -m tests.benchmark schedule
+
+The "stress" and "load" benchmarks run a fake runner (fake_runner.py) instead of ansible, they need neither ansible nor
+ansible-runner. tests/test_stress.py runs the "stress" benchmark on every backend.
+The "schedule" benchmark simulates the schedule timer on a virtual clock, it needs nothing but Python.
+The "importtime" benchmark fails if importing the component imports ansible or takes longer than its budget.
+tests/test_importtime.py only checks that ansible isn't imported, a wall clock budget depends too much on the machine.
+The "state-writes" benchmark reads the entities of this component, it needs Home Assistant installed.
+"""
+import argparse
+import asyncio
+import bisect
+import collections
+import datetime
+import functools
+import heapq
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+from custom_components.ansible_playbook.ansible_playbook_runner import BACKENDS, BACKEND_FORK, STATS_KEYS, STATUS_CANCELED
+from custom_components.ansible_playbook.metrics import metrics, PHASE_IPC_TRANSFER
+from custom_components.ansible_playbook.process_manager import (
+    AnsiblePlaybookExecution,
+    AnsibleProcessManager,
+    AnsibleTaskState,
+    TRIGGER_MODES,
+    transformStatsToPlaybookResult,
+)
+from custom_components.ansible_playbook.schedules import (
+    AnsiblePlaybookSchedule,
+    AnsiblePlaybookScheduleTimer,
+    CronExpression,
+    DEFAULT_SCHEDULE_JITTER,
+    DEFAULT_MAX_SCHEDULED_RUNS_PER_MINUTE,
+)
+from .fake_runner import FakePlaybookRunner
+
+
+COMPONENT = "custom_components.ansible_playbook"
+# The benchmarks which start a fresh interpreter run it here, so the component and the tests can be imported
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LOCAL_INVENTORY = "localhost ansible_connection=local ansible_python_interpreter={python}\n"
+
+LOCAL_PLAYBOOK = """---
+- name: Benchmark playbook
+  hosts: all
+  gather_facts: no
+  tasks:
+    - name: Benchmark task
+      debug:
+        msg: "benchmark"
+"""
+
+
+def create_local_private_data_dir(directory: str) -> str:
+    """Creates an ansible-runner private data dir with a trivial playbook running against localhost."""
+    os.makedirs(os.path.join(directory, "inventory"), exist_ok=True)
+    os.makedirs(os.path.join(directory, "project"), exist_ok=True)
+    with open(os.path.join(directory, "inventory", "hosts"), "w") as inventory:
+        inventory.write(LOCAL_INVENTORY.format(python=sys.executable))
+    with open(os.path.join(directory, "project", "main.yaml"), "w") as playbook:
+        playbook.write(LOCAL_PLAYBOOK)
+    return directory
+
+
+async def _run_playbook_once(manager: AnsibleProcessManager, private_data_dir: str) -> float:
+    loop = asyncio.get_running_loop()
+    finished = loop.create_future()
+    begin = time.perf_counter()
+    manager.run_task(
+        entity_id="benchmark",
+        base_dir=private_data_dir,
+        playbook_file="main.yaml",
+        vault_password_file=None,
+        on_finished=lambda entity_id, result: finished.set_result(result),
+    )
+    await finished
+    return time.perf_counter() - begin
+
+
+async def _measure_backend(backend: str, runs: int) -> dict:
+    manager = AnsibleProcessManager(asyncio.get_running_loop())
+    manager.configure(max_concurrent_runs=1, max_runs_per_inventory=None, backend=backend)
+    # Warm workers are the point of the pool backend, they are started before measuring.
+    await manager.async_start_worker_pool()
+    durations = []
+    with tempfile.TemporaryDirectory() as directory:
+        private_data_dir = create_local_private_data_dir(directory)
+        for _ in range(runs):
+            durations.append(await _run_playbook_once(manager, private_data_dir))
+    await manager.async_shutdown()
+    return {
+        "backend": backend,
+        "median_seconds": statistics.median(durations),
+        "min_seconds": min(durations),
+        # ru_maxrss is in KiB on Linux, it covers the largest reaped child (including ansible-playbook itself).
+        "max_child_rss_kib": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+def benchmark_backend(backend: str, runs: int, ballast_mb: int) -> dict:
+    # The ballast stands in for the address space of Home Assistant, which the fork backend copies on every run.
+    ballast = bytearray(b"\x01") * (ballast_mb * 1024 * 1024)
+    result = asyncio.run(_measure_backend(backend, runs))
+    result["parent_rss_kib"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    del ballast
+    return result
+
+
+def benchmark_backends(runs: int, ballast_mb: int) -> None:
+    """
+    Compares the startup latency (end to end time of a one task playbook) and the memory of the
+    execution backends. Every backend is measured in a fresh interpreter, so RUSAGE_CHILDREN only
+    covers that backend.
+    """
+    results = {}
+    for backend in BACKENDS:
+        output = subprocess.run(
+            [sys.executable, "-m", __spec__.name, "backend", backend, "--runs", str(runs), "--ballast-mb", str(ballast_mb)],
+            check=True,
+            capture_output=True,
+            text=True,
+            cwd=REPOSITORY_ROOT,
+        ).stdout
+        results[backend] = json.loads(output.strip().splitlines()[-1])
+    print(f"{'backend':<12}{'median s':>10}{'min s':>10}{'child RSS MiB':>16}")
+    for backend, result in results.items():
+        print(
+            f"{backend:<12}{result['median_seconds']:>10.3f}{result['min_seconds']:>10.3f}"
+            f"{result['max_child_rss_kib'] / 1024:>16.1f}"
+        )
+    fork = results[BACKEND_FORK]
+    for backend, result in results.items():
+        if backend == BACKEND_FORK:
+            continue
+        print(
+            f"{backend} saves {fork['median_seconds'] - result['median_seconds']:.3f} s per run and "
+            f"{(fork['max_child_rss_kib'] - result['max_child_rss_kib']) / 1024:.1f} MiB of peak child RSS "
+            f"compared to {BACKEND_FORK} (parent ballast {ballast_mb} MiB)"
+        )
+
+
+def create_synthetic_stats(hosts: int) -> dict:
+    """Runner.stats of a run over "hosts" hosts; like ansible, counters only list the hosts with a count > 0."""
+    stats = {key: {} for key in STATS_KEYS}
+    for number in range(hosts):
+        host = f"host{number:05d}.example.com"
+        stats["ok"][host] = 10 + number % 7
+        stats["processed"][host] = 1
+        if number % 3 == 0:
+            stats["changed"][host] = 2
+        if number % 5 == 0:
+            stats["skipped"][host] = 1
+        if number % 50 == 0:
+            stats["failures"][host] = 1
+        if number % 97 == 0:
+            stats["dark"][host] = 1
+    return stats
+
+
+class _LegacyResult(dict):
+    def __init__(self, changed=0, dark=0, failures=0, ignored=0, ok=0, processed=0, rescued=0, skipped=0):
+        self["changed"] = changed
+        self["dark"] = dark
+        self["failures"] = failures
+        self["ignored"] = ignored
+        self["ok"] = ok
+        self["processed"] = processed
+        self["rescued"] = rescued
+        self["skipped"] = skipped
+
+
+def _legacy_transform(runner_stats: dict) -> dict:
+    """The transformation this component used before the tuple based results, with a dict subclass per host."""
+    hosts = set()
+    for high_level_key in runner_stats.keys():
+        for host_name in runner_stats[high_level_key].keys():
+            hosts.add(host_name)
+    result = {}
+    for host in hosts:
+        result[host] = _LegacyResult(**{
+            key: runner_stats[key][host] if runner_stats[key].get(host) is not None else 0 for key in STATS_KEYS
+        })
+    return result
+
+
+def _measure_transform(transform, stats: dict, repeat: int) -> tuple:
+    seconds = min(timeit.repeat(lambda: transform(stats), number=1, repeat=repeat))
+    tracemalloc.start()
+    result = transform(stats)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return seconds, retained, peak
+
+
+def benchmark_stats(host_counts: list, repeat: int) -> None:
+    """Compares the time and the memory (retained by the result, and peak) of the stats transformation."""
+    print(f"{'hosts':>8}{'implementation':>16}{'ms':>10}{'retained KiB':>15}{'peak KiB':>12}")
+    for hosts in host_counts:
+        stats = create_synthetic_stats(hosts)
+        for name, transform in (("legacy", _legacy_transform), ("current", transformStatsToPlaybookResult)):
+            seconds, retained, peak = _measure_transform(transform, stats, repeat)
+            print(f"{hosts:>8}{name:>16}{seconds * 1000:>10.2f}{retained / 1024:>15.1f}{peak / 1024:>12.1f}")
+
+
+# The properties Home Assistant reads from a sensor entity when it writes its state
+STATE_WRITE_PROPERTIES = ("unique_id", "name", "state", "extra_state_attributes", "should_poll", "device")
+
+
+def _legacy_sensor_class(sensor_class):
+    """The sensor entity as it was before tracing: every property getter builds and logs a debug string."""
+    logger = logging.getLogger("custom_components.ansible_playbook.sensor")
+
+    class _LegacySensorEntity(sensor_class):
+        @property
+        def name(self):
+            logger.debug("AnsiblePlaybookSensorEntity.name: " + self._name)
+            return self._name
+
+        @property
+        def state(self):
+            logger.debug("AnsiblePlaybookSensorEntity.state: " + str(self._state))
+            return self._state
+
+        @property
+        def unique_id(self):
+            logger.debug("AnsiblePlaybookSensorEntity.unique_id: " + str(self._unique_id))
+            return self._unique_id
+
+        @property
+        def device(self):
+            logger.debug("AnsiblePlaybookSensorEntity.device: " + str(self._button_id))
+            return self._button_id
+
+        @property
+        def should_poll(self):
+            logger.debug("AnsiblePlaybookSensorEntity.should_poll: " + str(self._should_poll))
+            return self._should_poll
+
+    return _LegacySensorEntity
+
+
+def _measure_state_writes(entity, writes: int) -> float:
+    """State writes per second, a write reads the properties Home Assistant reads in async_write_ha_state."""
+    getters = [functools.partial(getattr, entity, name) for name in STATE_WRITE_PROPERTIES]
+
+    def write_states():
+        for _ in range(writes):
+            for getter in getters:
+                getter()
+
+    seconds = min(timeit.repeat(write_states, number=1, repeat=5))
+    return writes / seconds
+
+
+def benchmark_state_writes(writes: int) -> None:
+    """
+    Compares the state write throughput of the run sensor with and without the per-access debug strings,
+    with debug logging off (the default) and on (the records go to a null handler, so only their cost counts).
+    """
+    from custom_components.ansible_playbook.sensor import AnsiblePlaybookSensorEntity
+
+    component_logger = logging.getLogger("custom_components.ansible_playbook")
+    component_logger.addHandler(logging.NullHandler())
+    component_logger.propagate = False
+    print(f"{'debug logging':<16}{'implementation':>16}{'writes/s':>14}")
+    for level in (logging.INFO, logging.DEBUG):
+        component_logger.setLevel(level)
+        for name, sensor_class in (
+            ("legacy", _legacy_sensor_class(AnsiblePlaybookSensorEntity)),
+            ("current", AnsiblePlaybookSensorEntity),
+        ):
+            entity = sensor_class(name="Benchmark", button_unique_id="benchmark", button_id="benchmark", unique_id="benchmark_sensor")
+            rate = _measure_state_writes(entity, writes)
+            print(f"{'on' if level == logging.DEBUG else 'off':<16}{name:>16}{rate:>14.0f}")
+
+
+class _ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.records = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.records.append(record)
+
+
+async def run_stress(backend: str, presses: int, entities: int, max_concurrent_runs: int, run_seconds: float, stop_ratio: float, pollers: int, seed: int) -> dict:
+    """The scenario of "benchmark_stress", on the running loop. Returns the counts and the violations it found."""
+    loop = asyncio.get_running_loop()
+    manager = AnsibleProcessManager(loop)
+    manager.configure(
+        max_concurrent_runs=max_concurrent_runs,
+        max_runs_per_inventory=None,
+        backend=backend,
+        runner=FakePlaybookRunner(hosts=2, latency=run_seconds),
+    )
+    await manager.async_start_worker_pool()
+    randomizer = random.Random(seed)
+    trigger_modes = {f"entity_{index}": randomizer.choice(TRIGGER_MODES) for index in range(entities)}
+    violations = []
+    # run id -> number of runs started but not finished, must never exceed 1
+    active = collections.Counter()
+    counts = collections.Counter()
+
+    original_start = AnsiblePlaybookExecution.start
+
+    # The executions are dicts, so they are kept by id
+    executions = {}
+
+    def start(execution: AnsiblePlaybookExecution, *args, **kwargs) -> None:
+        counts["started"] += 1
+        active[execution.entity_id] += 1
+        if active[execution.entity_id] > 1 or execution.is_running():
+            violations.append(f"{execution.entity_id} started while it was running")
+        executions[id(execution)] = execution
+        running = sum(1 for other in executions.values() if other.is_running())
+        if running >= max_concurrent_runs:
+            violations.append(f"{running + 1} runs at the same time")
+        original_start(execution, *args, **kwargs)
+
+    def handle_finished(run_id: str, result) -> None:
+        counts["finished"] += 1
+        counts[result.status] += 1
+        if active[run_id] != 1:
+            violations.append(f"{run_id} finished {active[run_id]} runs at once")
+        active[run_id] -= 1
+        if manager.running_count() > max_concurrent_runs:
+            violations.append(f"{manager.running_count()} slots taken")
+
+    async def press(index: int) -> None:
+        entity_id = f"entity_{randomizer.randrange(entities)}"
+        # A few sets of tags, so runs of the same entity with different tags run side by side, and a few limits,
+        # which are coalesced
+        variant = randomizer.randrange(3)
+        host = randomizer.randrange(3)
+        # A press hops to the executor and back before it gets to the manager, like the buttons do
+        await asyncio.sleep(randomizer.random() * run_seconds * 10)
+        await loop.run_in_executor(None, time.sleep, 0)
+        if randomizer.random() < stop_ratio:
+            manager.stop_task(entity_id)
+            counts["stops"] += 1
+            return
+        manager.run_task(
+            entity_id=entity_id,
+            base_dir=tempfile.gettempdir(),
+            playbook_file="main.yaml",
+            vault_password_file=None,
+            on_finished=handle_finished,
+            limit=[f"host_{host}"] if host else None,
+            tags=[f"tag_{variant}"] if variant else None,
+            trigger_mode=trigger_modes[entity_id],
+            debounce=run_seconds,
+        )
+        counts["presses"] += 1
+
+    async def poll(done: asyncio.Event) -> None:
+        while not done.is_set():
+            for index in range(entities):
+                manager.get_task_state(f"entity_{index}")
+                counts["polls"] += 1
+            if manager.running_count() > max_concurrent_runs:
+                violations.append(f"{manager.running_count()} slots taken")
+            await asyncio.sleep(0)
+
+    errors = _ErrorCounter()
+    component_logger = logging.getLogger(COMPONENT)
+    component_logger.addHandler(errors)
+    AnsiblePlaybookExecution.start = start
+    begin = time.perf_counter()
+    try:
+        done = asyncio.Event()
+        polling = [loop.create_task(poll(done)) for _ in range(pollers)]
+        await asyncio.gather(*(press(index) for index in range(presses)))
+        # Debounced and follow-up runs are still to come, the debounce windows end within "run_seconds"
+        await asyncio.sleep(2 * run_seconds)
+        deadline = time.monotonic() + 60 + presses * run_seconds
+        while counts["started"] != counts["finished"] or manager.running_count() or any(
+            manager.get_task_state(f"entity_{index}") != AnsibleTaskState.NOT_RUNNING for index in range(entities)
+        ):
+            if time.monotonic() > deadline:
+                stuck = {
+                    f"entity_{index}": manager.get_task_state(f"entity_{index}").name for index in range(entities)
+                    if manager.get_task_state(f"entity_{index}") != AnsibleTaskState.NOT_RUNNING
+                }
+                violations.append(
+                    f"runs didn't finish: {counts['started']} started, {counts['finished']} finished, "
+                    f"{manager.running_count()} slots taken, stuck {stuck}"
+                )
+                break
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - begin
+        done.set()
+        await asyncio.gather(*polling)
+        await manager.async_shutdown()
+        # Stopped workers are reaped once they exited
+        deadline = time.monotonic() + 15
+        while multiprocessing.active_children() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if multiprocessing.active_children():
+            violations.append(f"{len(multiprocessing.active_children())} worker processes left")
+    finally:
+        AnsiblePlaybookExecution.start = original_start
+        component_logger.removeHandler(errors)
+    violations += [record.getMessage() for record in errors.records]
+    return {
+        "presses": counts["presses"],
+        "stops": counts["stops"],
+        "polls": counts["polls"],
+        "runs": counts["finished"],
+        "successful": counts["successful"],
+        "canceled": counts[STATUS_CANCELED],
+        "seconds": elapsed,
+        "runs_per_second": counts["finished"] / elapsed,
+        "violations": violations,
+    }
+
+
+def benchmark_stress(backend: str, presses: int, entities: int, max_concurrent_runs: int, run_seconds: float, stop_ratio: float, pollers: int, seed: int) -> None:
+    """
+    Fires hundreds of presses (and some stops) at the process manager at the same time, from concurrent coroutines
+    with mixed trigger modes and parameters, while other coroutines keep polling the task states. The runs use the
+    given execution backend, with a fake runner. Checks that no run id runs twice at once, that the concurrency limit
+    holds, that every run finishes exactly once, and that no worker process is left behind. Exits with 1 on a violation.
+    """
+    result = asyncio.run(run_stress(backend, presses, entities, max_concurrent_runs, run_seconds, stop_ratio, pollers, seed))
+    print(
+        f"{result['presses']} presses, {result['stops']} stops, {result['polls']} polls: {result['runs']} runs "
+        f"({result['successful']} successful, {result['canceled']} canceled) in {result['seconds']:.2f} s, "
+        f"{result['runs_per_second']:.1f} runs/s"
+    )
+    for violation in result["violations"]:
+        print(f"violation: {violation}")
+    if result["violations"]:
+        sys.exit(1)
+
+
+def _percentiles(samples: list) -> dict:
+    if len(samples) < 2:
+        return {"p50": samples[0] if samples else None, "p95": samples[0] if samples else None}
+    quantiles = statistics.quantiles(samples, n=20)
+    return {"p50": statistics.median(samples), "p95": quantiles[18]}
+
+
+async def _run_fake_playbook(manager: AnsibleProcessManager, entity_id: str) -> tuple:
+    """Runs the playbook of the entity, returns the seconds until its first event and until its result reached the loop."""
+    loop = asyncio.get_running_loop()
+    started = loop.create_future()
+    finished = loop.create_future()
+
+    def handle_progress(run_id: str, progress: dict) -> None:
+        if not started.done():
+            started.set_result(time.perf_counter())
+
+    pressed = time.perf_counter()
+    manager.run_task(
+        entity_id=entity_id,
+        base_dir=tempfile.gettempdir(),
+        playbook_file=entity_id + ".yml",
+        vault_password_file=None,
+        on_progress=handle_progress,
+        on_finished=lambda run_id, result: finished.set_result(time.perf_counter()),
+    )
+    finished_at = await finished
+    started_at = started.result() if started.done() else finished_at
+    return started_at - pressed, finished_at - pressed
+
+
+async def _measure_load(backend: str, runs: int, playbooks: int, max_concurrent_runs: int, hosts: int, latency: float) -> dict:
+    loop = asyncio.get_running_loop()
+    manager = AnsibleProcessManager(loop)
+    manager.configure(
+        max_concurrent_runs=max_concurrent_runs,
+        max_runs_per_inventory=None,
+        backend=backend,
+        runner=FakePlaybookRunner(hosts=hosts, tasks=3, latency=latency),
+    )
+    await manager.async_start_worker_pool()
+
+    # Latency: one run at a time, so nothing waits for a slot. The first run waits for a worker to be ready (to import
+    # ansible_runner, for the pool), it isn't counted.
+    await _run_fake_playbook(manager, "latency")
+    press_to_start = []
+    for _ in range(runs):
+        started, _ = await _run_fake_playbook(manager, "latency")
+        press_to_start.append(started)
+    # The forked and pool workers send their result with the time they sent it, the loop measures its transfer
+    completion = metrics.snapshot().get(PHASE_IPC_TRANSFER)
+
+    # Throughput: many playbooks at once, queued behind max_concurrent_runs
+    begin = time.perf_counter()
+    await asyncio.gather(*(_run_fake_playbook(manager, f"playbook_{index}") for index in range(playbooks)))
+    elapsed = time.perf_counter() - begin
+
+    # Memory: Python memory the process manager keeps per run of a playbook, once the runs are over
+    await _run_fake_playbook(manager, "memory")
+    tracemalloc.start()
+    retained_before = tracemalloc.get_traced_memory()[0]
+    for _ in range(runs):
+        await _run_fake_playbook(manager, "memory")
+    retained = (tracemalloc.get_traced_memory()[0] - retained_before) / runs
+    tracemalloc.stop()
+
+    await manager.async_shutdown()
+    return {
+        "backend": backend,
+        "press_to_start": _percentiles(press_to_start),
+        "completion": {"p50": completion["p50"], "p95": completion["p95"]} if completion is not None else None,
+        "runs_per_second": playbooks / elapsed,
+        # Every slot busy all the time would finish the playbooks in this time
+        "ideal_seconds": -(-playbooks // max_concurrent_runs) * latency,
+        "seconds": elapsed,
+        # ru_maxrss is in KiB on Linux, it covers the largest reaped child (a forked or pool worker).
+        "max_child_rss_kib": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        "retained_bytes_per_run": retained,
+    }
+
+
+def benchmark_load(backends: list, runs: int, playbooks: int, max_concurrent_runs: int, hosts: int, latency: float) -> None:
+    """
+    Measures the process manager with a fake runner, per execution backend, each in a fresh interpreter:
+    the latency from a press to the first job event on the loop (runs one at a time), the latency of the result from
+    the worker to the loop, the throughput of many playbooks pressed at once, and the memory of a run: the peak RSS of
+    a worker, and the Python memory the manager keeps per run. Runs offline, no ansible is started.
+    """
+    results = {}
+    for backend in backends:
+        output = subprocess.run(
+            [
+                sys.executable, "-m", __spec__.name, "load-backend", backend, "--runs", str(runs), "--playbooks", str(playbooks),
+                "--max-concurrent-runs", str(max_concurrent_runs), "--hosts", str(hosts), "--latency", str(latency),
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+            cwd=REPOSITORY_ROOT,
+        ).stdout
+        results[backend] = json.loads(output.strip().splitlines()[-1])
+
+    def milliseconds(value: float | None) -> str:
+        return f"{value * 1000:.1f}" if value is not None else "-"
+
+    print(
+        f"{'backend':<12}{'start p50':>10}{'start p95':>10}{'done p50':>10}{'done p95':>10}"
+        f"{'runs/s':>9}{'ideal s':>9}{'took s':>8}{'child MiB':>11}{'kept B/run':>12}"
+    )
+    for backend, result in results.items():
+        completion = result["completion"] or {"p50": None, "p95": None}
+        print(
+            f"{backend:<12}{milliseconds(result['press_to_start']['p50']):>10}{milliseconds(result['press_to_start']['p95']):>10}"
+            f"{milliseconds(completion['p50']):>10}{milliseconds(completion['p95']):>10}"
+            f"{result['runs_per_second']:>9.1f}{result['ideal_seconds']:>9.2f}{result['seconds']:>8.2f}"
+            f"{result['max_child_rss_kib'] / 1024:>11.1f}{result['retained_bytes_per_run']:>12.0f}"
+        )
+    print(
+        f"start: press to the first job event on the loop (ms), done: result sent by the worker to received by the loop (ms, "
+        f"'-' where the loop runs the playbook itself); {playbooks} playbooks of {hosts} hosts taking {latency} s, "
+        f"{max_concurrent_runs} at a time"
+    )
+
+
+class _VirtualTimer:
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+class _VirtualLoop:
+    """Just enough of an event loop for the schedule timer, on a virtual clock which jumps from timer to timer."""
+    def __init__(self, now: float):
+        self.now = now
+        self._timers = []
+        self._sequence = itertools.count()
+
+    def call_later(self, delay: float, callback) -> _VirtualTimer:
+        timer = _VirtualTimer()
+        heapq.heappush(self._timers, (self.now + delay, next(self._sequence), timer, callback))
+        return timer
+
+    def run_until(self, end: float) -> int:
+        """Runs the timers due until "end", returns how often the loop woke up."""
+        wakeups = 0
+        while self._timers and self._timers[0][0] <= end:
+            when, _, timer, callback = heapq.heappop(self._timers)
+            if timer.cancelled:
+                continue
+            self.now = when
+            wakeups += 1
+            callback()
+        self.now = end
+        return wakeups
+
+
+def _simulate_schedule(playbooks: int, cron: CronExpression, hours: int, jitter: float, max_runs_per_minute: int | None, seed: int) -> dict:
+    """Runs the schedule timer on a virtual clock, with every playbook on the same cron schedule."""
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc).timestamp()
+    end = start + hours * 3600
+    loop = _VirtualLoop(start)
+    timer = AnsiblePlaybookScheduleTimer(
+        loop, max_runs_per_minute, time_zone=datetime.timezone.utc, clock=lambda: loop.now, random_source=random.Random(seed)
+    )
+    starts = []
+    for index in range(playbooks):
+        timer.add(f"playbook_{index}", AnsiblePlaybookSchedule(cron=cron, jitter=jitter), lambda: starts.append(loop.now))
+    wakeups = loop.run_until(end)
+    timer.shutdown()
+    # How late the runs started, after the latest minute their cron expression matched
+    matches = []
+    match = datetime.datetime.fromtimestamp(start, datetime.timezone.utc)
+    while match.timestamp() <= end:
+        match = cron.next_after(match)
+        matches.append(match.timestamp())
+    delays = sorted(started - matches[bisect.bisect_right(matches, started) - 1] for started in starts)
+    per_window = collections.Counter(int(started // 10) for started in starts)
+    per_minute = collections.Counter(int(started // 60) for started in starts)
+    return {
+        "runs": len(starts),
+        "wakeups": wakeups,
+        "peak_per_10s": max(per_window.values(), default=0),
+        "peak_per_minute": max(per_minute.values(), default=0),
+        "delay": _percentiles(delays),
+        "max_delay": delays[-1] if delays else 0.0,
+    }
+
+
+def benchmark_schedule(playbooks: int, cron: str, hours: int, jitter: float, max_runs_per_minute: int, seed: int) -> None:
+    """
+    Compares how the runs of many playbooks on the same cron schedule are spread: started right when the expression
+    matches, with jitter, and with jitter and the rate limit. Simulated on a virtual clock, nothing runs.
+    """
+    cron_expression = CronExpression.parse(cron)
+    print(f"{'schedule':<22}{'runs':>7}{'wakeups':>9}{'peak/10s':>10}{'peak/min':>10}{'delay p50':>11}{'p95':>8}{'max':>8}")
+    for name, schedule_jitter, rate in (
+        ("exact", 0.0, None),
+        ("jitter", jitter, None),
+        ("jitter + rate limit", jitter, max_runs_per_minute),
+    ):
+        result = _simulate_schedule(playbooks, cron_expression, hours, schedule_jitter, rate, seed)
+        print(
+            f"{name:<22}{result['runs']:>7}{result['wakeups']:>9}{result['peak_per_10s']:>10}{result['peak_per_minute']:>10}"
+            f"{result['delay']['p50']:>11.1f}{result['delay']['p95']:>8.1f}{result['max_delay']:>8.1f}"
+        )
+    print(
+        f"{playbooks} playbooks on \"{cron}\" for {hours} hours, jitter up to {jitter:.0f} s, rate limit {max_runs_per_minute} "
+        f"runs per minute; delay: seconds from the match of the expression to the start of the run"
+    )
+
+
+# What importing the component may take, on top of what Home Assistant has imported already
+DEFAULT_IMPORT_BUDGET_MS = 150.0
+# Modules which are imported when a playbook runs, not when the component is set up
+LAZY_IMPORTS = ("ansible", "ansible_runner")
+# Imported by Home Assistant before it sets up a platform, not counted against the budget
+_HOME_ASSISTANT_IMPORTS = (
+    "asyncio", "concurrent.futures", "json", "logging", "multiprocessing", "sqlite3",
+    "voluptuous", "homeassistant.core", "homeassistant.helpers.config_validation", "homeassistant.helpers.dispatcher",
+    "homeassistant.components.button", "homeassistant.components.sensor",
+)
+# Without Home Assistant, the modules of the platforms which don't import it
+_PLATFORM_MODULES = ("button", "sensor")
+_CORE_MODULES = (
+    "process_manager", "history", "result_cache", "result_store", "playbook_group", "runtime_directories", "metrics",
+    "schedules", "playbook_paths", "vault_secrets", "shards", "artifacts", "shared_services",
+)
+_IMPORTTIME_MARKER = "ansible_playbook: importing the component"
+
+
+def _importtime_script() -> str:
+    """The script measured by "benchmark_importtime", it marks on stderr where the component's imports begin."""
+    return "\n".join([
+        "import importlib, importlib.util, sys",
+        f"for name in {_HOME_ASSISTANT_IMPORTS!r}:",
+        "    try:",
+        "        importlib.import_module(name)",
+        "    except ImportError:",
+        "        pass",
+        f"modules = {_PLATFORM_MODULES!r} if importlib.util.find_spec('homeassistant') else {_CORE_MODULES!r}",
+        f"print({_IMPORTTIME_MARKER!r}, file=sys.stderr, flush=True)",
+        "for name in modules:",
+        f"    importlib.import_module({COMPONENT!r} + '.' + name)",
+        "print(' '.join(modules))",
+    ])
+
+
+def eagerly_imported_modules() -> list:
+    """The modules of LAZY_IMPORTS imported along with the component, in a fresh interpreter as in "benchmark_importtime"."""
+    script = "\n".join([
+        _importtime_script(),
+        f"print(' '.join(sorted(name for name in sys.modules if name.split('.')[0] in {LAZY_IMPORTS!r})))",
+    ])
+    completed = subprocess.run([sys.executable, "-c", script], check=True, capture_output=True, text=True, cwd=REPOSITORY_ROOT)
+    return completed.stdout.splitlines()[-1].split()
+
+
+def benchmark_importtime(budget_ms: float, top: int) -> bool:
+    """
+    Measures the import of the component with "python -X importtime", in a fresh interpreter which has imported what
+    Home Assistant imports before setting up a platform. Fails (returns False) if ansible is imported along or the
+    imports take longer than "budget_ms" milliseconds.
+    """
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _importtime_script()],
+        check=True,
+        capture_output=True,
+        text=True,
+        cwd=REPOSITORY_ROOT,
+    )
+    lines = completed.stderr.splitlines()
+    lines = lines[lines.index(_IMPORTTIME_MARKER) + 1:]
+    # "import time: self [us] | cumulative | imported package", the package is indented by its depth
+    imports = []
+    for line in lines:
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|", 2)
+        if self_us.strip().isdigit():
+            imports.append((int(self_us) / 1000, name.strip()))
+    total_ms = sum(milliseconds for milliseconds, _ in imports)
+    lazy = sorted({name for _, name in imports if name.split(".")[0] in LAZY_IMPORTS})
+
+    print(f"imported {completed.stdout.strip()}: {len(imports)} modules in {total_ms:.1f} ms (budget {budget_ms:.0f} ms)")
+    for milliseconds, name in sorted(imports, reverse=True)[:top]:
+        print(f"{milliseconds:>9.1f} ms  {name}")
+    if lazy:
+        print(f"FAILED: imported {', '.join(lazy)}, which must only be imported when a playbook runs")
+    if total_ms > budget_ms:
+        print(f"FAILED: the imports took {total_ms:.1f} ms, more than the budget of {budget_ms:.0f} ms")
+    return not lazy and total_ms <= budget_ms
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    backends_parser = subparsers.add_parser("backends", help="compare the execution backends")
+    backends_parser.add_argument("--runs", type=int, default=5)
+    backends_parser.add_argument("--ballast-mb", type=int, default=256)
+
+    backend_parser = subparsers.add_parser("backend", help="measure a single execution backend, prints JSON")
+    backend_parser.add_argument("backend", choices=BACKENDS)
+    backend_parser.add_argument("--runs", type=int, default=5)
+    backend_parser.add_argument("--ballast-mb", type=int, default=256)
+
+    stats_parser = subparsers.add_parser("stats", help="measure the transformation of runner stats into results")
+    stats_parser.add_argument("--hosts", type=int, nargs="+", default=[1000, 10000])
+    stats_parser.add_argument("--repeat", type=int, default=20)
+
+    state_writes_parser = subparsers.add_parser("state-writes", help="measure the state write throughput of the sensors")
+    state_writes_parser.add_argument("--writes", type=int, default=100000)
+
+    stress_parser = subparsers.add_parser("stress", help="press concurrently against a fake runner and check the process manager")
+    stress_parser.add_argument("--backend", choices=BACKENDS, default=BACKEND_FORK)
+    stress_parser.add_argument("--presses", type=int, default=500)
+    stress_parser.add_argument("--entities", type=int, default=20)
+    stress_parser.add_argument("--max-concurrent-runs", type=int, default=4)
+    stress_parser.add_argument("--run-seconds", type=float, default=0.02)
+    stress_parser.add_argument("--stop-ratio", type=float, default=0.05)
+    stress_parser.add_argument("--pollers", type=int, default=4)
+    stress_parser.add_argument("--seed", type=int, default=0)
+
+    load_parser = subparsers.add_parser("load", help="measure latency, throughput and memory of the backends with a fake runner")
+    load_parser.add_argument("--backends", choices=BACKENDS, nargs="+", default=BACKENDS)
+    load_backend_parser = subparsers.add_parser("load-backend", help="measure a single backend with a fake runner, prints JSON")
+    load_backend_parser.add_argument("backend", choices=BACKENDS)
+    for load_arguments in (load_parser, load_backend_parser):
+        load_arguments.add_argument("--runs", type=int, default=50)
+        load_arguments.add_argument("--playbooks", type=int, default=100)
+        load_arguments.add_argument("--max-concurrent-runs", type=int, default=8)
+        load_arguments.add_argument("--hosts", type=int, default=10)
+        load_arguments.add_argument("--latency", type=float, default=0.1)
+
+    schedule_parser = subparsers.add_parser("schedule", help="simulate how the schedule timer spreads the runs of many playbooks")
+    schedule_parser.add_argument("--playbooks", type=int, default=30)
+    schedule_parser.add_argument("--cron", default="0 * * * *")
+    schedule_parser.add_argument("--hours", type=int, default=24)
+    schedule_parser.add_argument("--jitter", type=float, default=DEFAULT_SCHEDULE_JITTER)
+    schedule_parser.add_argument("--max-runs-per-minute", type=int, default=DEFAULT_MAX_SCHEDULED_RUNS_PER_MINUTE)
+    schedule_parser.add_argument("--seed", type=int, default=0)
+
+    importtime_parser = subparsers.add_parser("importtime", help="check that importing the component is fast and doesn't import ansible")
+    importtime_parser.add_argument("--budget-ms", type=float, default=DEFAULT_IMPORT_BUDGET_MS)
+    importtime_parser.add_argument("--top", type=int, default=10)
+
+    args = parser.parse_args()
+    if args.benchmark == "backends":
+        benchmark_backends(args.runs, args.ballast_mb)
+    elif args.benchmark == "backend":
+        print(json.dumps(benchmark_backend(args.backend, args.runs, args.ballast_mb)))
+    elif args.benchmark == "stats":
+        benchmark_stats(args.hosts, args.repeat)
+    elif args.benchmark == "state-writes":
+        benchmark_state_writes(args.writes)
+    elif args.benchmark == "stress":
+        benchmark_stress(
+            args.backend, args.presses, args.entities, args.max_concurrent_runs, args.run_seconds, args.stop_ratio, args.pollers, args.seed
+        )
+    elif args.benchmark == "load":
+        benchmark_load(args.backends, args.runs, args.playbooks, args.max_concurrent_runs, args.hosts, args.latency)
+    elif args.benchmark == "load-backend":
+        print(json.dumps(asyncio.run(
+            _measure_load(args.backend, args.runs, args.playbooks, args.max_concurrent_runs, args.hosts, args.latency)
+        )))
+    elif args.benchmark == "schedule":
+        benchmark_schedule(args.playbooks, args.cron, args.hours, args.jitter, args.max_runs_per_minute, args.seed)
+    elif args.benchmark == "importtime":
+        if not benchmark_importtime(args.budget_ms, args.top):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
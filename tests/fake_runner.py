@@ -0,0 +1,155 @@
+import asyncio
+import random
+import time
+from typing import Callable, Dict, List, NamedTuple, Tuple
+
+from custom_components.ansible_playbook.ansible_playbook_runner import PlaybookRunner, RunTimer, STATS_KEYS, STATUS_CANCELED
+from custom_components.ansible_playbook.trace import span
+
+
+# How often a fake run checks its cancel callback while it waits
+CANCEL_POLL_INTERVAL = 0.01
+
+
+class FakeRunnerResult(NamedTuple):
+    """Takes the place of the ansible-runner Runner in the result of "FakePlaybookRunner.execute"."""
+    status: str
+    stats: dict | None
+
+
+class FakePlaybookRunner(PlaybookRunner):
+    """
+    Runs no ansible at all, for benchmarks and stress tests: it emits the job events of a playbook of "tasks" tasks on
+    "hosts" hosts (host0000, host0001, ...) and returns their stats, just like ansible-runner would.
+
+    The first event comes after "startup" seconds, the tasks take "latency" seconds together. Each task fails on a
+    host with the probability "failure_rate", or finds it unreachable with "unreachable_rate"; the host sits out the
+    remaining tasks then, and the run fails. The outcome only depends on "seed", the playbook and the limit, so runs
+    are reproducible. "limit" picks hosts by name, patterns aren't supported.
+    """
+    def __init__(
+        self,
+        hosts: int = 1,
+        tasks: int = 1,
+        latency: float = 0.0,
+        startup: float = 0.0,
+        failure_rate: float = 0.0,
+        unreachable_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        self._hosts = hosts
+        self._tasks = tasks
+        self._latency = float(latency)
+        self._startup = float(startup)
+        self._failure_rate = failure_rate
+        self._unreachable_rate = unreachable_rate
+        self._seed = seed
+
+    def preload(self) -> None:
+        """There is nothing to import."""
+
+    def host_names(self, limit: List[str] | None = None) -> List[str]:
+        hosts = [f"host{index:04d}" for index in range(self._hosts)]
+        if limit is None:
+            return hosts
+        selected = set(limit)
+        return [host for host in hosts if host in selected]
+
+    def timeline(self, playbook: str, limit: List[str] | None = None) -> Tuple[List[dict | float], str, dict]:
+        """
+        The job events of a run, with the seconds to wait in between (floats), followed by the final status and stats.
+        """
+        hosts = self.host_names(limit)
+        randomizer = random.Random(f"{self._seed}:{playbook}:{','.join(hosts)}")
+        counters: Dict[str, Dict[str, int]] = {key: {} for key in STATS_KEYS}
+        timeline: List[dict | float] = [
+            self._startup,
+            {"event": "playbook_on_start", "event_data": {"playbook": playbook}},
+            {"event": "playbook_on_play_start", "event_data": {"play": "Fake play"}},
+        ]
+        active = list(hosts)
+        for task_index in range(self._tasks):
+            task = f"Fake task {task_index}"
+            timeline.append({"event": "playbook_on_task_start", "event_data": {"task": task, "task_action": "debug"}})
+            timeline += [{"event": "runner_on_start", "event_data": {"host": host, "task": task}} for host in active]
+            timeline.append(self._latency / self._tasks if self._tasks else 0.0)
+            for host in list(active):
+                draw = randomizer.random()
+                if draw < self._unreachable_rate:
+                    event, counter = "runner_on_unreachable", "dark"
+                    active.remove(host)
+                elif draw < self._unreachable_rate + self._failure_rate:
+                    event, counter = "runner_on_failed", "failures"
+                    active.remove(host)
+                else:
+                    event, counter = "runner_on_ok", "ok"
+                timeline.append({"event": event, "event_data": {"host": host, "task": task}})
+                counters[counter][host] = counters[counter].get(host, 0) + 1
+        for host in hosts:
+            counters["processed"][host] = 1
+        timeline.append({"event": "playbook_on_stats", "event_data": dict(counters)})
+        status = "failed" if counters["failures"] or counters["dark"] else "successful"
+        return timeline, status, counters
+
+    def execute(
+        self,
+        private_data_dir: str,
+        playbook: str,
+        vault_password_file: str | None,
+        event_handler: Callable[[dict], bool] = None,
+        limit: List[str] | None = None,
+        envvars: Dict[str, str] | None = None,
+        cancel_callback: Callable[[], bool] = None,
+        tags: List[str] | None = None,
+        extra_vars: dict | None = None,
+        vault_password: str | None = None,
+        artifact_dir: str | None = None,
+    ) -> FakeRunnerResult:
+        with span("FakePlaybookRunner.execute", playbook=playbook):
+            timeline, status, stats = self.timeline(playbook, limit)
+            for step in timeline:
+                if isinstance(step, float):
+                    if not _sleep(step, cancel_callback):
+                        return FakeRunnerResult(STATUS_CANCELED, None)
+                elif event_handler is not None:
+                    event_handler(step)
+            return FakeRunnerResult(status, stats)
+
+    async def async_execute(
+        self,
+        private_data_dir: str,
+        playbook: str,
+        vault_password_file: str | None,
+        event_handler: Callable[[dict], None] = None,
+        timer: RunTimer = None,
+        limit: List[str] | None = None,
+        envvars: Dict[str, str] | None = None,
+        tags: List[str] | None = None,
+        extra_vars: dict | None = None,
+        artifact_dir: str | None = None,
+    ) -> Tuple[str, dict | None]:
+        with span("FakePlaybookRunner.async_execute", playbook=playbook):
+            timer = timer if timer is not None else RunTimer()
+            timer.spawned()
+            timeline, status, stats = self.timeline(playbook, limit)
+            for step in timeline:
+                if isinstance(step, float):
+                    await asyncio.sleep(step)
+                    continue
+                timer.handle_event(step)
+                if event_handler is not None:
+                    event_handler(step)
+            timer.finished()
+            return status, stats
+
+
+def _sleep(seconds: float, cancel_callback: Callable[[], bool] | None) -> bool:
+    """Sleeps for "seconds", returns False as soon as "cancel_callback" tells to cancel."""
+    deadline = time.monotonic() + seconds
+    while True:
+        if cancel_callback is not None and cancel_callback():
+            return False
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return True
+        time.sleep(min(remaining, CANCEL_POLL_INTERVAL))
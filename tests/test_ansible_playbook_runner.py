@@ -0,0 +1,24 @@
+"""The ansible-runner command line of the subprocess backend."""
+import os
+import shlex
+
+from custom_components.ansible_playbook.ansible_playbook_runner import build_runner_command, write_limit_file
+
+
+def _cmdline(command: list) -> list:
+    return shlex.split(command[command.index("--cmdline") + 1])
+
+
+def test_vault_password_file_with_spaces():
+    command = build_runner_command("/config/my playbooks", "main.yaml", "/config/my playbooks/project/vault pass.txt", tags=["a b"])
+    assert _cmdline(command) == ["--vault-password-file", "/config/my playbooks/project/vault pass.txt", "--tags", "a b"]
+
+
+def test_long_limit_in_a_file(tmp_path):
+    assert write_limit_file(str(tmp_path), ["host1", "host2"]) is None
+    hosts = [f"host{index:05d}.example.com" for index in range(10000)]
+    path = write_limit_file(str(tmp_path), hosts)
+    assert os.path.dirname(path) == str(tmp_path / "artifacts")
+    assert open(path).read().splitlines() == hosts
+    command = build_runner_command(str(tmp_path), "main.yaml", None, limit=hosts, limit_file=path)
+    assert command[command.index("--limit") + 1] == "@" + path
@@ -0,0 +1,53 @@
+"""Pruning the artifacts of the runs of a playbook."""
+import os
+import time
+
+from custom_components.ansible_playbook.artifacts import ARTIFACT_STATUS_FILE, STALE_ARTIFACT_AGE, AnsibleArtifacts
+
+
+def _run(directory: str, name: str, finished_at: float | None, modified_at: float | None = None) -> str:
+    """Writes the artifacts of a run, with a status file if it finished."""
+    path = os.path.join(directory, name)
+    os.makedirs(path)
+    with open(os.path.join(path, "stdout"), "w") as file:
+        file.write("x" * 100)
+    if finished_at is not None:
+        status_file = os.path.join(path, ARTIFACT_STATUS_FILE)
+        with open(status_file, "w") as file:
+            file.write("successful")
+        os.utime(status_file, (finished_at, finished_at))
+    if modified_at is not None:
+        os.utime(path, (modified_at, modified_at))
+    return path
+
+
+def test_prune_keeps_the_latest_finished_runs(tmp_path):
+    artifacts = AnsibleArtifacts(retention=2)
+    directory = artifacts.directory(str(tmp_path), "web")
+    assert directory == os.path.join(str(tmp_path), "artifacts", "web")
+    now = time.time()
+    for index in range(4):
+        _run(directory, f"finished{index}", now - 100 + index)
+    # Still running, and never finished
+    _run(directory, "running", None)
+    _run(directory, "stale", None, modified_at=now - STALE_ARTIFACT_AGE - 1)
+
+    assert artifacts.usage("web") is None
+    usage = artifacts.prune(str(tmp_path), "web")
+    assert sorted(os.listdir(directory)) == ["finished2", "finished3", "running"]
+    # The stdout files and the status files of the remaining runs
+    assert usage == 3 * 100 + 2 * len("successful")
+    assert artifacts.usage("web") == usage
+
+
+def test_prune_under_a_root(tmp_path):
+    artifacts = AnsibleArtifacts(root=str(tmp_path / "tmpfs"), retention=1)
+    directory = artifacts.directory(str(tmp_path / "playbook"), "web")
+    assert directory == os.path.join(str(tmp_path), "tmpfs", "web")
+    # Nothing to prune yet
+    assert artifacts.prune(str(tmp_path / "playbook"), "web") == 0
+    now = time.time()
+    _run(directory, "first", now - 10)
+    _run(directory, "second", now)
+    artifacts.prune(str(tmp_path / "playbook"), "web")
+    assert os.listdir(directory) == ["second"]
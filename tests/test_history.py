@@ -0,0 +1,86 @@
+"""The persistent run history: retention, queries and failed writes."""
+import asyncio
+import sqlite3
+import time
+
+from custom_components.ansible_playbook import history as history_module
+from custom_components.ansible_playbook.history import AnsiblePlaybookHistory, AnsiblePlaybookRunRecord
+
+
+def _record(entity_id: str, started_at: float, status: str = "successful") -> AnsiblePlaybookRunRecord:
+    return AnsiblePlaybookRunRecord(entity_id, "main.yml", started_at, started_at + 2, status, {"host": (1, 0, 0, 0, 0, 0, 0)})
+
+
+async def _history(path: str, **kwargs) -> AnsiblePlaybookHistory:
+    history = AnsiblePlaybookHistory(asyncio.get_running_loop(), path, **kwargs)
+    await history.async_load()
+    return history
+
+
+def test_retention(tmp_path):
+    path = str(tmp_path / "history.db")
+
+    async def scenario() -> list:
+        now = time.time()
+        history = await _history(path, max_runs_per_entity=3, max_age_days=1)
+        # Older than a day
+        history.record(_record("other", now - 2 * 24 * 3600))
+        for index in range(5):
+            history.record(_record("entity", now - 100 + index))
+        await history.async_close()
+        return [(entity_id, round(started_at - now)) for entity_id, started_at in sqlite3.connect(path).execute(
+            "SELECT entity_id, started_at FROM runs ORDER BY started_at"
+        )]
+
+    assert asyncio.run(scenario()) == [("entity", -98), ("entity", -97), ("entity", -96)]
+
+
+def test_query_and_statistics(tmp_path):
+    path = str(tmp_path / "history.db")
+
+    async def scenario() -> tuple:
+        base = time.time() - 1000
+        history = await _history(path)
+        for started_at, status in ((100.0, "successful"), (200.0, "failed"), (300.0, "successful")):
+            history.record(_record("entity", base + started_at, status))
+        history.record(_record("other", time.time()))
+        await history.async_close()
+        # A new instance reads what the first one wrote, plus its own unwritten runs
+        history = await _history(path)
+        history.record(_record("entity", base + 400.0))
+        records = await history.async_query("entity", since=base + 150, until=base + 450)
+        statistics = history.statistics("entity")
+        await history.async_close()
+        return [record.status for record in records], statistics
+
+    statuses, statistics = asyncio.run(scenario())
+    assert statuses == ["successful", "successful", "failed"]
+    assert statistics.durations == [2.0, 2.0, 2.0, 2.0]
+    assert statistics.success_rate == 75.0
+
+
+def test_failed_write_is_retried(tmp_path, monkeypatch):
+    path = str(tmp_path / "history.db")
+    monkeypatch.setattr(history_module, "HISTORY_FLUSH_DELAY", 0.01)
+
+    async def scenario() -> list:
+        history = await _history(path)
+        write = history._write
+        failures = []
+
+        def failing_write(records):
+            if not failures:
+                failures.append(records)
+                raise sqlite3.OperationalError("database is locked")
+            write(records)
+
+        history._write = failing_write
+        history.record(_record("entity", time.time()))
+        await asyncio.sleep(0.2)
+        records = await history.async_query("entity")
+        await history.async_close()
+        return records
+
+    records = asyncio.run(scenario())
+    assert len(records) == 1
+    assert [row for row in sqlite3.connect(path).execute("SELECT COUNT(*) FROM runs")] == [(1,)]
@@ -0,0 +1,7 @@
+"""Keeps ansible out of the import of the component."""
+from .benchmark import LAZY_IMPORTS, eagerly_imported_modules
+
+
+def test_ansible_is_imported_lazily():
+    # In a fresh interpreter; the wall clock budget is left to "python -m tests.benchmark importtime"
+    assert eagerly_imported_modules() == [], f"{', '.join(LAZY_IMPORTS)} must only be imported when a playbook runs"
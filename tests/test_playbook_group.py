@@ -0,0 +1,30 @@
+"""The generated playbook of playbook groups."""
+import os
+
+from custom_components.ansible_playbook.playbook_group import write_group_playbook
+from custom_components.ansible_playbook.process_manager import AnsiblePlaybookExecution
+
+
+def test_write_group_playbook(tmp_path):
+    project = tmp_path / "project"
+    project.mkdir()
+    members = [str(project / "first.yml"), str(project / "second.yml")]
+    path = write_group_playbook(str(tmp_path / "groups"), "site", members)
+    # Written outside of the project, importing the members by their absolute paths
+    assert os.path.dirname(path) == str(tmp_path / "groups")
+    assert os.listdir(project) == []
+    content = open(path).read()
+    assert content.index(f"- import_playbook: \"{members[0]}\"") < content.index(f"- import_playbook: \"{members[1]}\"")
+    # Not written again while it is up to date
+    mtime_ns = os.stat(path).st_mtime_ns
+    os.utime(path, ns=(0, 0))
+    assert write_group_playbook(str(tmp_path / "groups"), "site", members) == path
+    assert os.stat(path).st_mtime_ns == 0 != mtime_ns
+
+
+def test_group_gathering_respects_ansible_cfg(tmp_path):
+    (tmp_path / "project").mkdir()
+    execution = AnsiblePlaybookExecution("group", str(tmp_path), "group_site.yml", None, members=["first", "second"])
+    assert execution._build_envvars(None) == {"ANSIBLE_GATHERING": "smart"}
+    (tmp_path / "project" / "ansible.cfg").write_text("[defaults]\ngathering = explicit\n")
+    assert execution._build_envvars(None) is None
@@ -0,0 +1,92 @@
+"""Runs the trigger mode handling of the process manager with the fake runner."""
+import asyncio
+import tempfile
+
+from custom_components.ansible_playbook.ansible_playbook_runner import BACKEND_SUBPROCESS
+from custom_components.ansible_playbook.process_manager import AnsibleProcessManager, AnsibleTaskState, TRIGGER_QUEUE_ONE
+from .fake_runner import FakePlaybookRunner
+
+
+def _manager() -> AnsibleProcessManager:
+    manager = AnsibleProcessManager(asyncio.get_running_loop())
+    manager.configure(
+        max_concurrent_runs=2,
+        max_runs_per_inventory=None,
+        backend=BACKEND_SUBPROCESS,
+        runner=FakePlaybookRunner(hosts=4, latency=0.1),
+    )
+    return manager
+
+
+def _run_task(manager: AnsibleProcessManager, results: list, **kwargs) -> AnsibleTaskState:
+    return manager.run_task(
+        entity_id="entity",
+        base_dir=tempfile.gettempdir(),
+        playbook_file="main.yaml",
+        vault_password_file=None,
+        on_finished=lambda run_id, result: results.append((run_id, result)),
+        **kwargs,
+    )
+
+
+async def _wait_until_over(manager: AnsibleProcessManager) -> None:
+    async with asyncio.timeout(10):
+        while manager.get_task_state("entity") != AnsibleTaskState.NOT_RUNNING:
+            await asyncio.sleep(0.01)
+    await manager.async_shutdown()
+
+
+async def _run_presses(limits: list) -> list:
+    """Presses the same entity once per limit with "queue_one", returns the run ids and results of the runs."""
+    manager = _manager()
+    results = []
+    task_states = [_run_task(manager, results, limit=limit, trigger_mode=TRIGGER_QUEUE_ONE) for limit in limits]
+    assert task_states == [AnsibleTaskState.RUNNING] * len(limits)
+    await _wait_until_over(manager)
+    return results
+
+
+def test_queue_one_coalesces_limits():
+    results = asyncio.run(_run_presses([["host0000"], ["host0001"], ["host0002"]]))
+    # The presses during the first run are coalesced into a single follow-up run over the union of their limits
+    assert [run_id for run_id, _ in results] == ["entity", "entity"]
+    assert [sorted(result.hosts) for _, result in results] == [["host0000"], ["host0001", "host0002"]]
+    # The result tells the limit the run ran on, a result cached for one of the presses must not cover the others
+    assert [result.limit for _, result in results] == [["host0000"], ["host0001", "host0002"]]
+
+
+def test_queue_one_without_limit_runs_on_all_hosts():
+    results = asyncio.run(_run_presses([["host0000"], ["host0001"], None]))
+    assert [sorted(result.hosts) for _, result in results] == [["host0000"], ["host0000", "host0001", "host0002", "host0003"]]
+
+
+def test_parameterized_runs_are_dropped_once_over():
+    async def scenario() -> tuple:
+        manager = _manager()
+        results = []
+        _run_task(manager, results)
+        for version in range(3):
+            _run_task(manager, results, extra_vars={"version": version})
+        _run_task(manager, results, tags=["web"], shards=[["host0000"], ["host0001"], ["host0002"]])
+        await _wait_until_over(manager)
+        return results, list(manager._sub_processes)
+
+    results, run_ids = asyncio.run(scenario())
+    assert len(results) == 5
+    assert run_ids == ["entity"]
+
+
+def test_stopped_parameterized_runs_are_dropped():
+    async def scenario() -> tuple:
+        manager = _manager()
+        results = []
+        task_states = [_run_task(manager, results, tags=[f"tag{index}"]) for index in range(4)]
+        assert task_states == [AnsibleTaskState.RUNNING] * 2 + [AnsibleTaskState.QUEUED] * 2
+        assert manager.stop_task("entity") == AnsibleTaskState.RUNNING
+        await _wait_until_over(manager)
+        return results, list(manager._sub_processes)
+
+    results, run_ids = asyncio.run(scenario())
+    # The queued runs are dropped without a result
+    assert [result.status for _, result in results] == ["canceled", "canceled"]
+    assert run_ids == []
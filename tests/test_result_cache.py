@@ -0,0 +1,66 @@
+"""Fingerprinting the inputs of a run and caching the results of successful runs."""
+import os
+
+from custom_components.ansible_playbook import result_cache as result_cache_module
+from custom_components.ansible_playbook.process_manager import AnsiblePlaybookRunResult, AnsiblePlaybookSummary
+from custom_components.ansible_playbook.result_cache import AnsiblePlaybookFingerprinter, AnsiblePlaybookResultCache
+
+
+def _result(status: str = "successful") -> AnsiblePlaybookRunResult:
+    return AnsiblePlaybookRunResult({}, AnsiblePlaybookSummary(), status)
+
+
+def test_fingerprint_follows_the_inputs(tmp_path):
+    (tmp_path / "project").mkdir()
+    playbook = tmp_path / "project" / "main.yml"
+    playbook.write_text("- hosts: all\n")
+    fingerprinter = AnsiblePlaybookFingerprinter()
+
+    def fingerprint(**kwargs) -> str:
+        arguments = {"extra_vars": {"version": 1}, "vault_password_file": None, "limit": ["web"], "tags": None}
+        arguments.update(kwargs)
+        return fingerprinter.fingerprint(str(tmp_path), "main.yml", **arguments)
+
+    first = fingerprint()
+    assert fingerprint() == first
+    assert fingerprint(extra_vars={"version": 2}) != first
+    assert fingerprint(limit=["db"]) != first
+    assert fingerprint(tags=["web"]) != first
+    # Touching a file doesn't change the fingerprint, changing it does
+    os.utime(playbook, ns=(0, 0))
+    assert fingerprint() == first
+    playbook.write_text("- hosts: web\n")
+    assert fingerprint() != first
+    changed = fingerprint()
+    # The artifacts written by ansible-runner are not part of it
+    (tmp_path / "artifacts").mkdir()
+    (tmp_path / "artifacts" / "stdout").write_text("ok")
+    assert fingerprint() == changed
+    # Files which are gone are
+    playbook.unlink()
+    assert fingerprint() != changed
+
+
+def test_cached_results_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(result_cache_module.time, "monotonic", lambda: now[0])
+    cache = AnsiblePlaybookResultCache()
+    result = _result()
+    cache.put("fingerprint", result)
+    now[0] += 60
+    assert cache.get("fingerprint", ttl=60) is result
+    now[0] += 1
+    assert cache.get("fingerprint", ttl=60) is None
+    # An expired result is dropped, not only hidden
+    assert cache.get("fingerprint", ttl=3600) is None
+
+
+def test_least_recently_used_results_are_evicted():
+    cache = AnsiblePlaybookResultCache(max_entries=2)
+    cache.put("first", _result())
+    cache.put("second", _result())
+    assert cache.get("first", ttl=60) is not None
+    cache.put("third", _result())
+    assert cache.get("second", ttl=60) is None
+    assert cache.get("first", ttl=60) is not None
+    assert cache.get("third", ttl=60) is not None
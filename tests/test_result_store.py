@@ -0,0 +1,29 @@
+"""The latest per-host results of the playbooks."""
+from custom_components.ansible_playbook.process_manager import AnsiblePlaybookResult
+from custom_components.ansible_playbook.result_store import AnsiblePlaybookResultStore
+
+
+def test_update_tells_new_and_changed_hosts():
+    store = AnsiblePlaybookResultStore()
+    assert store.update("button", {
+        "web.1": AnsiblePlaybookResult("web.1", ok=1),
+        "web_1": AnsiblePlaybookResult("web_1", ok=1),
+    }) == (["web.1", "web_1"], [])
+    # Hosts whose names slugify alike are still kept apart
+    assert store.update("button", {
+        "web.1": AnsiblePlaybookResult("web.1", ok=1),
+        "web_1": AnsiblePlaybookResult("web_1", failures=1),
+        "db": AnsiblePlaybookResult("db", ok=1),
+    }) == (["db"], ["web_1"])
+    assert store.get("button", "web.1").ok == 1
+    assert store.get("button", "web_1").failures == 1
+    assert store.hosts("button") == ["web.1", "web_1", "db"]
+
+
+def test_buttons_are_kept_apart():
+    store = AnsiblePlaybookResultStore()
+    store.update("first", {"web": AnsiblePlaybookResult("web", changed=1)})
+    assert store.update("second", {"web": AnsiblePlaybookResult("web", changed=1)}) == (["web"], [])
+    assert store.get("first", "other") is None
+    assert store.get("third", "web") is None
+    assert store.hosts("third") == []
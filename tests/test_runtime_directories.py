@@ -0,0 +1,57 @@
+"""The fact cache and the ControlPersist sockets kept across runs."""
+import os
+import socket
+import stat
+
+from custom_components.ansible_playbook.runtime_directories import AnsibleRuntimeDirectories, project_settings
+
+
+def _private_data_dir(tmp_path, ansible_cfg: str | None = None) -> str:
+    project_dir = tmp_path / "playbook" / "project"
+    project_dir.mkdir(parents=True)
+    if ansible_cfg is not None:
+        (project_dir / "ansible.cfg").write_text(ansible_cfg)
+    return str(tmp_path / "playbook")
+
+
+def test_off_by_default(tmp_path):
+    assert AnsibleRuntimeDirectories(str(tmp_path / "runtime")).envvars(_private_data_dir(tmp_path)) == {}
+    assert not os.path.exists(tmp_path / "runtime")
+
+
+def test_envvars(tmp_path):
+    private_data_dir = _private_data_dir(tmp_path)
+    envvars = AnsibleRuntimeDirectories(str(tmp_path / "runtime"), fact_cache_ttl=600, control_persist=60).envvars(private_data_dir)
+    assert envvars["ANSIBLE_GATHERING"] == "smart"
+    assert envvars["ANSIBLE_CACHE_PLUGIN_TIMEOUT"] == "600"
+    assert "ControlPersist=60s" in envvars["ANSIBLE_SSH_ARGS"]
+    # Only readable by Home Assistant, one directory per private data dir
+    for directory in (envvars["ANSIBLE_CACHE_PLUGIN_CONNECTION"], envvars["ANSIBLE_SSH_CONTROL_PATH_DIR"]):
+        assert stat.S_IMODE(os.stat(directory).st_mode) == 0o700
+    other = AnsibleRuntimeDirectories(str(tmp_path / "runtime"), fact_cache_ttl=600).envvars(_private_data_dir(tmp_path / "other"))
+    assert other["ANSIBLE_CACHE_PLUGIN_CONNECTION"] != envvars["ANSIBLE_CACHE_PLUGIN_CONNECTION"]
+
+
+def test_ansible_cfg_of_the_project_wins(tmp_path):
+    private_data_dir = _private_data_dir(tmp_path, "[defaults]\ngathering = explicit\n")
+    assert project_settings(private_data_dir) == {("defaults", "gathering")}
+    envvars = AnsibleRuntimeDirectories(str(tmp_path / "runtime"), fact_cache_ttl=600, control_persist=60).envvars(private_data_dir)
+    # The fact cache is left out, ControlPersist is not
+    assert "ANSIBLE_GATHERING" not in envvars
+    assert "ANSIBLE_SSH_CONTROL_PATH_DIR" in envvars
+
+
+def test_stale_control_sockets_are_removed(tmp_path):
+    runtime = AnsibleRuntimeDirectories(str(tmp_path / "runtime"), control_persist=60)
+    private_data_dir = _private_data_dir(tmp_path)
+    control_path_dir = runtime.envvars(private_data_dir)["ANSIBLE_SSH_CONTROL_PATH_DIR"]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale:
+        stale.bind(os.path.join(control_path_dir, "stale"))
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as listening:
+        listening.bind(os.path.join(control_path_dir, "listening"))
+        listening.listen()
+        # Cleaned up at most once per ControlPersist period
+        runtime.envvars(private_data_dir)
+        assert sorted(os.listdir(control_path_dir)) == ["listening", "stale"]
+        AnsibleRuntimeDirectories(str(tmp_path / "runtime"), control_persist=60).envvars(private_data_dir)
+        assert os.listdir(control_path_dir) == ["listening"]
@@ -0,0 +1,70 @@
+"""Cron expressions and the timer starting the scheduled runs."""
+import asyncio
+import datetime
+import random
+import zoneinfo
+
+import pytest
+
+from custom_components.ansible_playbook.schedules import AnsiblePlaybookSchedule, AnsiblePlaybookScheduleTimer, CronExpression
+
+BERLIN = zoneinfo.ZoneInfo("Europe/Berlin")
+
+
+def _next(expression: str, moment: datetime.datetime) -> datetime.datetime:
+    return CronExpression.parse(expression).next_after(moment)
+
+
+def test_february_29():
+    assert _next("0 0 29 2 *", datetime.datetime(2026, 1, 1)) == datetime.datetime(2028, 2, 29)
+    # Never matches
+    with pytest.raises(ValueError):
+        CronExpression.parse("0 0 30 2 *")
+
+
+def test_day_of_month_or_day_of_week():
+    # Both restricted: either one matches, 2026-01-02 is a Friday
+    assert _next("0 0 13 * 5", datetime.datetime(2026, 1, 1)) == datetime.datetime(2026, 1, 2)
+    # Only one restricted: that one has to match
+    assert _next("0 0 13 * *", datetime.datetime(2026, 1, 1)) == datetime.datetime(2026, 1, 13)
+    assert _next("0 0 * * 5", datetime.datetime(2026, 1, 3)) == datetime.datetime(2026, 1, 9)
+    # 7 is Sunday too
+    assert _next("0 0 * * 7", datetime.datetime(2026, 1, 1)) == datetime.datetime(2026, 1, 4)
+
+
+def test_daylight_saving_time():
+    schedule = AnsiblePlaybookSchedule(cron=CronExpression.parse("30 2 * * *"))
+    # 02:30 doesn't exist when the clocks go forward, the run starts an hour later instead of being skipped
+    planned = schedule.first_planned(datetime.datetime(2026, 3, 28, 12, tzinfo=BERLIN).timestamp(), BERLIN, None)
+    assert datetime.datetime.fromtimestamp(planned, BERLIN) == datetime.datetime(2026, 3, 29, 3, 30, tzinfo=BERLIN)
+    # 02:30 happens twice when the clocks go back, the run starts once
+    planned = schedule.first_planned(datetime.datetime(2026, 10, 24, 12, tzinfo=BERLIN).timestamp(), BERLIN, None)
+    following = schedule.next_planned(planned, planned + 30, BERLIN)
+    assert following - planned == 25 * 3600
+
+
+def test_timer_spaces_runs_due_together():
+    now = [1000.0]
+    started = []
+    loop = asyncio.new_event_loop()
+    try:
+        timer = AnsiblePlaybookScheduleTimer(loop, max_runs_per_minute=6, clock=lambda: now[0], random_source=random.Random(0))
+        for key in ("first", "second"):
+            timer.add(key, AnsiblePlaybookSchedule(interval=60, jitter=0), lambda key=key: started.append((key, now[0])))
+        assert 1000 <= timer.next_run("first") <= 1060
+        now[0] = 1100.0
+        timer._handle_timer()
+        # One run per 10 seconds
+        assert len(started) == 1
+        now[0] = 1110.0
+        timer._handle_timer()
+        assert sorted(key for key, _ in started) == ["first", "second"]
+        assert [at for _, at in started] == [1100.0, 1110.0]
+        # Missed runs are skipped, the next ones are planned after now
+        assert timer.next_run("first") > 1100 and timer.next_run("second") > 1110
+        timer.remove("first")
+        assert timer.next_run("first") is None
+        timer.shutdown()
+        assert timer.next_run("second") is None
+    finally:
+        loop.close()
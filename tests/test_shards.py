@@ -0,0 +1,92 @@
+"""Splitting the hosts of a run into shards and merging the results of the shards."""
+from custom_components.ansible_playbook import shards as shards_module
+from custom_components.ansible_playbook.process_manager import (
+    AnsiblePlaybookResult,
+    AnsiblePlaybookRunResult,
+    AnsiblePlaybookSummary,
+    merge_run_results,
+)
+from custom_components.ansible_playbook.shards import AnsibleShardPlanner, MIN_HOSTS_PER_SHARD, SHARDS_AUTO, shard_count, split_hosts
+
+
+def test_shard_count():
+    assert shard_count(10, 4, cpu_count=8, max_shards=2) == 4
+    # Never more shards than hosts, never less than one
+    assert shard_count(3, 4, cpu_count=8, max_shards=8) == 3
+    assert shard_count(0, 4, cpu_count=8, max_shards=8) == 1
+    # "auto" is capped by the CPU count, the concurrent runs and MIN_HOSTS_PER_SHARD
+    assert shard_count(1000, SHARDS_AUTO, cpu_count=4, max_shards=8) == 4
+    assert shard_count(1000, SHARDS_AUTO, cpu_count=8, max_shards=3) == 3
+    assert shard_count(3 * MIN_HOSTS_PER_SHARD - 1, SHARDS_AUTO, cpu_count=8, max_shards=8) == 2
+    assert shard_count(MIN_HOSTS_PER_SHARD - 1, SHARDS_AUTO, cpu_count=8, max_shards=8) == 1
+
+
+def test_split_hosts():
+    hosts = [f"host{index}" for index in range(7)]
+    shards = split_hosts(hosts, 3)
+    assert [len(shard) for shard in shards] == [3, 2, 2]
+    assert sorted(host for shard in shards for host in shard) == hosts
+
+
+def test_planner_lists_the_hosts_again_once_the_inventory_changed(tmp_path, monkeypatch):
+    inventory = tmp_path / "inventory"
+    inventory.write_text("host0\nhost1\nhost2\n")
+    listed = []
+
+    def list_inventory_hosts(private_data_dir, limit=None):
+        listed.append(limit)
+        return inventory.read_text().split()
+
+    monkeypatch.setattr(shards_module, "list_inventory_hosts", list_inventory_hosts)
+    planner = AnsibleShardPlanner(max_shards=4)
+    assert planner.plan(str(tmp_path), 2) == [["host0", "host2"], ["host1"]]
+    assert planner.plan(str(tmp_path), 2) == [["host0", "host2"], ["host1"]]
+    assert len(listed) == 1
+    # Another limit is listed by itself
+    planner.plan(str(tmp_path), 2, ["host0"])
+    assert listed == [None, ["host0"]]
+    inventory.write_text("host0\nhost1\nhost2\nhost3\n")
+    assert planner.plan(str(tmp_path), 2) == [["host0", "host2"], ["host1", "host3"]]
+    assert len(listed) == 3
+
+
+def test_planner_does_not_split_without_inventory(tmp_path, monkeypatch):
+    def list_inventory_hosts(private_data_dir, limit=None):
+        raise shards_module.InventoryError("no inventory")
+
+    monkeypatch.setattr(shards_module, "list_inventory_hosts", list_inventory_hosts)
+    assert AnsibleShardPlanner(max_shards=4).plan(str(tmp_path), 2) is None
+
+
+def _shard_result(status: str, started_at: float, finished_at: float, **hosts) -> AnsiblePlaybookRunResult:
+    return AnsiblePlaybookRunResult(
+        {host: AnsiblePlaybookResult(host, ok=ok) for host, ok in hosts.items()},
+        AnsiblePlaybookSummary(),
+        status,
+        started_at,
+        finished_at,
+        fact_gathering=finished_at - started_at,
+    )
+
+
+def test_merge_run_results():
+    merged = merge_run_results([
+        _shard_result("successful", 10.0, 20.0, web0=2, web2=1),
+        _shard_result("successful", 11.0, 25.0, web1=3),
+    ])
+    assert merged.status == "successful"
+    assert sorted(merged.hosts) == ["web0", "web1", "web2"]
+    assert merged.hosts["web1"].ok == 3
+    assert (merged.summary.hosts, merged.summary.ok) == (3, 6)
+    assert (merged.started_at, merged.finished_at, merged.fact_gathering) == (10.0, 25.0, 14.0)
+
+
+def test_merged_status():
+    def status(*statuses) -> str:
+        return merge_run_results([_shard_result(status, 0.0, 1.0) for status in statuses]).status
+
+    assert status("successful", "failed") == "failed"
+    assert status("failed", "timeout") == "timeout"
+    assert status("canceled", "successful") == "canceled"
+    # A timeout wins over a cancellation
+    assert status("canceled", "timeout") == "timeout"
@@ -0,0 +1,27 @@
+"""Runs the stress scenario of the benchmarks against the process manager on every execution backend."""
+import asyncio
+import multiprocessing
+
+import pytest
+
+from custom_components.ansible_playbook.ansible_playbook_runner import BACKENDS
+
+from .benchmark import run_stress
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_stress(backend):
+    result = asyncio.run(run_stress(
+        backend,
+        presses=200,
+        entities=10,
+        max_concurrent_runs=4,
+        run_seconds=0.02,
+        stop_ratio=0.05,
+        pollers=2,
+        seed=0,
+    ))
+    # Stuck RUNNING or QUEUED runs, double starts, exceeded limits, errors and leaked workers are all violations
+    assert result["violations"] == []
+    assert result["runs"] > 0
+    assert multiprocessing.active_children() == []
@@ -0,0 +1,32 @@
+"""Reading the vault password files once."""
+import os
+
+import pytest
+
+from custom_components.ansible_playbook.vault_secrets import AnsibleVaultSecrets
+
+
+def test_password_is_read_again_once_the_file_changed(tmp_path):
+    path = tmp_path / "vault.txt"
+    path.write_text("secret\n")
+    os.utime(path, ns=(1, 1))
+    secrets = AnsibleVaultSecrets()
+    assert secrets.get(str(path)) == "secret"
+    # Same mtime and size, not read again
+    path.write_text("terces\n")
+    os.utime(path, ns=(1, 1))
+    assert secrets.get(str(path)) == "secret"
+    path.write_text("another secret\n")
+    assert secrets.get(str(path)) == "another secret"
+
+
+def test_scripts_are_left_to_ansible(tmp_path):
+    path = tmp_path / "vault.sh"
+    path.write_text("#!/bin/sh\necho secret\n")
+    path.chmod(0o700)
+    assert AnsibleVaultSecrets().get(str(path)) is None
+
+
+def test_missing_file():
+    with pytest.raises(OSError):
+        AnsibleVaultSecrets().get("/nonexistent/vault.txt")
@@ -0,0 +1,32 @@
+"""Stopping pool workers, with a runner which takes long to preload."""
+import multiprocessing
+import time
+
+from custom_components.ansible_playbook.worker_pool import AnsiblePoolWorker
+from .fake_runner import FakePlaybookRunner
+
+
+class SlowPreloadRunner(FakePlaybookRunner):
+    def preload(self) -> None:
+        time.sleep(60)
+
+
+def _stop(worker: AnsiblePoolWorker) -> float:
+    begin = time.monotonic()
+    worker.stop(timeout=1)
+    assert not worker.is_alive()
+    return time.monotonic() - begin
+
+
+def test_stop_while_preloading():
+    worker = AnsiblePoolWorker(multiprocessing.get_context("spawn"), SlowPreloadRunner())
+    time.sleep(0.5)
+    # The worker has its own process group before it preloads, so it is killed once the timeout is over
+    assert _stop(worker) < 3
+
+
+def test_kill_while_starting():
+    worker = AnsiblePoolWorker(multiprocessing.get_context("spawn"), SlowPreloadRunner())
+    # Most likely before the worker got its own process group
+    worker.kill()
+    assert _stop(worker) < 3